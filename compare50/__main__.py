@@ -1,4 +1,5 @@
 import argparse
+import concurrent.futures
 import contextlib
 import glob
 import itertools
@@ -15,9 +16,11 @@ import tempfile
 
 import attr
 import lib50
+import pygments.lexers
+import pygments.util
 import termcolor
 
-from . import comparators, _api, _data, _renderer, __version__
+from . import comparators, _api, _cache, _checkpoint, _data, _incremental, _renderer, __version__
 
 
 def excepthook(cls, exc, tb):
@@ -56,6 +59,8 @@ def partition(vals, pred):
 class SubmissionFactory:
     def __init__(self):
         self.max_file_size = 1024 * 1024
+        self.max_workers = 16
+        self.lexers = {}
         self.patterns = []
         self.submissions = {}
 
@@ -67,43 +72,104 @@ class SubmissionFactory:
         pattern = lib50.config.TaggedValue(pattern, "exclude")
         self.patterns.append(pattern)
 
-    def _get(self, path, preprocessor, is_archive=False):
-        path = pathlib.Path(path)
-
-        # Ask lib50 which file(s) in path should be included
-        if path.is_file():
-            # lib50.files operates on a directory
-            # So create a tempdir if the path is just a file
-            with tempfile.TemporaryDirectory() as dir:
-                (pathlib.Path(dir) / path.name).touch()
-                included, excluded = lib50.files(self.patterns, root=dir)
-            path = path.parent
-        else:
-            included, excluded = lib50.files(self.patterns, require_tags=[], root=path)
-
-        # Filter out any non utf8 files
-        decodable, undecodable = partition(included, lambda fp: self._is_valid_utf8(path / fp))
-
-        # Filter out any large files (>self.max_file_size)
-        small, large = partition(decodable, lambda fp: (path / fp).stat().st_size <= self.max_file_size)
-
-        return _data.Submission(path, sorted(small),
-                                large_files=sorted(large),
-                                undecodable_files=sorted(undecodable),
-                                preprocessor=preprocessor,
-                                is_archive=is_archive)
+    def _find(self, path, absolute_path, included):
+        """
+        Find the files of the submission at ``path``, of which lib50 ``included`` the files
+        (see :class:`_lib50_files`). Returns the path of the submission, its files, large files,
+        and undecodable files, and the text of its files if that is cached. Only touches the
+        file system through ``absolute_path``, so multiple threads can find submissions at once.
+        """
+        if absolute_path.is_file():
+            path, absolute_path = path.parent, absolute_path.parent
+
+        small, large, undecodable = [], [], []
+        texts = {}
+        for fp in included:
+            # Read small files only once, then keep their text to lex them later
+            file_path = absolute_path / fp
+            if file_path.stat().st_size <= self.max_file_size:
+                text = self._read_utf8(file_path)
+                if text is None:
+                    undecodable.append(fp)
+                else:
+                    small.append(fp)
+                    if _data.File._text_cache is not None:
+                        texts[fp] = text
+            else:
+                # Filter out any non utf8 files, then any large files (>self.max_file_size)
+                (large if self._is_valid_utf8(file_path) else undecodable).append(fp)
+
+        return path, small, large, undecodable, texts
+
+    def _submission(self, path, found, preprocessor, is_archive):
+        path, small, large, undecodable, texts = found
+        sub = _data.Submission(path, sorted(small),
+                               large_files=sorted(large),
+                               undecodable_files=sorted(undecodable),
+                               preprocessor=preprocessor,
+                               is_archive=is_archive,
+                               lexers=self.lexers)
+        for file in sub.files:
+            if str(file.name) in texts:
+                _data.File._text_cache.put(file.path, texts[str(file.name)])
+        return sub
 
     def get_all(self, paths, preprocessor, is_archive=False):
         """
         For every path, and every preprocessor, generate a Submission containing that path/preprocessor.
         Returns a list of lists of Submissions.
         """
+        paths = [pathlib.Path(path) for path in paths]
+        absolute_paths = [path.absolute() for path in paths]
+
+        # Ask lib50 which files of every submission should be included. lib50.files changes the
+        # working directory while it globs, so ask it in worker processes (each of which has a
+        # working directory of its own) rather than threads
+        with _api.Executor() as executor:
+            included = list(executor.map(self._lib50_files(self.patterns), absolute_paths,
+                                         chunksize=max(1, len(paths) // (4 * (os.cpu_count() or 1)))))
+
+        # Find the files of submissions on a pool of threads, as this is mostly waiting on the file
+        # system, but create the submissions in order, so that their ids do not depend on timing
         subs = set()
-        for sub_path in paths:
-            subs.add(self._get(sub_path, preprocessor, is_archive))
-            _api.get_progress_bar().update()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for path, found in zip(paths, executor.map(self._find, paths, absolute_paths, included)):
+                subs.add(self._submission(path, found, preprocessor, is_archive))
+                _api.get_progress_bar().update()
         return subs
 
+    @attr.s(slots=True)
+    class _lib50_files:
+        """ "Function" that asks lib50 which files of the submission at an absolute path
+        should be included. In the form of a class so that pickle can serialize it. """
+        patterns = attr.ib()
+
+        def __call__(self, absolute_path):
+            if absolute_path.is_file():
+                # lib50.files operates on a directory
+                # So create a tempdir if the path is just a file
+                with tempfile.TemporaryDirectory() as dir:
+                    (pathlib.Path(dir) / absolute_path.name).touch()
+                    included, excluded = lib50.files(self.patterns, root=dir)
+            else:
+                included, excluded = lib50.files(self.patterns, require_tags=[], root=absolute_path)
+            return included
+
+    @staticmethod
+    def _read_utf8(file_path):
+        """
+        Read the text of the file at file_path, as :meth:`compare50.File.read` would.
+        Returns ``None`` if the file is not valid utf-8.
+        """
+        with open(file_path, "rb") as f:
+            data = f.read()
+        try:
+            text = data.decode("utf8")
+        except UnicodeDecodeError:
+            return None
+        # Translate newlines like reading in text mode does
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+
     @staticmethod
     def _is_valid_utf8(file_path):
         """
@@ -289,17 +355,53 @@ def expand_patterns(patterns):
     return list(itertools.chain.from_iterable(map(lambda x: glob.glob(x, recursive=True) or [x], patterns)))
 
 
+def lexer_mapping(value):
+    """
+    Parse a mapping from a file extension (e.g. ``.h``), or the name of files
+    without an extension (e.g. ``Makefile``), to a Pygments lexer (e.g. ``c``).
+    """
+    key, sep, name = value.partition("=")
+    if not key or not sep:
+        raise argparse.ArgumentTypeError(f"{value} is not of the form EXT=LEXER")
+    try:
+        return key, pygments.lexers.get_lexer_by_name(name)
+    except pygments.util.ClassNotFound:
+        raise argparse.ArgumentTypeError(f"{name} is not a lexer known to Pygments")
+
+
+def frequency(value):
+    """
+    Parse a frequency, either an absolute number (e.g. ``100``)
+    or a percentage (e.g. ``5%``), which is returned as a fraction.
+    """
+    if value.endswith("%"):
+        return float(value[:-1]) / 100
+    return int(value)
+
+
 def main():
     submission_factory = SubmissionFactory()
 
     parser = ArgParser(prog="compare50")
     parser.add_argument("submissions",
-                        nargs="+",
+                        nargs="*",
                         help="Paths to submissions to compare")
     parser.add_argument("-a", "--archive",
                         nargs="+",
                         default=[],
                         help="Paths to archive submissions. Archive submissions are not compared against other archive submissions, only against regular submissions.")
+    parser.add_argument("--archive-index",
+                        action="store",
+                        metavar="FILE",
+                        type=pathlib.Path,
+                        help="Path to an archive index built by --build-archive, used instead of -a."
+                             " The index is memory-mapped, so the archive is not indexed again.")
+    parser.add_argument("--build-archive",
+                        action="store",
+                        metavar="FILE",
+                        type=pathlib.Path,
+                        help="index the archive submissions (-a) for the first pass, write the index to FILE"
+                             " (for use with --archive-index), then exit")
     parser.add_argument("-d", "--distro",
                         nargs="+",
                         default=[],
@@ -340,11 +442,51 @@ def main():
                         metavar="MATCHES",
                         type=int,
                         help="number of matches to output")
+    parser.add_argument("--max-frequency",
+                        action="store",
+                        type=frequency,
+                        help="skip fingerprints that occur in more than MAX_FREQUENCY files while ranking,"
+                             " either a number of files or a percentage of all files (e.g. 5%%)."
+                             " Speeds up ranking large numbers of submissions with common code.")
+    parser.add_argument("--candidates",
+                        action="store",
+                        type=int,
+                        help="only score the CANDIDATES pairs of submissions that a fast, approximate, comparison"
+                             " deems most similar while ranking. Speeds up ranking very large numbers of submissions,"
+                             " but might miss similar pairs. More candidates means fewer missed pairs.")
     parser.add_argument("--max-file-size",
                         action="store",
                         default=1024,
                         type=int,
                         help="maximum allowed file size in KiB (default 1024 KiB)")
+    parser.add_argument("--lexer",
+                        action="append",
+                        default=[],
+                        metavar="EXT=LEXER",
+                        type=lexer_mapping,
+                        help="lex files with extension EXT (e.g. .h=c), or files without an extension named EXT"
+                             " (e.g. Makefile=make), with the Pygments lexer LEXER, rather than the lexer Pygments"
+                             " picks, or guesses from their contents")
+    parser.add_argument("--cache",
+                        action="store",
+                        metavar="DIR",
+                        type=pathlib.Path,
+                        help="cache fingerprints in DIR, so that files that are unchanged since a previous run"
+                             " are not indexed again")
+    parser.add_argument("--cache-size",
+                        action="store",
+                        default=1024,
+                        type=int,
+                        help="maximum size of the cache in MiB (default 1024 MiB)")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="keep the index of all submissions, and the results, in the output directory."
+                             " If the output directory holds these already, add the submissions to its results"
+                             " instead, by comparing them only against each other and the submissions compared before")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="resume the run that was interrupted (or failed) with the same arguments,"
+                             " rather than start over, skipping the submissions, scores and pairs it completed")
     parser.add_argument("--profile",
                         action="store_true",
                         help="profile compare50 (development only, requires line_profiler, implies debug)")
@@ -357,11 +499,20 @@ def main():
 
     args = parser.parse_args()
 
+    if not args.submissions and not args.build_archive:
+        parser.error("the following arguments are required: submissions")
+
     excepthook.verbose = args.verbose
 
     # Set max file size in bytes
     submission_factory.max_file_size = args.max_file_size * 1024
 
+    # Lexers are passed along with every submission, as workers need not share our state
+    submission_factory.lexers = {key: lexer.aliases[0] for key, lexer in args.lexer}
+
+    if args.cache:
+        _cache.fingerprint_cache = _cache.FingerprintCache(args.cache, max_size=args.cache_size * 1024 * 1024)
+
     for attrib in ("submissions", "archive", "distro"):
         # Expand all patterns found in args.{submissions,archive,distro}
         setattr(args, attrib, expand_patterns(getattr(args, attrib)))
@@ -375,6 +526,48 @@ def main():
 
     preprocessor = _data.Preprocessor(passes[0].preprocessors)
 
+    for option in ("max_frequency", "candidates"):
+        if getattr(args, option) is None:
+            continue
+        if not isinstance(passes[0].comparator, comparators.Winnowing):
+            raise _api.Error("--{} is not supported by {}".format(option.replace("_", "-"), passes[0].__name__))
+        setattr(passes[0].comparator, option, getattr(args, option))
+
+    if args.archive_index or args.build_archive:
+        if not isinstance(passes[0].comparator, comparators.Winnowing):
+            raise _api.Error("archive indices are not supported by {}".format(passes[0].__name__))
+        if args.archive_index and args.archive:
+            raise _api.Error("--archive-index cannot be combined with -a")
+
+    # Add to the results of an earlier incremental run, if there are any
+    add = args.incremental and _incremental.exists(args.output)
+    if args.incremental:
+        if not isinstance(passes[0].comparator, comparators.Winnowing):
+            raise _api.Error("--incremental is not supported by {}".format(passes[0].__name__))
+        if args.build_archive:
+            raise _api.Error("--incremental cannot be combined with --build-archive")
+        if add and (args.archive or args.archive_index):
+            raise _api.Error("-a and --archive-index cannot be used to add submissions to {}".format(args.output))
+        if args.resume:
+            raise _api.Error("--incremental cannot be combined with --resume")
+
+    # Checkpoint every phase in the output directory, such that the run can be resumed if it fails.
+    # These checkpoints hold everything that determines the outcome of a run
+    settings = {"version": __version__,
+                "submissions": args.submissions,
+                "archive": args.archive,
+                "archive_index": None if args.archive_index is None else str(args.archive_index.resolve()),
+                "distro": args.distro,
+                "passes": args.passes,
+                "patterns": [[pattern.tag, pattern.value] for pattern in submission_factory.patterns],
+                "max_file_size": args.max_file_size,
+                "lexer": [[key, type(lexer).__name__] for key, lexer in args.lexer],
+                "n": args.n,
+                "max_frequency": args.max_frequency,
+                "candidates": args.candidates}
+    checkpoint = _checkpoint.Checkpoint(None if args.incremental else args.output, settings)
+    resume = args.resume and checkpoint.exists()
+
     if args.profile:
         args.debug = True
         profiler = profile
@@ -384,7 +577,20 @@ def main():
     if args.debug:
         _api.Executor = _api.FauxExecutor
 
-    if args.output.exists():
+    if args.build_archive:
+        with profiler():
+            with _api.progress_bar("Preparing", total=len(args.archive), disable=args.debug):
+                archive_subs = submission_factory.get_all(args.archive, preprocessor, is_archive=True)
+            archive_subs = sorted((sub for sub in archive_subs if sub.files), key=lambda sub: sub.id)
+
+            with _api.progress_bar(f"Indexing ({passes[0].__name__})", disable=args.debug):
+                passes[0].comparator.build_archive(archive_subs, args.build_archive)
+
+        termcolor.cprint(f"Done! Built an archive index of {len(archive_subs)} submissions in {args.build_archive}.",
+                         "green")
+        return
+
+    if args.output.exists() and not add and not resume:
         try:
             resp = input(f"File path {termcolor.colored(args.output, None, attrs=['underline'])}"
                           " already exists. Do you want to remove it? [Y/n] ")
@@ -401,17 +607,67 @@ def main():
             print("Quitting...")
             sys.exit(1)
 
-    with profiler():
+    if resume:
+        checkpoint.resume()
+    else:
+        checkpoint.start()
+
+    # Files are read while preparing submissions, keep their text to lex them later
+    with profiler(), _cache.cache_texts():
         total = len(args.submissions) + len(args.archive) + len(args.distro)
         with _api.progress_bar("Preparing", total=total, disable=args.debug) as bar:
             # Collect all submissions, archive submissions and distro files
-            subs = submission_factory.get_all(args.submissions, preprocessor)
-            archive_subs = submission_factory.get_all(args.archive, preprocessor, is_archive=True)
-            ignored_subs = submission_factory.get_all(args.distro, preprocessor)
+            subs, archive_subs, ignored_subs = checkpoint.inventory(lambda: (
+                list(submission_factory.get_all(args.submissions, preprocessor)),
+                list(submission_factory.get_all(args.archive, preprocessor, is_archive=True)),
+                list(submission_factory.get_all(args.distro, preprocessor))), preprocessor, submission_factory.lexers)
             ignored_files = {f for sub in ignored_subs for f in sub.files}
 
+            # Map a prebuilt archive index, after the submissions so that archive submissions have larger ids
+            if args.archive_index:
+                archive = passes[0].comparator.load_archive(args.archive_index, preprocessor, submission_factory.lexers)
+                passes[0].comparator.archive = archive
+                archive_subs = archive.submissions
+
+            # Submissions compared before are archive submissions while scoring, such that they are
+            # not compared against each other again, but are ranked and rendered as submissions
+            distro = sorted(str(f.path.resolve()) for f in ignored_files)
+            if add:
+                archive = passes[0].comparator.load_archive(_incremental.index_path(args.output), preprocessor,
+                                                            submission_factory.lexers)
+                passes[0].comparator.archive = archive
+                archive_subs = archive.submissions
+                state = _incremental.load(args.output, archive_subs)
+                passes[0].comparator.previous_scores = state.scores
+                if state.passes != args.passes:
+                    raise _api.Error("{} holds the results of other passes: {}".format(args.output, state.passes))
+                if state.distro != distro:
+                    raise _api.Error("{} holds results with other distro files".format(args.output))
+                seen = {str(sub.path) for sub in archive_subs}
+                for sub in subs:
+                    if str(sub.path.resolve()) in seen:
+                        raise _api.Error("{} was compared before".format(sub.path))
+            elif args.incremental:
+                state = _incremental.State(args.output, args.passes, distro)
+
+            if args.incremental:
+                _incremental.index_path(args.output).parent.mkdir(parents=True, exist_ok=True)
+                passes[0].comparator.index_path = _incremental.index_path(args.output)
+
+            checkpoint.submissions = list(itertools.chain(subs, archive_subs, ignored_subs))
+
         print_stats(subs, archive_subs, ignored_subs, ignored_files, verbose=bool(args.verbose))
 
+        # Guess the lexers of files without a known extension once, rather than once per pass.
+        # Submissions of a prebuilt archive index are only read if they turn out to be similar
+        with _api.progress_bar("Guessing lexers", disable=args.debug):
+            guess_subs = itertools.chain(subs, ignored_subs, [] if args.archive_index or add else archive_subs)
+            n_guessed, guess_time = _api.guess_lexers([f for sub in guess_subs for f in sub.files])
+        if n_guessed:
+            data = PluralDict(n=n_guessed, time=guess_time)
+            termcolor.cprint("Guessed the lexer of {n} file{n(s)} from {n(its,their)} contents in {time:.2f}s,"
+                             " use --lexer to choose lexers instead".format_map(data), "yellow", attrs=["bold"])
+
         # Remove any empty submissions
         subs = [sub for sub in subs if sub.files]
         archive_subs = [archive for archive in archive_subs if archive.files]
@@ -422,26 +678,45 @@ def main():
 
         with _api.progress_bar(f"Scoring ({passes[0].__name__})", disable=args.debug) as bar:
             # Cross compare and rank all submissions, keep only top `n`
-            scores = _api.rank(subs, archive_subs, ignored_files, passes[0], n=args.n)
+            scores = checkpoint.scores(lambda: _api.rank(subs, archive_subs, ignored_files, passes[0], n=args.n))
+
+        # Only the new pairs are compared and rendered, the pages of the others are reused
+        new_scores = scores
+        if args.incremental:
+            # Ranking scored the pairs of earlier runs again, as the frequencies of fingerprints changed
+            seen = {(score.sub_a, score.sub_b) for score in state.scores}
+            new_scores = [score for score in scores if (score.sub_a, score.sub_b) not in seen]
+            state.scores = scores
 
         # If ranking produced no scores, there are no matches, stop
         if not scores:
+            if args.incremental:
+                _incremental.save(state)
+            checkpoint.remove()
             termcolor.cprint(f"Done, no similarities found.", "yellow")
             return
 
-        # Get the matching spans, group them per submission
+        # Get the matching spans, group them per submission. Every file is lexed only
+        # once, after which every pass preprocesses its cached tokens
         groups = []
         pass_to_results = {}
-        for pass_ in passes:
-            with _api.progress_bar(f"Comparing ({pass_.__name__})", disable=args.debug):
-                preprocessor = _data.Preprocessor(pass_.preprocessors)
-                for sub in itertools.chain(subs, archive_subs, ignored_subs):
-                    object.__setattr__(sub, "preprocessor", preprocessor)
-                pass_to_results[pass_] = _api.compare(scores, ignored_files, pass_)
+        with _cache.cache_tokens():
+            for pass_ in passes:
+                with _api.progress_bar(f"Comparing ({pass_.__name__})", disable=args.debug):
+                    preprocessor = _data.Preprocessor(pass_.preprocessors)
+                    for sub in itertools.chain(subs, archive_subs, ignored_subs):
+                        object.__setattr__(sub, "preprocessor", preprocessor)
+                    pass_to_results[pass_] = checkpoint.compare(new_scores, ignored_files, pass_)
 
         # Render results
         with _api.progress_bar("Rendering", disable=args.debug):
-            index = _renderer.render(pass_to_results, dest=args.output)
+            if args.incremental:
+                index = _renderer.render(pass_to_results, dest=args.output, scores=scores,
+                                         contents=state.contents, pages=state.pages)
+                _incremental.save(state)
+            else:
+                index = _renderer.render(pass_to_results, dest=args.output, pages=checkpoint.pages())
+        checkpoint.remove()
 
     termcolor.cprint(
         f"Done! Visit file://{index.absolute()} in a web browser to see the results.", "green")
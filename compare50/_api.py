@@ -1,3 +1,4 @@
+import bisect
 import collections
 import contextlib
 import heapq
@@ -5,14 +6,14 @@ import io
 import itertools
 import time
 
-import intervaltree
+import numpy as np
 import tqdm
 
 import concurrent.futures
-from ._data import Submission, Span, Group, BisectList, Compare50Result
+from ._data import Submission, File, Span, Group, Compare50Result, Tokens, _digest, _guess_lexer, _read
 
 
-__all__ = ["rank", "compare", "missing_spans", "expand", "progress_bar", "get_progress_bar", "Error"]
+__all__ = ["rank", "compare", "missing_spans", "expand", "guess_lexers", "progress_bar", "get_progress_bar", "Error"]
 
 
 class Error(Exception):
@@ -38,9 +39,8 @@ def rank(submissions, archive_submissions, ignored_files, pass_, n=50):
 
     Rank submissions, return the top ``n`` most similar pairs
     """
-    scores = pass_.comparator.score(submissions, archive_submissions, ignored_files)
     # Keep only top `n` submission matches
-    return heapq.nlargest(n, scores)
+    return pass_.comparator.top_scores(submissions, archive_submissions, ignored_files, n)
 
     # max_id = max((max(score.sub_a.id, score.sub_b.id) for score in scores))
     # matrix = np.zeros((max_id+1, max_id+1))
@@ -68,25 +68,26 @@ def compare(scores, ignored_files, pass_):
     list of :class:`compare50.compare50Result`\ s.
     """
 
-    missing_spans_cache = {}
+    # Flattened ignored spans (including the spans lost by preprocessors) of every file,
+    # comparators report the same ignored spans for a file in every comparison
+    file_to_ignored_spans = {}
     sub_match_to_ignored_spans = {}
     sub_match_to_groups = {}
 
     for comparison in pass_.comparator.compare(scores, ignored_files):
+        # Divide ignored_spans per file, only for files that were not seen before
+        file_to_spans = collections.defaultdict(list)
+        if not all(file in file_to_ignored_spans for sub in (comparison.sub_a, comparison.sub_b) for file in sub.files):
+            for span in comparison.ignored_spans:
+                file_to_spans[span.file].append(span)
+
         new_ignored_spans = []
         for sub in (comparison.sub_a, comparison.sub_b):
             for file in sub.files:
-                # Divide ignored_spans per file
-                ignored_spans_file = [span for span in comparison.ignored_spans
-                                           if span.file == file]
-
-                # Find all spans lost by preprocessors for file_a
-                if file not in missing_spans_cache:
-                    missing_spans_cache[file] = missing_spans(file)
-                ignored_spans_file.extend(missing_spans_cache[file])
-
-                # Flatten the spans (they could be overlapping)
-                new_ignored_spans += _flatten_spans(ignored_spans_file)
+                if file not in file_to_ignored_spans:
+                    # Find all spans lost by preprocessors, then flatten the spans (they could be overlapping)
+                    file_to_ignored_spans[file] = _flatten_spans(file_to_spans[file] + missing_spans(file))
+                new_ignored_spans += file_to_ignored_spans[file]
 
         sub_match_to_ignored_spans[(comparison.sub_a, comparison.sub_b)] = new_ignored_spans
 
@@ -120,9 +121,9 @@ def missing_spans(file, original_tokens=None, processed_tokens=None):
     """
 
     if original_tokens is None:
-        original_tokens = file.unprocessed_tokens()
+        original_tokens = file.unprocessed_tokens(columnar=True)
     if processed_tokens is None:
-        processed_tokens = list(file.submission.preprocessor(original_tokens))
+        processed_tokens = file._preprocess(original_tokens, columnar=True)
 
     if not original_tokens:
         return []
@@ -130,19 +131,56 @@ def missing_spans(file, original_tokens=None, processed_tokens=None):
     file_start = original_tokens[0].start
     file_end = original_tokens[-1].end
 
-    spans = []
-    start = file_start
-    for token in processed_tokens:
-        if token.start != start:
-            spans.append(Span(file, start, token.start))
-        start = token.end
+    if isinstance(processed_tokens, Tokens):
+        starts, ends = processed_tokens.starts, processed_tokens.ends
+    else:
+        processed_tokens = list(processed_tokens)
+        starts = np.fromiter((token.start for token in processed_tokens), dtype=np.int64, count=len(processed_tokens))
+        ends = np.fromiter((token.end for token in processed_tokens), dtype=np.int64, count=len(processed_tokens))
+
+    # Anything between the end of a token (or the start of the file) and the start of the next is missing
+    previous_ends = np.concatenate(([file_start], ends[:-1]))
+    missing = np.flatnonzero(starts != previous_ends)
+    spans = [Span(file, start, end) for start, end in zip(previous_ends[missing].tolist(), starts[missing].tolist())]
 
-    if start < file_end:
-        spans.append(Span(file, start, file_end))
+    end = int(ends[-1]) if len(ends) else file_start
+    if end < file_end:
+        spans.append(Span(file, end, file_end))
 
     return spans
 
 
+def guess_lexers(files):
+    """
+    :param files: files whose lexers should be determined
+    :type files: [:class:`compare50.File`]
+    :returns: the number of files whose lexer was guessed, and the time spent guessing in seconds
+    :rtype: (int, float)
+
+
+    Guess the lexers of the files that have no lexer for their name from their contents,
+    in parallel. Every file is guessed once here, rather than once per pass later on.
+    """
+    files = [file for file in files if file._lexer_for_name() is None]
+
+    bar = get_progress_bar()
+    bar.reset(total=max(len(files), 1))
+
+    seconds = 0
+    with Executor() as executor:
+        for digest, lexer, time_ in executor.map(_guess_lexer_of, [file.path for file in files]):
+            File._guessed_lexers[digest] = lexer
+            seconds += time_
+            bar.update()
+    return len(files), seconds
+
+
+def _guess_lexer_of(path):
+    text = _read(path)
+    lexer, seconds = _guess_lexer(text)
+    return _digest(text), lexer, seconds
+
+
 def expand(span_matches, tokens_a, tokens_b):
     """
     :param span_matches: span pairs to be expanded wherein the first element of every \
@@ -151,10 +189,10 @@ def expand(span_matches, tokens_a, tokens_b):
     :type span_matches: [(:class:`compare50.Span`, :class:`compare50.Span`)]
     :param tokens_a: the tokens of the file corresponding to the first element of each \
             ``span_match``
-    :type tokens_a: [:class:`compare50.Token`]
+    :type tokens_a: [:class:`compare50.Token`] or :class:`compare50.Tokens`
     :param tokens_b: :param tokens_a: the tokens of the file corresponding to the first \
             element of each ``span_match``
-    :type tokens_b: [:class:`compare50.Token`]
+    :type tokens_b: [:class:`compare50.Token`] or :class:`compare50.Tokens`
     :returns: A new list of maximially expanded span pairs
     :rtype: [(:class:`compare50.Span`, :class:`compare50.Span`)]
 
@@ -166,71 +204,152 @@ def expand(span_matches, tokens_a, tokens_b):
     if not span_matches:
         return span_matches
 
-    expanded_span_matches = set()
+    file_a, file_b = span_matches[0][0].file, span_matches[0][1].file
+    starts_a, ends_a, starts_b, ends_b = (np.array(offsets, dtype=np.int64) for offsets in
+                                          zip(*((span_a.start, span_a.end, span_b.start, span_b.end)
+                                                for span_a, span_b in span_matches)))
 
-    # Keep a list of tokens, sorted by the start (BisectList facilitates binary search)
-    tokens_a = BisectList.from_sorted(tokens_a, key=lambda tok: tok.start)
-    tokens_b = BisectList.from_sorted(tokens_b, key=lambda tok: tok.start)
+    return [(Span(file_a, start_a, end_a), Span(file_b, start_b, end_b))
+            for start_a, end_a, start_b, end_b in _expand(starts_a, ends_a, starts_b, ends_b, tokens_a, tokens_b)]
 
-    # Keep track of the intervals of the file covered by spans so that we can
-    # avoid expanding span pairs that are already subsumed
-    span_tree_a = intervaltree.IntervalTree()
-    span_tree_b = intervaltree.IntervalTree()
 
-    # Sort span matches first, to ensure that, if there are contiguous identical spans, we
-    # start expanding the earliest span first.
-    span_matches = sorted(span_matches, key=lambda match: (match[0].start, match[1].start))
+def _expand(starts_a, ends_a, starts_b, ends_b, tokens_a, tokens_b):
+    """
+    Expand all span matches, given as arrays of the (character) offsets at which the
+    spans start and end, see :func:`expand`. Returns a list of maximally expanded span
+    matches, as (start_a, end_a, start_b, end_b) tuples.
+
+    Every span match that is not already subsumed (on both sides) by a previously expanded
+    match is expanded along its diagonal (the pairs of tokens at the same distance from the
+    span match) for as long as the tokens are identical. Because a diagonal is never walked
+    twice, and subsumption is checked in logarithmic time, this takes near-linear time.
+    """
+    expanded_span_matches = set()
+    tokens_a, tokens_b = Tokens.from_tokens(tokens_a), Tokens.from_tokens(tokens_b)
 
-    def is_subsumed(span, tree):
-        """Determine if span is contained by any interval in the tree.
-        Assumes that tree contains no intersecting intervals"""
-        return any(i.begin <= span.start and i.end >= span.end
-                       for i in tree[span.start:span.end])
+    # The start of every token, to find the tokens of the spans by binary search
+    token_starts_a, token_starts_b = tokens_a.starts, tokens_b.starts
+    token_ends_a, token_ends_b = tokens_a.ends.tolist(), tokens_b.ends.tolist()
 
+    # Tokens as integers, such that identical tokens are identical integers
+    codes_a, codes_b = _token_codes(tokens_a, tokens_b)
 
-    def _expand_side(cursor_a, cursor_b, step):
-        """One-sided expansion. Given the start/end indices of a span pair,
-        expand token-wise moving along the list of tokens according to ``step``.
+    # Sort span matches first, to ensure that, if there are contiguous identical spans, we
+    # start expanding the earliest span first.
+    order = np.lexsort((starts_b, starts_a))
+    starts_a, ends_a, starts_b, ends_b = starts_a[order], ends_a[order], starts_b[order], ends_b[order]
+
+    # The token before the first token of every span, and a token of the span to expand right from
+    # (the one that starts before its end, but never one before the span itself)
+    lefts_a = np.searchsorted(token_starts_a, starts_a, side="right") - 2
+    lefts_b = np.searchsorted(token_starts_b, starts_b, side="right") - 2
+    rights_a = np.maximum(np.searchsorted(token_starts_a, ends_a, side="right") - 2, lefts_a + 1)
+    rights_b = np.maximum(np.searchsorted(token_starts_b, ends_b, side="right") - 2, lefts_b + 1)
+
+    # Keep track of the parts of the files covered by expanded spans, so that we can avoid
+    # expanding span pairs that are already subsumed. Spans are expanded in order of their start
+    # in a, so every expanded span in a starts before the current span does, and the current span
+    # is subsumed in a if any expanded span ends after it does. In b a span is subsumed if any
+    # expanded span that starts before it (by token) ends after it.
+    max_end_a = -1
+    max_ends_b = _PrefixMax(len(tokens_b))
+
+    for start_a, end_a, start_b, end_b, left_a, left_b, right_a, right_b in zip(
+            starts_a.tolist(), ends_a.tolist(), starts_b.tolist(), ends_b.tolist(),
+            lefts_a.tolist(), lefts_b.tolist(), rights_a.tolist(), rights_b.tolist()):
+        if max_end_a >= end_a and max_ends_b.get(left_b + 1) >= end_b:
+            continue
 
-        Returns a pair of indices corresponding to the new tokens"""
+        # Expand left
+        n = _run_length(codes_a, codes_b, left_a, left_b, -1)
+        new_start_a, new_start_b = left_a - n + 1, left_b - n + 1
 
-        tok_idx_a = tokens_a.bisect_key_right(cursor_a) - 2
-        tok_idx_b = tokens_b.bisect_key_right(cursor_b) - 2
+        # Expand right
+        n = _run_length(codes_a, codes_b, right_a, right_b, 1)
+        new_end_a, new_end_b = right_a + n - 1, right_b + n - 1
 
-        try:
-            while min(tok_idx_a, tok_idx_b) >= 0 and tokens_a[tok_idx_a] == tokens_b[tok_idx_b]:
-                tok_idx_a += step
-                tok_idx_b += step
-        except IndexError:
-            pass
+        new_span_match = (int(token_starts_a[new_start_a]), token_ends_a[new_end_a],
+                          int(token_starts_b[new_start_b]), token_ends_b[new_end_b])
 
-        tok_idx_a -= step
-        tok_idx_b -= step
+        max_end_a = max(max_end_a, new_span_match[1])
+        max_ends_b.update(new_start_b, new_span_match[3])
 
-        return tok_idx_a, tok_idx_b
+        # Add new spans
+        expanded_span_matches.add(new_span_match)
 
+    return list(expanded_span_matches)
 
-    for span_a, span_b in span_matches:
-        if is_subsumed(span_a, span_tree_a) and is_subsumed(span_b, span_tree_b):
-            continue
 
-        # Expand left
-        start_a, start_b = _expand_side(span_a.start, span_b.start, -1)
+def _token_codes(tokens_a, tokens_b):
+    """Map the tokens of both :class:`Tokens` to integers, such that tokens are equal iff their integers are."""
+    codes = collections.defaultdict(itertools.count().__next__)
+    token_codes = []
+    for tokens in (tokens_a, tokens_b):
+        # Every distinct (type, value) pair gets its code only once
+        n_values = len(tokens.value_table)
+        pairs, inverse = np.unique(tokens.types.astype(np.int64) * n_values + tokens.values, return_inverse=True)
+        pair_codes = np.fromiter((codes[tokens.type_table[pair // n_values], tokens.value_table[pair % n_values]]
+                                  for pair in pairs.tolist()), dtype=np.int64, count=len(pairs))
+        token_codes.append(pair_codes[inverse.ravel()])
+    return tuple(token_codes)
 
-        # Expand right
-        end_a, end_b = _expand_side(span_a.end, span_b.end, 1)
 
-        new_span_a = Span(span_a.file, tokens_a[start_a].start, tokens_a[end_a].end)
-        new_span_b = Span(span_b.file, tokens_b[start_b].start, tokens_b[end_b].end)
+def _run_length(codes_a, codes_b, i_a, i_b, step):
+    """
+    The number of pairs of identical codes, starting from ``codes_a[i_a]`` and ``codes_b[i_b]``
+    and moving along both arrays according to ``step`` (either 1 or -1).
+    """
+    if step == 1:
+        n = min(len(codes_a) - i_a, len(codes_b) - i_b)
+    else:
+        n = min(i_a, i_b) + 1
+    if i_a < 0 or i_b < 0 or n <= 0:
+        return 0
+
+    # Compare increasingly large chunks, so that short runs are cheap and long runs are fast
+    length = 0
+    chunk = 16
+    while length < n:
+        size = min(chunk, n - length)
+        if step == 1:
+            chunk_a = codes_a[i_a + length:i_a + length + size]
+            chunk_b = codes_b[i_b + length:i_b + length + size]
+        else:
+            chunk_a = codes_a[i_a - length - size + 1:i_a - length + 1][::-1]
+            chunk_b = codes_b[i_b - length - size + 1:i_b - length + 1][::-1]
 
-        span_tree_a.addi(new_span_a.start, new_span_a.end)
-        span_tree_b.addi(new_span_b.start, new_span_b.end)
+        different = np.flatnonzero(chunk_a != chunk_b)
+        if len(different):
+            return length + int(different[0])
+        length += size
+        chunk *= 4
+    return length
 
-        # Add new spans
-        expanded_span_matches.add((new_span_a, new_span_b))
 
-    # print(expanded_span_matches)
-    return list(expanded_span_matches)
+class _PrefixMax:
+    """
+    Fenwick tree over positions 0 up to ``size``, that keeps track of the largest value
+    at or before every position.
+    """
+    def __init__(self, size):
+        self._tree = [-1] * (size + 1)
+
+    def update(self, position, value):
+        """Set the value at ``position`` to ``value``, if that is larger."""
+        position += 1
+        while position < len(self._tree):
+            if self._tree[position] < value:
+                self._tree[position] = value
+            position += position & -position
+
+    def get(self, position):
+        """The largest value at or before ``position``, or -1 if there is none."""
+        position = min(position + 1, len(self._tree) - 1)
+        value = -1
+        while position > 0:
+            value = max(value, self._tree[position])
+            position -= position & -position
+        return value
 
 
 def _flatten_spans(spans):
@@ -273,62 +392,96 @@ def _group_span_matches(span_matches):
 
 
 def _transitive_closure(connections):
-    class Graph:
-        def __init__(self):
-            self.connections = collections.defaultdict(set)
-
-        def add(self, a, b):
-            self.connections[a].add(b)
-            self.connections[b].add(a)
-
-        def traverse(self, node, visited=None):
-            if visited is None:
-                visited = set()
-
-            visited.add(node)
-
-            for other_node in self.connections[node]:
-                if other_node not in visited:
-                    self.traverse(other_node, visited)
+    """
+    The connected components of the graph of ``connections``, pairs of nodes, in order of
+    first appearance. Found with a union-find, so that long chains of connections do not recurse.
+    """
+    index = {}
+    parents = []
 
-            return visited
+    def find(i):
+        while parents[i] != i:
+            # Path halving
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
 
-    graph = Graph()
     for a, b in connections:
-        graph.add(a, b)
-
-    trans_closure = []
-    nodes = graph.connections.keys()
-    while nodes:
-        node = next(iter(nodes))
-        reachable_nodes = graph.traverse(node)
-        nodes -= reachable_nodes
-        trans_closure.append(reachable_nodes)
-    return trans_closure
+        i = index.setdefault(a, len(index))
+        if i == len(parents):
+            parents.append(i)
+        j = index.setdefault(b, len(index))
+        if j == len(parents):
+            parents.append(j)
 
+        i, j = find(i), find(j)
+        if i != j:
+            parents[max(i, j)] = min(i, j)
 
-def _is_span_subsumed(span, other_spans):
-    for other_span in other_spans:
-        if span.start >= other_span.start and span.end <= other_span.end:
-            return True
-    return False
+    components = collections.defaultdict(set)
+    for node, i in index.items():
+        components[find(i)].add(node)
+    return list(components.values())
 
 
-def _is_group_subsumed(group, groups):
-    for other_group in groups:
-        if other_group == group or len(other_group.spans) < len(group.spans):
-            continue
-
+def _filter_subsumed_groups(groups):
+    """
+    Remove every group of which every span is contained in a span of the same file of
+    another group, that has at least as many spans. Containment is found per file by
+    sweeping over the spans in order of their start.
+    """
+    # Spans of every file, with the group they are in
+    file_to_spans = collections.defaultdict(list)
+    for i, group in enumerate(groups):
         for span in group.spans:
-            if not _is_span_subsumed(span, filter(lambda other: span.file == other.file, other_group.spans)):
-                break
+            file_to_spans[span.file].append((span, i))
+
+    # The groups that contain every span (the group of the span itself included)
+    containing = {}
+    for spans in file_to_spans.values():
+        # Longest spans first among spans that start at the same character,
+        # such that every span comes after the spans that contain it
+        spans.sort(key=lambda span_group: (span_group[0].start, -span_group[0].end))
+
+        # Spans seen so far that might still contain spans to come, ordered by their end
+        ends = []
+        open_groups = []
+        for span, i in spans:
+            # Spans that end before this one starts contain no span to come
+            n_closed = bisect.bisect_left(ends, span.start)
+            del ends[:n_closed], open_groups[:n_closed]
+
+            # Every span seen so far that ends at or after this one contains it
+            pos = bisect.bisect_left(ends, span.end)
+            containing[span, i] = set(open_groups[pos:])
+            containing[span, i].add(i)
+
+            ends.insert(pos, span.end)
+            open_groups.insert(pos, i)
+
+    # Identical spans (in different groups) contain one another both ways
+    span_to_groups = collections.defaultdict(set)
+    for span, i in containing:
+        span_to_groups[span].add(i)
+    for (span, i), groups_ in containing.items():
+        groups_ |= span_to_groups[span]
+
+    filtered = []
+    for i, group in enumerate(groups):
+        if group.spans:
+            spans = iter(group.spans)
+            candidates = set(containing[next(spans), i])
+            for span in spans:
+                if not candidates:
+                    break
+                candidates &= containing[span, i]
         else:
-            return True
-    return False
+            # A group without spans is contained in any other group
+            candidates = range(len(groups))
 
-
-def _filter_subsumed_groups(groups):
-    return [g for g in groups if not _is_group_subsumed(g, groups)]
+        if not any(j != i and len(groups[j].spans) >= len(group.spans) and groups[j] != group for j in candidates):
+            filtered.append(group)
+    return filtered
 
 
 class _ProgressBar:
@@ -369,6 +522,13 @@ class _ProgressBar:
         except AttributeError:
             self._n += amount
 
+    def write(self, msg):
+        """Print a message without disrupting the progress bar."""
+        try:
+            self._bar.write(msg)
+        except AttributeError:
+            pass
+
     def close(self, leave=True):
         try:
             self._bar.close(leave)
@@ -0,0 +1,94 @@
+import contextlib
+import json
+import os
+import pathlib
+import struct
+import tempfile
+
+import numpy as np
+
+from . import __version__
+from ._api import Error
+
+
+#: Every archive index starts with these bytes
+MAGIC = b"compare50 archive\n"
+
+#: Bump whenever the format of archive indices changes
+VERSION = 1
+
+#: Arrays are aligned to this many bytes within the file
+ALIGNMENT = 64
+
+
+def write(path, metadata, arrays):
+    """
+    Write ``metadata`` (anything that can be serialized as JSON) and ``arrays``
+    (a mapping from names to numpy arrays) to ``path``, such that :func:`read`
+    can memory-map the arrays. The file is written atomically.
+    """
+    path = pathlib.Path(path)
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # Layout of the arrays, relative to the (aligned) end of the header
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({"version": VERSION,
+                         "compare50": __version__,
+                         "metadata": metadata,
+                         "arrays": layout}).encode()
+
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(bytes(_align(f.tell()) - f.tell()))
+            for array in arrays.values():
+                f.write(array.tobytes())
+                f.write(bytes(_align(array.nbytes) - array.nbytes))
+        # Archive indices are meant to be shared, unlike mkstemp's files
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def read(path):
+    """
+    Read a file written by :func:`write`. Returns its metadata, and a mapping from
+    names to read-only arrays that are memory-mapped from the file (so that they are
+    never deserialized, and are shared by all processes that read the same file).
+    """
+    path = pathlib.Path(path)
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Error("{} is not an archive index".format(path))
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length).decode())
+        start = _align(f.tell())
+
+    if header["version"] != VERSION:
+        raise Error("{} was built by an incompatible version of compare50 ({}), please rebuild it"
+                    .format(path, header["compare50"]))
+
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        dtype, shape = np.dtype(layout["dtype"]), tuple(layout["shape"])
+        # mmap can not map empty arrays
+        if not np.prod(shape):
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=start + layout["offset"], shape=shape)
+    return header["metadata"], arrays
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,276 @@
+import collections
+import contextlib
+import hashlib
+import os
+import pathlib
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import pygments
+
+from . import __version__
+from ._data import File, Preprocessor
+
+
+class FingerprintCache:
+    """
+    Content-addressed on-disk cache of file fingerprints. Entries are keyed by a hash of
+    the file's contents together with everything else that determines its fingerprints
+    (e.g. the preprocessors and comparator settings), so a file that has not changed
+    since a previous run never has to be lexed and fingerprinted again.
+
+    :param path: directory in which the cache is stored
+    :type path: str or pathlib.Path
+    :param max_size: maximum size of the cache in bytes
+    :type max_size: int
+    :param max_age: entries that have not been used for this many seconds are evicted \
+            (``None`` to never evict entries because of their age)
+    :type max_age: float
+    """
+    #: Bump whenever the format of the cache entries, or of their keys, changes
+    VERSION = 2
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024, max_age=30 * 24 * 60 * 60):
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def key(self, file, *settings):
+        """
+        Compute the cache key of ``file``. ``settings`` should uniquely identify
+        how the fingerprints of ``file`` are computed.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((self.VERSION, __version__, file.name.name, settings)).encode())
+        # The text of the file, rather than its bytes, such that it is not read again if it is cached
+        digest.update(file.read().encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Retrieve cached fingerprints, returns ``None`` if ``key`` is not in the cache."""
+        path = self._path(key)
+        try:
+            fingerprints = np.load(path)
+        except (OSError, ValueError):
+            return None
+
+        # Mark the entry as recently used, so that it is evicted last
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        return fingerprints
+
+    def put(self, key, fingerprints):
+        """Store fingerprints (a sequence of integers) in the cache."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asarray(fingerprints, dtype=np.int64))
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+
+    def prune(self):
+        """
+        Evict entries that have not been used for ``max_age`` seconds, then evict the least
+        recently used entries until the cache is no larger than ``max_size`` bytes.
+        """
+        now = time.time()
+
+        entries = []
+        for path in self.path.glob("*/*"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+
+            # Remove temporary files left behind by interrupted runs
+            if path.suffix == ".tmp":
+                if now - stat.st_mtime > 60 * 60:
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # Oldest entries first
+        entries.sort()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for mtime, entry_size, path in entries:
+            is_stale = self.max_age is not None and now - mtime > self.max_age
+            if not is_stale and size <= self.max_size:
+                break
+
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            size -= entry_size
+
+    def _path(self, key):
+        return self.path / key[:2] / f"{key}.npy"
+
+
+class TokenCache:
+    """
+    Cache of the unprocessed tokens (:class:`compare50.Tokens`) of files, for the duration of
+    a single run. Tokens are written to ``path``, such that every process (e.g. the workers of
+    every pass) can read them instead of lexing a file again, and the most recently used are
+    also kept in memory.
+
+    :param path: directory in which the tokens are stored
+    :type path: str or pathlib.Path
+    :param max_memory: maximum number of bytes (of pickled tokens) kept in memory, per process
+    :type max_memory: int
+    """
+    def __init__(self, path, max_memory=256 * 1024 * 1024):
+        self.path = pathlib.Path(path)
+        self.max_memory = max_memory
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+
+    def get(self, file):
+        """Retrieve the unprocessed tokens of ``file``, returns ``None`` if they are not in the cache."""
+        try:
+            tokens, _ = self._memory[file.id]
+        except KeyError:
+            pass
+        else:
+            self._memory.move_to_end(file.id)
+            return tokens
+
+        try:
+            data = self._path(file).read_bytes()
+        except OSError:
+            return None
+        tokens = pickle.loads(data)
+        self._remember(file, tokens, len(data))
+        return tokens
+
+    def put(self, file, tokens):
+        """Store the unprocessed tokens of ``file`` in the cache."""
+        data = pickle.dumps(tokens, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(file))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+
+        self._remember(file, tokens, len(data))
+
+    def _remember(self, file, tokens, size):
+        """Keep ``tokens`` in memory, evicting the least recently used entries if needed."""
+        if size > self.max_memory:
+            return
+
+        _, previous_size = self._memory.pop(file.id, (None, 0))
+        self._memory_size += size - previous_size
+        self._memory[file.id] = (tokens, size)
+
+        while self._memory_size > self.max_memory:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+    def _path(self, file):
+        return self.path / str(file.id)
+
+
+class TextCache:
+    """
+    In-memory cache of the text of files, for files that are read before they are lexed
+    (e.g. to check that they are valid utf-8), such that they are not read again to lex them.
+    Workers inherit the cache, files are only added to it while it is smaller than ``max_memory``.
+
+    :param max_memory: maximum number of characters kept in memory
+    :type max_memory: int
+    """
+    def __init__(self, max_memory=256 * 1024 * 1024):
+        self.max_memory = max_memory
+        self._texts = {}
+        self._memory_size = 0
+
+    def get(self, path):
+        """Retrieve the text of the file at ``path``, returns ``None`` if it is not in the cache."""
+        return self._texts.get(pathlib.Path(path))
+
+    def put(self, path, text):
+        """Cache ``text``, the text of the file at ``path``, if it fits."""
+        if self._memory_size + len(text) > self.max_memory:
+            return
+        self._texts[pathlib.Path(path)] = text
+        self._memory_size += len(text)
+
+
+@contextlib.contextmanager
+def cache_texts(max_memory=256 * 1024 * 1024):
+    """
+    Context manager within which :meth:`compare50.File.read` reads the text of files
+    from a :class:`TextCache`, if it is in there.
+    """
+    previous = File._text_cache
+    File._text_cache = TextCache(max_memory=max_memory)
+    try:
+        yield File._text_cache
+    finally:
+        File._text_cache = previous
+
+
+@contextlib.contextmanager
+def cache_tokens(max_memory=256 * 1024 * 1024, processes=None):
+    """
+    Context manager within which :meth:`compare50.File.unprocessed_tokens` caches the tokens
+    of every file in a :class:`TokenCache`, which is removed when the context exits.
+
+    Every process keeps its own tokens in memory, so ``max_memory`` is split evenly
+    between the ``processes`` (by default one per CPU, as many as the workers of
+    :data:`compare50._api.Executor`).
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    with tempfile.TemporaryDirectory(prefix="compare50-tokens-") as path:
+        previous = File._token_cache
+        File._token_cache = TokenCache(path, max_memory=max_memory // processes)
+        try:
+            yield File._token_cache
+        finally:
+            File._token_cache = previous
+
+
+def describe(preprocessor):
+    """
+    Describe ``preprocessor`` in a way that is stable across runs, for use in cache keys.
+    Returns ``None`` if ``preprocessor`` cannot be identified (e.g. because it is a lambda).
+    """
+    if isinstance(preprocessor, Preprocessor):
+        parts = [describe(p) for p in preprocessor.preprocessors]
+        return None if None in parts else "[{}]".format(", ".join(parts))
+
+    name = getattr(preprocessor, "__qualname__", None)
+    if name is None or "<" in name:
+        return None
+    return f"{preprocessor.__module__}.{name}"
+
+
+def describe_lexer(lexer):
+    """
+    Describe ``lexer`` in a way that is stable across runs, for use in cache keys.
+    ``None`` stands for a lexer that is guessed from the contents of a file.
+    """
+    name = "guessed" if lexer is None else type(lexer).__name__
+    return f"{name} (Pygments {pygments.__version__})"
+
+
+#: Cache used to store fingerprints across runs, ``None`` to disable caching
+fingerprint_cache = None
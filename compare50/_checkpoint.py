@@ -0,0 +1,202 @@
+"""
+Checkpoints of the phases of a run, kept in its output directory, such that a run that fails
+or is interrupted can be resumed (``--resume``) without redoing the phases, and the pairs,
+that it completed.
+
+Submissions are checkpointed as their paths and files, everything else is pickled with
+references to these submissions (and their files) in place of the submissions themselves,
+as submissions (and their ids) are created again by the run that resumes.
+"""
+import io
+import json
+import pathlib
+import pickle
+import shutil
+
+from . import _api
+from ._data import File, Submission
+from ._incremental import STATE_DIR, _write
+
+#: Directory within the output directory in which the checkpoints are kept
+CHECKPOINT_DIR = pathlib.Path(STATE_DIR) / "checkpoint"
+
+
+class Checkpoint:
+    """
+    :param dest: the output directory, or ``None`` to not checkpoint anything
+    :type dest: str or pathlib.Path
+    :param settings: everything that determines the outcome of the run (e.g. its arguments), \
+            a run can only be resumed with the same settings
+    :type settings: dict
+
+    :ivar submissions: every submission of the run, which can then be referred to by checkpoints
+    """
+    #: Number of pairs compared between checkpoints
+    BATCH_SIZE = 1000
+
+    def __init__(self, dest, settings):
+        self.path = None if dest is None else pathlib.Path(dest) / CHECKPOINT_DIR
+        self.settings = settings
+        self.submissions = []
+
+    def exists(self):
+        """Whether there is a run to resume."""
+        return self.path is not None and (self.path / "settings.json").is_file()
+
+    def start(self):
+        """Start checkpointing a new run."""
+        if self.path is None:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        _write(self.path / "settings.json", json.dumps(self.settings).encode())
+
+    def resume(self):
+        """Resume the run that was checkpointed, which must have had the same settings."""
+        with open(self.path / "settings.json") as f:
+            settings = json.load(f)
+        if settings != self.settings:
+            raise _api.Error("Cannot resume the run in {}, as it was started with other arguments"
+                             .format(self.path.parent.parent))
+
+    def remove(self):
+        """Remove all checkpoints, once the run is done."""
+        if self.path is None:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        try:
+            self.path.parent.rmdir()
+        except OSError:
+            pass
+
+    def inventory(self, get, preprocessor, lexers=None):
+        """
+        The submissions, archive submissions, and distro submissions of the run. These are
+        recreated with ``preprocessor`` and ``lexers`` from their checkpoint, or otherwise
+        returned by ``get``.
+        """
+        if self.path is None:
+            return get()
+
+        try:
+            with open(self.path / "inventory.json") as f:
+                inventory = json.load(f)
+        except FileNotFoundError:
+            inventory = None
+
+        if inventory is not None:
+            return tuple([Submission(sub["path"], sub["files"],
+                                     large_files=sub["large_files"],
+                                     undecodable_files=sub["undecodable_files"],
+                                     preprocessor=preprocessor,
+                                     is_archive=sub["is_archive"],
+                                     lexers=lexers or {})
+                          for sub in subs] for subs in inventory)
+
+        subs = get()
+        inventory = [[{"path": str(sub.path),
+                       "files": [str(f.name) for f in sub.files],
+                       "large_files": [str(f) for f in sub.large_files],
+                       "undecodable_files": [str(f) for f in sub.undecodable_files],
+                       "is_archive": sub.is_archive}
+                      for sub in s] for s in subs]
+        _write(self.path / "inventory.json", json.dumps(inventory).encode())
+        return subs
+
+    def scores(self, get):
+        """The scores of the run, from their checkpoint, or otherwise returned by ``get``."""
+        return self._checkpointed("scores", get)
+
+    def compare(self, scores, ignored_files, pass_):
+        """
+        :func:`compare50.compare`, in batches of ``BATCH_SIZE`` pairs. The results of every batch
+        are checkpointed, and batches of which the results are checkpointed are not compared again.
+        """
+        if self.path is None:
+            return _api.compare(scores, ignored_files, pass_)
+
+        results = []
+        for i in range(0, len(scores), self.BATCH_SIZE):
+            batch = scores[i:i + self.BATCH_SIZE]
+            results += self._checkpointed(f"{pass_.__name__}_{i // self.BATCH_SIZE}",
+                                          lambda: _api.compare(batch, ignored_files, pass_))
+        return results
+
+    def pages(self):
+        """
+        The (id, max_id) of every match page that is rendered, by submission pair, to pass
+        to :func:`compare50._renderer.render`. ``None`` if the run is not checkpointed.
+        """
+        if self.path is None:
+            return None
+        return _Pages(self.path / "pages", self.submissions)
+
+    def _checkpointed(self, name, get):
+        if self.path is None:
+            return get()
+
+        path = self.path / f"{name}.pickle"
+        try:
+            with open(path, "rb") as f:
+                return _Unpickler(f, self.submissions).load()
+        except FileNotFoundError:
+            pass
+
+        obj = get()
+        f = io.BytesIO()
+        _Pickler(f, self.submissions).dump(obj)
+        _write(path, f.getvalue())
+        return obj
+
+
+class _Pages(dict):
+    """Pages by submission pair, of which every page that is set is logged to ``path``."""
+
+    def __init__(self, path, submissions):
+        super().__init__()
+        self.path = path
+        self._positions = {sub: i for i, sub in enumerate(submissions)}
+
+        try:
+            with open(path) as f:
+                for line in f:
+                    # The last line is incomplete if the run stopped while logging it
+                    try:
+                        pos_a, pos_b, id, max_id = json.loads(line)
+                    except ValueError:
+                        break
+                    super().__setitem__((submissions[pos_a], submissions[pos_b]), (id, max_id))
+        except FileNotFoundError:
+            pass
+
+    def __setitem__(self, pair, page):
+        super().__setitem__(pair, page)
+        with open(self.path, "a") as f:
+            f.write(json.dumps([self._positions[pair[0]], self._positions[pair[1]], *page]) + "\n")
+
+
+class _Pickler(pickle.Pickler):
+    """Pickles submissions and files as their position in ``submissions``."""
+
+    def __init__(self, file, submissions):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._positions = {}
+        for i, sub in enumerate(submissions):
+            self._positions[sub] = ("submission", i)
+            for j, file in enumerate(sub.files):
+                self._positions[file] = ("file", i, j)
+
+    def persistent_id(self, obj):
+        if isinstance(obj, (Submission, File)):
+            return self._positions[obj]
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, submissions):
+        super().__init__(file)
+        self._submissions = submissions
+
+    def persistent_load(self, pid):
+        if pid[0] == "submission":
+            return self._submissions[pid[1]]
+        return self._submissions[pid[1]].files[pid[2]]
@@ -1,16 +1,22 @@
 import abc
 from collections.abc import Mapping, Sequence
+import hashlib
+import heapq
 import os
 import pathlib
 import numbers
+import time
 
 import attr
+import numpy as np
 import pygments
 import pygments.lexers
+import pygments.lexers.special
+import pygments.token
 
 
 __all__ = ["Pass", "Comparator", "File", "Submission",
-           "Pass", "Span", "Score", "Comparison", "Token"]
+           "Pass", "Span", "Score", "Comparison", "Token", "Tokens"]
 
 
 class _PassRegistry(abc.ABCMeta):
@@ -73,10 +79,20 @@ class Comparator(metaclass=abc.ABCMeta):
         """
         Given a list of scores and a list of distro files, perform an in-depth
         comparison of each submission pair and return a corresponding list of
-        :class:`compare50.Comparison`\ s
+        :class:`compare50.Comparison`\ s. The ignored spans of a file should be
+        the same in every comparison that it is part of.
         """
         pass
 
+    def top_scores(self, submissions, archive_submissions, ignored_files, n):
+        """
+        Given a list of submissions, a list of archive submissions, a set of distro files
+        and a number ``n``, return the ``n`` highest :class:`compare50.Score`\ s in descending
+        order. Comparators may override this to avoid creating a
+        :class:`compare50.Score` for every submission pair.
+        """
+        return heapq.nlargest(n, self.score(submissions, archive_submissions, ignored_files))
+
 
 class IdStore(Mapping):
     """
@@ -118,6 +134,8 @@ class Submission:
     :ivar files: list of :class:`compare50.File` objects contained in the submission
     :ivar preprocessor: A function from tokens to tokens that will be run on \
             each file in the submission
+    :ivar lexers: names of Pygments lexers by file extension, or by file name for files \
+            without one, to lex the files of the submission with rather than the lexers Pygments picks
     :ivar id: integer that uniquely identifies this submission \
             (submissions with the same path will always have the same id).
 
@@ -132,6 +150,7 @@ class Submission:
     undecodable_files = attr.ib(factory=tuple, converter=_to_path_tuple, cmp=False, repr=False)
     preprocessor = attr.ib(default=lambda tokens: tokens, cmp=False, repr=False)
     is_archive = attr.ib(default=False, cmp=False)
+    lexers = attr.ib(factory=dict, cmp=False, repr=False)
     id = attr.ib(init=False)
 
 
@@ -160,7 +179,16 @@ class File:
 
     Represents a single file from a submission.
     """
+    # Lexers that Pygments picks by file extension, or by file name for files without one
     _lexer_cache = {}
+    # Lexers by name, see Submission.lexers
+    _lexers_by_name = {}
+    # Lexers guessed from the contents of files, by the digest of their contents
+    _guessed_lexers = {}
+    # Cache of unprocessed tokens, see compare50._cache.cache_tokens
+    _token_cache = None
+    # Cache of the text of files read before they are lexed, see compare50._cache.cache_texts
+    _text_cache = None
     _store = IdStore(key=lambda file: file.path)
 
     name = attr.ib(converter=pathlib.Path, cmp=False)
@@ -174,66 +202,199 @@ class File:
 
     def read(self, size=-1):
         """Open file, read ``size`` bytes from it, then close it."""
-        with open(self.path) as f:
-            return f.read(size)
+        return _read(self.path, size)
+
+    def tokens(self, columnar=False):
+        """
+        Returns the preprpocessed tokens of the file. As a list of :class:`compare50.Token`\ s,
+        or as :class:`compare50.Tokens` if ``columnar``.
+        """
+        return self._preprocess(self.unprocessed_tokens(columnar=True), columnar=columnar)
 
-    def tokens(self):
-        """Returns the preprpocessed tokens of the file."""
-        return list(self.submission.preprocessor(self.unprocessed_tokens()))
+    def _preprocess(self, tokens, columnar=False):
+        """
+        Run the preprocessor of the submission on ``tokens``. Only a
+        :class:`compare50._data.Preprocessor` is handed :class:`compare50.Tokens`,
+        any other preprocessor gets a list of :class:`compare50.Token`\ s.
+        """
+        preprocessor = self.submission.preprocessor
+        if not isinstance(preprocessor, Preprocessor) and isinstance(tokens, Tokens):
+            tokens = list(tokens)
+        tokens = preprocessor(tokens)
+        return Tokens.from_tokens(tokens) if columnar else list(tokens)
 
-    def lexer(self):
-        """Determine which Pygments lexer should be used."""
-        ext = self.name.suffix
+    def lexer(self, text=None):
+        """
+        Determine which Pygments lexer should be used. ``text``, the contents of the file,
+        may optionally be specified to avoid reading the file again.
+        """
+        lexer = self._lexer_for_name()
+        if lexer is not None:
+            return lexer
+
+        if text is None:
+            text = self.read()
         try:
-            return self._lexer_cache[ext]
+            return self._guessed_lexers[_digest(text)]
+        except KeyError:
+            lexer, _ = _guess_lexer(text)
+            self._guessed_lexers[_digest(text)] = lexer
+            return lexer
+
+    def _lexer_for_name(self):
+        """The lexer for the name of this file, or ``None`` if it has to be guessed from its contents."""
+        key = self.name.suffix or self.name.name
+        try:
+            name = self.submission.lexers[key]
+        except KeyError:
+            pass
+        else:
+            # Lexers are passed by name, as they do not survive pickling to workers that are not forked
+            try:
+                return self._lexers_by_name[name]
+            except KeyError:
+                lexer = self._lexers_by_name[name] = pygments.lexers.get_lexer_by_name(name)
+                return lexer
+
+        try:
+            return self._lexer_cache[key]
         except KeyError:
             pass
 
-        # get lexer for this file type
         try:
             lexer = pygments.lexers.get_lexer_for_filename(self.name.name)
-            self._lexer_cache[ext] = lexer
-            return lexer
         except pygments.util.ClassNotFound:
-            try:
-                return pygments.lexers.guess_lexer(self.read())
-            except pygments.util.ClassNotFound:
-                return pygments.lexers.special.TextLexer()
+            return None
+        self._lexer_cache[key] = lexer
+        return lexer
 
     @classmethod
     def get(cls, id):
         """Find File with given id"""
         return cls._store.objects[id]
 
-    def unprocessed_tokens(self):
-        """Get the raw tokens of the file."""
+    def unprocessed_tokens(self, columnar=False):
+        """
+        Get the raw tokens of the file. As a list of :class:`compare50.Token`\ s,
+        or as :class:`compare50.Tokens` if ``columnar``.
+        """
+        if self._token_cache is None:
+            tokens = self._lex()
+        else:
+            tokens = self._token_cache.get(self)
+            if tokens is None:
+                tokens = self._lex()
+                self._token_cache.put(self, tokens)
+        return tokens if columnar else list(tokens)
+
+    def _lex(self):
+        """Run the lexer on the file, returns its :class:`compare50.Tokens`."""
         text = self.read()
-        lexer_tokens = self.lexer().get_tokens_unprocessed(text)
-        tokens = []
-        prevToken = None
-        for token in lexer_tokens:
-            if prevToken:
-                tokens.append(Token(start=prevToken[0], end=token[0],
-                                    type=prevToken[1], val=prevToken[2]))
-
-            prevToken = token
-
-        if prevToken:
-            tokens.append(Token(start=prevToken[0], end=len(text),
-                                type=prevToken[1], val=prevToken[2]))
-        return tokens
+        types = {}
+        values = {}
+        starts = []
+        type_ids = []
+        value_ids = []
+        for start, type, value in self.lexer(text).get_tokens_unprocessed(text):
+            starts.append(start)
+            type_ids.append(types.setdefault(type, len(types)))
+            value_ids.append(values.setdefault(value, len(values)))
+
+        # Every token ends where the next one starts, the last one at the end of the file
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.append(starts[1:], len(text)) if len(starts) else np.zeros(0, dtype=np.int64)
+        return Tokens(starts, ends,
+                      np.array(type_ids, dtype=np.int32), list(types),
+                      np.array(value_ids, dtype=np.int32), list(values))
+
+
+def _read(path, size=-1):
+    """Read ``size`` characters from the file at ``path``, unless its text is cached."""
+    text = None if File._text_cache is None else File._text_cache.get(path)
+    if text is not None:
+        return text if size < 0 else text[:size]
+    with open(path) as f:
+        return f.read(size)
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def _guess_lexer(text):
+    """Guess the lexer of ``text`` from its contents, returns the lexer and the time it took in seconds."""
+    start = time.perf_counter()
+    if not text.strip():
+        lexer = pygments.lexers.special.TextLexer()
+    else:
+        try:
+            lexer = pygments.lexers.guess_lexer(text)
+        except pygments.util.ClassNotFound:
+            lexer = pygments.lexers.special.TextLexer()
+    return lexer, time.perf_counter() - start
 
 
 @attr.s(slots=True)
 class Preprocessor:
-    """Hack to ensure that composed preprocessor is serializable by Pickle."""
+    """
+    Hack to ensure that composed preprocessor is serializable by Pickle.
+
+    Given :class:`compare50.Tokens`, the preprocessors are fused: a run of preprocessors
+    that handle every token on their own (those with a ``map_token``) maps every distinct
+    (type, value) pair once, preprocessors with a ``columnar`` implementation operate on
+    the arrays, and any other preprocessor gets a stream of :class:`compare50.Token`\ s.
+    """
     preprocessors = attr.ib()
 
     def __call__(self, tokens):
+        if not isinstance(tokens, Tokens):
+            for preprocessor in self.preprocessors:
+                tokens = preprocessor(tokens)
+            return tokens
+
+        map_tokens = []
         for preprocessor in self.preprocessors:
-            tokens = preprocessor(tokens)
+            if not isinstance(tokens, Tokens):
+                tokens = preprocessor(tokens)
+            elif hasattr(preprocessor, "map_token"):
+                map_tokens.append(preprocessor.map_token)
+            else:
+                tokens = _map_tokens(tokens, map_tokens)
+                map_tokens = []
+                if hasattr(preprocessor, "columnar"):
+                    tokens = preprocessor.columnar(tokens)
+                else:
+                    tokens = preprocessor(list(tokens))
+        return _map_tokens(tokens, map_tokens)
+
+
+def _map_tokens(tokens, map_tokens):
+    """
+    Run the ``map_token``\ s of a run of preprocessors, one after the other, once for every
+    distinct (type, value) pair of ``tokens`` rather than once for every token.
+    """
+    if not map_tokens:
         return tokens
 
+    n_values = max(len(tokens.value_table), 1)
+    pairs, inverse = np.unique(tokens.types.astype(np.int64) * n_values + tokens.values, return_inverse=True)
+
+    value_table = {}
+    mapped = []
+    for pair in pairs.tolist():
+        type = tokens.type_table[pair // n_values]
+        val = tokens.value_table[pair % n_values]
+        for map_token in map_tokens:
+            val = map_token(type, val)
+            if val is None:
+                break
+        mapped.append(-1 if val is None else value_table.setdefault(val, len(value_table)))
+
+    values = np.array(mapped, dtype=np.int32)[inverse]
+    kept = values >= 0
+    return Tokens(tokens.starts[kept], tokens.ends[kept], tokens.types[kept], tokens.type_table,
+                  values[kept], list(value_table))
+
 
 @attr.s(slots=True, frozen=True, repr=False)
 class Span:
@@ -379,6 +540,106 @@ class Token:
         return self.val == other.val and self.type == other.type
 
 
+class Tokens(Sequence):
+    """
+    :ivar starts: array of the character index of the beginning of every token
+    :ivar ends: array of the character index one past the end of every token
+    :ivar types: array of the Pygments token type of every token, as an index into ``type_table``
+    :ivar type_table: list of Pygments token types
+    :ivar values: array of the string contents of every token, as an index into ``value_table``
+    :ivar value_table: list of strings
+
+    A columnar stream of tokens. It takes far less memory than a list of
+    :class:`compare50.Token`\ s and is quick to pickle, and preprocessors and indices can
+    operate on its arrays in bulk. Indexing and iterating produce :class:`compare50.Token`\ s,
+    which are new every time, such that preprocessors that operate on Token streams
+    may alter them. The arrays are never altered once they are created.
+    """
+    __slots__ = ["starts", "ends", "types", "type_table", "values", "value_table"]
+
+    def __init__(self, starts, ends, types, type_table, values, value_table):
+        self.starts = starts
+        self.ends = ends
+        self.types = types
+        self.type_table = type_table
+        self.values = values
+        self.value_table = value_table
+        for array in (starts, ends, types, values):
+            array.flags.writeable = False
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """Create Tokens from an iterable of :class:`compare50.Token`\ s (or return ``tokens`` if it is Tokens)."""
+        if isinstance(tokens, Tokens):
+            return tokens
+
+        tokens = list(tokens)
+        types = {}
+        values = {}
+        return cls(np.fromiter((tok.start for tok in tokens), dtype=np.int64, count=len(tokens)),
+                   np.fromiter((tok.end for tok in tokens), dtype=np.int64, count=len(tokens)),
+                   np.fromiter((types.setdefault(tok.type, len(types)) for tok in tokens),
+                               dtype=np.int32, count=len(tokens)),
+                   list(types),
+                   np.fromiter((values.setdefault(tok.val, len(values)) for tok in tokens),
+                               dtype=np.int32, count=len(tokens)),
+                   list(values))
+
+    def mask(self, ttype):
+        """Boolean array that is ``True`` for every token whose type is in ``ttype``."""
+        return np.array([type in ttype for type in self.type_table], dtype=bool)[self.types] \
+            if self.type_table else np.zeros(len(self), dtype=bool)
+
+    def select(self, selection):
+        """The tokens at ``selection``, a boolean mask or an array of indices."""
+        return Tokens(self.starts[selection], self.ends[selection], self.types[selection], self.type_table,
+                      self.values[selection], self.value_table)
+
+    def replace_values(self, mask, value):
+        """Replace the value of every token in ``mask`` by ``value``."""
+        value_table = self.value_table
+        try:
+            value_id = value_table.index(value)
+        except ValueError:
+            value_table = value_table + [value]
+            value_id = len(value_table) - 1
+        return Tokens(self.starts, self.ends, self.types, self.type_table,
+                      np.where(mask, value_id, self.values).astype(np.int32), value_table)
+
+    def vals(self):
+        """The values of all tokens, as a list of strings."""
+        value_table = self.value_table
+        return [value_table[value] for value in self.values.tolist()]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.select(index)
+        return Token(start=int(self.starts[index]), end=int(self.ends[index]),
+                     type=self.type_table[self.types[index]], val=self.value_table[self.values[index]])
+
+    def __iter__(self):
+        type_table, value_table = self.type_table, self.value_table
+        for start, end, type, value in zip(self.starts.tolist(), self.ends.tolist(),
+                                           self.types.tolist(), self.values.tolist()):
+            yield Token(start=start, end=end, type=type_table[type], val=value_table[value])
+
+    def __reduce__(self):
+        # Pygments compares token types by identity, so pickle them by name
+        return (_unpickle_tokens, (self.starts, self.ends, self.types, [str(type) for type in self.type_table],
+                                   self.values, self.value_table))
+
+    def __repr__(self):
+        return "Tokens({})".format(list(self))
+
+
+def _unpickle_tokens(starts, ends, types, type_names, values, value_table):
+    return Tokens(starts, ends, types, [pygments.token.string_to_tokentype(name) for name in type_names],
+                  values, value_table)
+
+
 class BisectList(Sequence):
     """
     A sorted list allowing for easy binary seaching. This exists because Python's
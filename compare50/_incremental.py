@@ -0,0 +1,147 @@
+"""
+The state of an incremental run, kept in its output directory such that a later run can
+compare only new submissions against the submissions that were compared before.
+
+The state consists of the index of every submission scored so far (an archive index, see
+:meth:`compare50.comparators.Winnowing.load_archive`), which also holds the frequencies of
+every fingerprint, the top scores and the match page of each of them, and the contents of
+every match page, such that a page only has to be written again if its position changed.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+
+import attr
+
+from . import _api
+from ._data import Score
+
+#: Directory within the output directory in which the state is kept
+STATE_DIR = ".compare50"
+
+#: Bump whenever the format of the state changes
+VERSION = 1
+
+
+class _Contents(dict):
+    """The contents of the match page of every pair, read from ``path`` as they are needed."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = pathlib.Path(path)
+        self.changed = set()
+
+    def __setitem__(self, pair, content):
+        super().__setitem__(pair, content)
+        self.changed.add(pair)
+
+    def __missing__(self, pair):
+        with open(self.path / _name(pair), "rb") as f:
+            content = pickle.load(f)
+        super().__setitem__(pair, content)
+        return content
+
+
+@attr.s(slots=True)
+class State:
+    """
+    :ivar dest: the output directory
+    :ivar passes: the names of the passes that were run
+    :ivar distro: the paths of the distro files
+    :ivar scores: the top scores so far
+    :ivar pages: the (id, max_id) of the match page of every pair in ``scores``
+    :ivar contents: the contents of the match page of every pair in ``scores``
+    """
+    dest = attr.ib(converter=pathlib.Path)
+    passes = attr.ib()
+    distro = attr.ib()
+    scores = attr.ib(factory=list)
+    pages = attr.ib(factory=dict)
+    contents = attr.ib(default=attr.Factory(lambda self: _Contents(self.dest / STATE_DIR / "pages"),
+                                            takes_self=True))
+
+
+def exists(dest):
+    """Whether ``dest`` holds the state of an incremental run."""
+    return (pathlib.Path(dest) / STATE_DIR / "results.json").is_file()
+
+
+def index_path(dest):
+    """Path of the index of every submission scored so far."""
+    return pathlib.Path(dest) / STATE_DIR / "index"
+
+
+def load(dest, submissions):
+    """
+    Load the state of an incremental run in ``dest``,
+    of which ``submissions`` are the submissions loaded from its index.
+    """
+    with open(pathlib.Path(dest) / STATE_DIR / "results.json") as f:
+        results = json.load(f)
+
+    if results["version"] != VERSION:
+        raise _api.Error(f"{dest} was written by a different version of compare50, it cannot be added to")
+
+    path_to_sub = {str(sub.path): sub for sub in submissions}
+    state = State(dest, results["passes"], results["distro"])
+    for pair in results["pairs"]:
+        score = Score(path_to_sub[pair["sub_a"]], path_to_sub[pair["sub_b"]], pair["score"])
+        state.scores.append(score)
+        state.pages[(score.sub_a, score.sub_b)] = (pair["id"], pair["max_id"])
+    return state
+
+
+def save(state):
+    """
+    Save ``state``, after rendering its scores. The index is written while scoring instead
+    (see :attr:`compare50.comparators.Winnowing.index_path`).
+    """
+    path = state.dest / STATE_DIR
+    (path / "pages").mkdir(parents=True, exist_ok=True)
+
+    for pair in state.contents.changed:
+        _write(path / "pages" / _name(pair), pickle.dumps(state.contents[pair]))
+    state.contents.changed.clear()
+
+    # Pages of pairs that dropped out of the top scores are not needed anymore
+    names = {_name((score.sub_a, score.sub_b)) for score in state.scores}
+    for page in (path / "pages").iterdir():
+        if page.name not in names:
+            os.remove(page)
+
+    results = {
+        "version": VERSION,
+        "passes": state.passes,
+        "distro": state.distro,
+        "pairs": [{"sub_a": _path(score.sub_a),
+                   "sub_b": _path(score.sub_b),
+                   "score": float(score.score),
+                   "id": state.pages[(score.sub_a, score.sub_b)][0],
+                   "max_id": state.pages[(score.sub_a, score.sub_b)][1]}
+                  for score in state.scores]
+    }
+    _write(path / "results.json", json.dumps(results).encode())
+
+
+def _path(sub):
+    # The index stores resolved paths, as these do not depend on the working directory
+    return str(sub.path.resolve())
+
+
+def _name(pair):
+    return hashlib.blake2b("\0".join(map(_path, pair)).encode(), digest_size=16).hexdigest()
+
+
+def _write(path, data):
+    """Atomically write ``data`` to ``path``."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -11,7 +11,7 @@ import pygments
 from pygments.formatters import HtmlFormatter
 
 from .. import _api
-from .._data import IdStore
+from .._data import IdStore, Pass
 
 STATIC = pathlib.Path(pkg_resources.resource_filename("compare50._renderer", "static"))
 TEMPLATES = pathlib.Path(pkg_resources.resource_filename("compare50._renderer", "templates"))
@@ -68,7 +68,17 @@ class HTMLSubmission:
             return 0
 
 
-def render(pass_to_results, dest):
+def render(pass_to_results, dest, scores=None, contents=None, pages=None):
+    """
+    Render the results of every pass to ``dest``, one match page per submission pair.
+
+    To render incrementally, ``scores`` ranks every submission pair, including pairs that have
+    no results in ``pass_to_results`` because an earlier run rendered them. ``contents`` maps
+    (sub_a, sub_b) of every such pair to the contents of its match page, and is filled in for
+    every pair that is rendered. ``pages`` maps (sub_a, sub_b) to the (id, max_id) of the match
+    page of the pair that is in ``dest``, such that pages that did not change are not written
+    again. It is updated as pages are written, such that it can also be used to resume rendering.
+    """
     bar = _api.get_progress_bar()
     dest = pathlib.Path(dest)
 
@@ -77,21 +87,47 @@ def render(pass_to_results, dest):
         for result in results:
             sub_pair_to_results[(result.sub_a, result.sub_b)].append(result)
 
-    bar.reset(total=len(sub_pair_to_results) + 1)
-    # Sort by score
-    results_per_sub_pair = sorted(sub_pair_to_results.values(),
-                                  key=lambda res: res[0].score, reverse=True)
+    if scores is None:
+        # Sort by score
+        scores = [results[0].score for results in sorted(sub_pair_to_results.values(),
+                                                         key=lambda res: res[0].score, reverse=True)]
+    else:
+        scores = sorted(scores, key=lambda score: score.score, reverse=True)
+
+    bar.reset(total=len(scores) + 1)
 
     common_css = [read_file(STATIC / f) for f in  ("bootstrap.min.css", "fonts.css")]
     match_css = common_css + [read_file(STATIC / "match.css")]
     match_js = [read_file(STATIC / f) for f in ("split.min.js", "match.js")]
     # Render all matches
+    max_id = len(scores)
+    tasks = []
+    for id, score in enumerate(scores, 1):
+        # Pages of pairs rendered before only change with their position
+        pair = (score.sub_a, score.sub_b)
+        if pages is not None and pages.get(pair) == (id, max_id):
+            bar.update()
+            continue
+
+        results = sub_pair_to_results.get(pair)
+        if results:
+            tasks.append((id, results))
+            continue
+
+        with open(dest / f"match_{id}.html", "w") as f:
+            f.write(_render_page(id, max_id, contents[pair], match_js, match_css))
+        pages[pair] = (id, max_id)
+        bar.update()
+
     with _api.Executor() as executor:
-        # Load static files
-        max_id = len(results_per_sub_pair)
-        for id, html in executor.map(_RenderTask(dest, max_id, match_js, match_css), enumerate(results_per_sub_pair, 1)):
+        for id, html, content in executor.map(_RenderTask(dest, max_id, match_js, match_css), tasks):
             with open(dest / f"match_{id}.html", "w") as f:
                 f.write(html)
+            pair = (scores[id - 1].sub_a, scores[id - 1].sub_b)
+            if contents is not None:
+                contents[pair] = content
+            if pages is not None:
+                pages[pair] = (id, max_id)
             bar.update()
 
 
@@ -100,21 +136,18 @@ def render(pass_to_results, dest):
         index_template = jinja2.Template(
             f.read(), autoescape=jinja2.select_autoescape(enabled_extensions=("html",)))
 
-    ranking_pass, ranking_results = next(iter(pass_to_results.items()))
-
-
     try:
-        max_score = max((result.score.score for result in ranking_results))
+        max_score = max((score.score for score in scores))
     except ValueError:
         max_score = 0
 
     # Generate cluster data
     subs = set()
     graph_info = {"nodes": [], "links": [], "data": {}}
-    for i, result in enumerate(ranking_results):
-        graph_info["links"].append({"index":i, "source": str(result.sub_a.path), "target": str(result.sub_b.path), "value": 10 * result.score.score/max_score})
-        subs.add(result.sub_a)
-        subs.add(result.sub_b)
+    for i, score in enumerate(scores):
+        graph_info["links"].append({"index":i, "source": str(score.sub_a.path), "target": str(score.sub_b.path), "value": 10 * score.score/max_score})
+        subs.add(score.sub_a)
+        subs.add(score.sub_b)
 
     for sub in subs:
         graph_info["nodes"].append({"id": str(sub.path)})
@@ -146,6 +179,20 @@ def read_file(fname):
         return f.read()
 
 
+def _render_page(id, max_id, content, js, css):
+    """
+    Render a match page, given its contents: the names of the passes,
+    the rendered matches, and the data of every pass.
+    """
+    pass_names, match_htmls, data = content
+    page_content = read_file(TEMPLATES / "match_page.html")
+    page_template = jinja2.Template(
+        page_content, autoescape=jinja2.select_autoescape(enabled_extensions=("html",)))
+    return page_template.render(id=id, max_id=max_id,
+                                passes=[Pass._get(name) for name in pass_names], matches=match_htmls,
+                                data=data, js=js, css=css)
+
+
 class _RenderTask:
     def __init__(self, dest, max_id, js, css):
         dest.mkdir(exist_ok=True)
@@ -188,17 +235,9 @@ class _RenderTask:
             match_html = match_template.render(name=result.name, sub_a=sub_a, sub_b=sub_b)
             match_htmls.append(match_html)
 
-        passes = [result.pass_ for result in results]
-
-        page_content = read_file(TEMPLATES / "match_page.html")
-        page_template = jinja2.Template(
-            page_content, autoescape=jinja2.select_autoescape(enabled_extensions=("html",)))
-        page_html = page_template.render(id=id, max_id=self.max_id,
-                                         passes=passes, matches=match_htmls,
-                                         data=[attr.asdict(datum) for datum in data],
-                                         js=self.js, css=self.css)
-
-        return id, page_html
+        content = ([result.pass_.__name__ for result in results], match_htmls,
+                   [attr.asdict(datum) for datum in data])
+        return id, _render_page(id, self.max_id, content, self.js, self.css), content
 
     @staticmethod
     def _prepare_dest(dest):
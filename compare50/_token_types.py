@@ -0,0 +1,38 @@
+"""
+A registry of Pygments token types. Every token type gets a bitset of the categories compare50
+classifies tokens by, as it is first seen. Classifying a token is then a lookup, rather than a
+walk up the hierarchy of token types::
+
+    if categories[tok.type] & NAME:
+        ...
+"""
+import numpy as np
+from pygments.token import Comment, Keyword, Name, Number, String, Text
+
+TEXT, COMMENT, NAME, KEYWORD_TYPE, STRING, NUMBER, INTEGER, FLOAT = (1 << i for i in range(8))
+
+#: The token type of every category, a token type is in a category if it is (a subtype of) it
+CATEGORIES = {TEXT: Text,
+              COMMENT: Comment,
+              NAME: Name,
+              KEYWORD_TYPE: Keyword.Type,
+              STRING: String,
+              NUMBER: Number,
+              INTEGER: Number.Integer,
+              FLOAT: Number.Float}
+
+
+class _Categories(dict):
+    def __missing__(self, type):
+        bitset = self[type] = sum(bit for bit, category in CATEGORIES.items() if type in category)
+        return bitset
+
+
+#: The bitset of the categories of every token type
+categories = _Categories()
+
+
+def members(type_table, category):
+    """Boolean array that is ``True`` for every token type in ``type_table`` that is in ``category``."""
+    return np.fromiter((categories[type] & category for type in type_table),
+                       dtype=np.int64, count=len(type_table)).astype(bool)
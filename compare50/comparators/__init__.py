@@ -1,2 +1,3 @@
 from ._winnowing import Winnowing
 from ._misspellings import Misspellings
+from ._suffix_array import SuffixArray
@@ -1,11 +1,12 @@
 import collections
 import contextlib
+import heapq
 import itertools
 import pathlib
 import re
 
 import attr
-from pygments.token import Comment
+import numpy as np
 
 from .. import Comparator, Span, Comparison, Score
 
@@ -17,27 +18,33 @@ class Misspellings(Comparator):
 
     def _misspelled(self, *files):
         """Returns a set containing all of the words in each file that are not in the dictionary"""
-        return set().union(*({tok.val for tok in file.tokens() if tok.val not in self.dictionary} for file in files))
+        return set().union(*({word for word in _words(file) if word not in self.dictionary} for file in files))
 
     def score(self, submissions, archive_submissions, ignored_files):
         """Number of identically misspelled words."""
+        return list(self._scores(submissions, archive_submissions, ignored_files))
+
+    def top_scores(self, submissions, archive_submissions, ignored_files, n):
+        """The ``n`` highest scores, keeping no more than ``n`` scores in memory."""
+        return heapq.nlargest(n, self._scores(submissions, archive_submissions, ignored_files))
+
+    def _scores(self, submissions, archive_submissions, ignored_files):
+        """Lazily generate a score for each submission pair."""
         ignored_words = self._misspelled(*ignored_files)
 
         # Map each submission to its misspelled words
         sub_to_words = {sub: self._misspelled(*sub) - ignored_words for sub in submissions}
 
         # For each pair of submissions, assign a score based upon number of misspelled words
-        scores = [Score(sub_a, sub_b, _intersect_size(words_a, words_b))
-                    for (sub_a, words_a), (sub_b, words_b) in itertools.combinations(sub_to_words.items(), r=2)]
+        yield from (Score(sub_a, sub_b, _intersect_size(words_a, words_b))
+                    for (sub_a, words_a), (sub_b, words_b) in itertools.combinations(sub_to_words.items(), r=2))
 
         # Compare each archive submission against each regular submission
         for archive_sub in archive_submissions:
             # Find all misspelled words in archive
             archive_words = self._misspelled(*archive_sub) - ignored_words
-            scores.extend(Score(sub, archive_sub, _intersect_size(words, archive_words))
-                            for sub, words in sub_to_words.items())
-
-        return scores
+            yield from (Score(sub, archive_sub, _intersect_size(words, archive_words))
+                        for sub, words in sub_to_words.items())
 
     def compare(self, scores, ignored_files):
         ignored_words = self._misspelled(*ignored_files)
@@ -64,9 +71,10 @@ class Misspellings(Comparator):
         return comparisons
 
     def _spellcheck(self, file, ignored_words):
+        tokens = file.tokens(columnar=True)
         word_to_spans = collections.defaultdict(list)
-        for token in file.tokens():
-            word_to_spans[token.val].append(Span(file, token.start, token.end))
+        for start, end, value in zip(tokens.starts.tolist(), tokens.ends.tolist(), tokens.values.tolist()):
+            word_to_spans[tokens.value_table[value]].append(Span(file, start, end))
 
         result = SpellcheckResult()
 
@@ -95,6 +103,12 @@ class SpellcheckResult:
                 yield from itertools.product(self.misspelled[word], other.misspelled[word])
 
 
+def _words(file):
+    """The distinct values of the tokens of a file."""
+    tokens = file.tokens(columnar=True)
+    return [tokens.value_table[value] for value in np.unique(tokens.values).tolist()]
+
+
 def _intersect_size(a, b):
     """Equivalent to len(a & b) but more efficient"""
     if len(b) < len(a):
@@ -0,0 +1,284 @@
+import functools
+import itertools
+import os
+import pickle
+
+import attr
+import numpy as np
+
+from .. import _api, Comparator, Comparison, File, Span, Tokens
+from ._winnowing import CompareIndex, _split, _token_id, _ROLLING_BASE
+
+
+class SuffixArray(Comparator):
+    """
+    Comparator that finds every maximal run of tokens two submissions have in common,
+    by means of a suffix array of the tokens of both submissions. Unlike
+    :class:`Winnowing`, which matches fingerprints of k tokens and then expands them,
+    this finds the runs directly, and compares all files of a submission pair at once.
+    Scoring is left to another comparator, such that this can take over the comparison
+    of any pass, e.g. ``SuffixArray(25, scorer=Winnowing(k=25, t=35))``.
+
+    :param min_length: the minimum number of tokens in a run; shorter runs are ignored
+    :type min_length: int
+    :param scorer: the comparator that scores submissions
+    :type scorer: :class:`compare50.Comparator`
+    """
+
+    __slots__ = ["min_length", "scorer"]
+
+    def __init__(self, min_length, scorer):
+        if min_length < 1:
+            raise ValueError("min_length must be at least 1, not {}".format(min_length))
+        self.min_length = min_length
+        self.scorer = scorer
+
+    def score(self, submissions, archive_submissions, ignored_files):
+        """Scores of the scorer."""
+        return self.scorer.score(submissions, archive_submissions, ignored_files)
+
+    def top_scores(self, submissions, archive_submissions, ignored_files, n):
+        """The ``n`` highest scores of the scorer."""
+        return self.scorer.top_scores(submissions, archive_submissions, ignored_files, n)
+
+    def compare(self, scores, ignored_files):
+        bar = _api.get_progress_bar()
+        if not scores:
+            bar.reset(total=1)
+            return []
+
+        # Runs of at least min_length tokens that occur in ignored_files are ignored
+        ignored_index = CompareIndex(self.min_length)
+        for ignored_file in ignored_files:
+            ignored_index.include(ignored_file)
+
+        # Find all unique files
+        files = list({file: None for score in scores for sub in (score.sub_a, score.sub_b) for file in sub})
+        bar.reset(total=len(files) + len(scores))
+
+        n_batches = 4 * (os.cpu_count() or 1)
+
+        with _api.Executor() as executor:
+            # Tokenize every file once, in parallel. Its stretches of unignored tokens
+            # come back pickled, so that only the workers that compare the file unpickle them
+            file_cache = {}
+            ignored_spans = {}
+            for file, (cache, spans) in zip(files, executor.map(_unignored_tokens(ignored_index), files,
+                                                                chunksize=max(1, len(files) // n_batches))):
+                file_cache[file.id] = cache
+                ignored_spans[file] = [Span(file, start, end) for start, end in spans]
+                bar.update()
+
+            # Compare the submission pairs in batches, every batch is sent along with
+            # the tokens of just the files it needs
+            batches = _split(sorted(scores, key=lambda score: (score.sub_a.id, score.sub_b.id)), n_batches)
+            tasks = [(self.min_length,
+                      [([f.id for f in score.sub_a], [f.id for f in score.sub_b]) for score in batch],
+                      {f.id: file_cache[f.id] for score in batch for sub in (score.sub_a, score.sub_b) for f in sub})
+                     for batch in batches]
+
+            sub_match_to_span_matches = {}
+            for batch, results in zip(batches, executor.map(_compare_submissions, tasks)):
+                for score, span_matches in zip(batch, results):
+                    sub_match_to_span_matches[(score.sub_a, score.sub_b)] = span_matches
+                bar.update(len(batch))
+
+        comparisons = []
+        for score in scores:
+            span_matches = [(Span(File.get(file_a), start_a, end_a), Span(File.get(file_b), start_b, end_b))
+                            for file_a, start_a, end_a, file_b, start_b, end_b
+                            in sub_match_to_span_matches[(score.sub_a, score.sub_b)]]
+
+            sub_ignored_spans = set()
+            for file in itertools.chain(score.sub_a.files, score.sub_b.files):
+                sub_ignored_spans.update(ignored_spans[file])
+
+            comparisons.append(Comparison(score.sub_a, score.sub_b, span_matches, list(sub_ignored_spans)))
+
+        return comparisons
+
+
+@attr.s(slots=True)
+class _unignored_tokens:
+    """ "Function" that tokenizes a file, and returns its pickled stretches of unignored tokens
+    (see :func:`_encode`), and the spans (start, end) of the file that are ignored.
+    In the form of a class so that pickle can serialize it. """
+    ignored_index = attr.ib()
+
+    def __call__(self, file):
+        file_tokens = file.tokens()
+        token_lists = self.ignored_index.unignored_tokens(file, tokens=file_tokens)
+        ignored_spans = _api.missing_spans(file,
+                                           original_tokens=file_tokens,
+                                           processed_tokens=list(itertools.chain.from_iterable(token_lists)))
+        return (pickle.dumps([_encode(tokens) for tokens in token_lists if tokens]),
+                [(span.start, span.end) for span in ignored_spans])
+
+
+def _encode(tokens):
+    """
+    Encode tokens as arrays of their codes (identical across processes for identical tokens,
+    i.e. tokens of the same type and value), starts and ends.
+    """
+    tokens = Tokens.from_tokens(tokens)
+    # Identify every distinct value and type only once
+    values = np.fromiter((_token_id(val) for val in tokens.value_table), dtype=np.uint64,
+                         count=len(tokens.value_table))[tokens.values]
+    types = np.fromiter((_type_id(type) for type in tokens.type_table), dtype=np.uint64,
+                        count=len(tokens.type_table))[tokens.types]
+    with np.errstate(over="ignore"):
+        codes = values * np.uint64(_ROLLING_BASE) + types
+    return codes.view(np.int64), tokens.starts, tokens.ends
+
+
+@functools.lru_cache(maxsize=None)
+def _type_id(type):
+    return _token_id(str(type))
+
+
+def _compare_submissions(task):
+    """
+    Find the maximal matches of a batch of submission pairs (as lists of file ids), given
+    the minimum length of a match and a mapping from file ids to their (pickled) stretches of
+    unignored tokens. Returns the matching spans of every pair, as tuples of
+    (file_a, start_a, end_a, file_b, start_b, end_b) wherein files are ids.
+    """
+    min_length, pairs, pickled_stretches = task
+    stretches = {}
+    results = []
+    for files_a, files_b in pairs:
+        for file in itertools.chain(files_a, files_b):
+            if file not in stretches:
+                stretches[file] = pickle.loads(pickled_stretches[file])
+
+        results.append(_maximal_matches([(file,) + stretch for file in files_a for stretch in stretches[file]],
+                                        [(file,) + stretch for file in files_b for stretch in stretches[file]],
+                                        min_length))
+    return results
+
+
+def _maximal_matches(stretches_a, stretches_b, min_length):
+    """
+    Find every maximal run of at least ``min_length`` identical tokens that occurs in one of
+    ``stretches_a`` and in one of ``stretches_b``, both lists of (file id, codes, starts, ends)
+    tuples (see :func:`_encode`). A run is maximal if it can be extended neither left nor right,
+    without leaving its stretch or without the tokens becoming different. Returns the runs as
+    tuples of (file_a, start_a, end_a, file_b, start_b, end_b).
+
+    All stretches are laid out one after another, each preceded by a separator (a code that
+    occurs nowhere else), and their suffixes are sorted. Runs are then the pairs of positions,
+    one from either side, whose suffixes share at least ``min_length`` tokens (they are in the
+    same block of the suffix array) and which are preceded by different codes.
+    """
+    stretches = [stretch for stretch in itertools.chain(stretches_a, stretches_b) if len(stretch[1])]
+    if not stretches:
+        return []
+    lengths = np.array([len(codes) for _, codes, _, _ in stretches])
+    # Every stretch is preceded by a separator, and the last is followed by one
+    offsets = np.cumsum(lengths + 1) - lengths
+    n = int(offsets[-1] + lengths[-1] + 1)
+    positions = np.repeat(offsets - np.cumsum(np.append(0, lengths[:-1])), lengths) + np.arange(lengths.sum())
+
+    def layout(arrays, fill):
+        laid_out = np.full(n, fill, dtype=np.int64)
+        laid_out[positions] = np.concatenate(arrays)
+        return laid_out
+
+    # Codes become ranks among the codes of the tokens, separators follow those
+    codes = np.unique(np.concatenate([codes for _, codes, _, _ in stretches]), return_inverse=True)[1].ravel()
+    sequence = layout([codes], 0)
+    separators = np.append(offsets - 1, n - 1)
+    sequence[separators] = codes.max() + 1 + np.arange(len(separators))
+
+    files = layout([np.full(len(codes), file) for file, codes, _, _ in stretches], -1)
+    starts = layout([starts for _, _, starts, _ in stretches], 0)
+    ends = layout([ends for _, _, _, ends in stretches], 0)
+    sides = layout([np.zeros(sum(len(codes) for _, codes, _, _ in stretches_a), dtype=np.int64),
+                    np.ones(sum(len(codes) for _, codes, _, _ in stretches_b), dtype=np.int64)], -1)
+
+    suffix_array, ranks = _suffix_array(sequence)
+
+    # Blocks of consecutive suffixes that share their first min_length codes
+    shared = _common_prefix_lengths(ranks, suffix_array[:-1], suffix_array[1:])
+    blocks = np.append(0, np.cumsum(shared < min_length))
+
+    # The code before every suffix, as a rank among all codes (the first code is a separator)
+    preceding = np.append(0, ranks[0][:-1])[suffix_array]
+    keys = blocks * (n + 1) + preceding
+
+    sides = sides[suffix_array]
+    is_a, is_b = sides == 0, sides == 1
+    positions_a, keys_a, blocks_a = suffix_array[is_a], keys[is_a], blocks[is_a]
+    order_b = np.argsort(keys[is_b], kind="stable")
+    positions_b, keys_b = suffix_array[is_b][order_b], keys[is_b][order_b]
+
+    # Every suffix from a matches the suffixes from b in the same block, except for those
+    # preceded by the same code (those matches extend further left, and are thus not maximal)
+    block_starts = np.searchsorted(keys_b, blocks_a * (n + 1))
+    block_ends = np.searchsorted(keys_b, (blocks_a + 1) * (n + 1))
+    same_starts = np.searchsorted(keys_b, keys_a, side="left")
+    same_ends = np.searchsorted(keys_b, keys_a, side="right")
+    owners_left, indices_left = _ranges(block_starts, same_starts)
+    owners_right, indices_right = _ranges(same_ends, block_ends)
+    matches_a = positions_a[np.concatenate((owners_left, owners_right))]
+    matches_b = positions_b[np.concatenate((indices_left, indices_right))]
+
+    # The shared prefix of two suffixes is exactly as long as the run, ending it on the right
+    lengths = _common_prefix_lengths(ranks, matches_a, matches_b)
+    last_a, last_b = matches_a + lengths - 1, matches_b + lengths - 1
+
+    return list(zip(files[matches_a].tolist(), starts[matches_a].tolist(), ends[last_a].tolist(),
+                    files[matches_b].tolist(), starts[matches_b].tolist(), ends[last_b].tolist()))
+
+
+def _suffix_array(sequence):
+    """
+    Sort the suffixes of ``sequence`` (an array of integers, ending in one that occurs nowhere
+    else) by prefix doubling. Returns the suffix array, and for every doubling step i the rank of
+    the first 2^i codes of every suffix, such that two suffixes start with the same 2^i codes
+    if and only if their ranks are equal.
+    """
+    n = len(sequence)
+    rank = np.unique(sequence, return_inverse=True)[1].ravel().astype(np.int64)
+    ranks = [rank]
+    length = 1
+    while rank.max() < n - 1:
+        # Sort by the ranks of both halves of the first 2 * length codes
+        second = np.zeros(n, dtype=np.int64)
+        second[:n - length] = rank[length:] + 1
+        pair_keys = rank * (n + 1) + second
+        order = np.argsort(pair_keys, kind="stable")
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.append(0, np.cumsum(np.diff(pair_keys[order]) != 0))
+        ranks.append(rank)
+        length *= 2
+
+    suffix_array = np.empty(n, dtype=np.int64)
+    suffix_array[rank] = np.arange(n)
+    return suffix_array, ranks
+
+
+def _common_prefix_lengths(ranks, positions_a, positions_b):
+    """
+    The number of codes the suffixes at ``positions_a`` and ``positions_b`` have in common,
+    given the ranks of :func:`_suffix_array`, by comparing increasingly short powers of 2.
+    """
+    n = len(ranks[0])
+    lengths = np.zeros(len(positions_a), dtype=np.int64)
+    # The ranks of the last step are all distinct, so suffixes share fewer codes than that
+    for step in reversed(range(len(ranks) - 1)):
+        a = np.minimum(positions_a + lengths, n - 1)
+        b = np.minimum(positions_b + lengths, n - 1)
+        lengths += (ranks[step][a] == ranks[step][b]) * (1 << step)
+    return lengths
+
+
+def _ranges(starts, ends):
+    """
+    Enumerate the ranges ``starts[i]:ends[i]``. Returns an array with the range (``i``) of every
+    element, and an array of the elements.
+    """
+    sizes = np.maximum(ends - starts, 0)
+    owners = np.repeat(np.arange(len(sizes)), sizes)
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return owners, starts[owners] + offsets
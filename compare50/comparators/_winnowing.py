@@ -1,14 +1,19 @@
 import abc
-import collections
+import bisect
+import functools
+import hashlib
+import heapq
 import itertools
 import math
+import os
+import pickle
 import sys
 
 import attr
 import numpy as np
 
 
-from .. import _api, Comparison, Comparator, Submission, Span, Score
+from .. import _api, _archive, _cache, Comparison, Comparator, File, Submission, Span, Score, Tokens
 
 
 class Winnowing(Comparator):
@@ -18,126 +23,369 @@ class Winnowing(Comparator):
     :type t: int
     :parma k: the noise threshold; any matching sequence of tokens shorter than this will be ignored
     :type k: int
+    :param hash: how k-grams are hashed, either ``"rolling"`` (a rolling hash that is stable \
+            across processes and runs) or ``"builtin"`` (Python's ``hash``, which is salted \
+            per process unless ``PYTHONHASHSEED`` is set)
+    :type hash: str
+    :param max_frequency: fingerprints that occur in more files than this are skipped \
+            while scoring. Either a number of files, or a fraction (between 0 and 1) of \
+            all files. ``None`` to never skip fingerprints.
+    :type max_frequency: int or float
+    :param candidates: if not ``None``, only this many submission pairs are scored. These \
+            are the pairs that a fast, approximate, comparison (MinHash) deems most similar. \
+            This makes scoring very large numbers of submissions feasible, at the cost of \
+            possibly missing similar pairs. More candidates means fewer missed pairs.
+    :type candidates: int
+    :param archive: archive submissions indexed ahead of time (see :meth:`build_archive`), \
+            which are then not indexed again while scoring. ``None`` to index the archive \
+            submissions every time.
+    :type archive: :class:`Archive`
+    :param index_path: if not ``None``, the index of all submissions (and archive submissions) \
+            scored is written to this path, as an archive index. A later run can load it (see \
+            :meth:`load_archive`) to score only new submissions against them.
+    :type index_path: str or :class:`pathlib.Path`
+    :param previous_scores: scores of pairs of ``archive`` submissions from an earlier run, \
+            that are scored again (with the frequencies of fingerprints of this run) and ranked \
+            along with the pairs of this run.
+    :type previous_scores: [:class:`compare50.Score`]
     """
 
-    __slots__ = ["k", "t"]
+    __slots__ = ["k", "t", "hash", "max_frequency", "candidates", "archive", "index_path", "previous_scores"]
 
-    def __init__(self, k, t):
+    def __init__(self, k, t, hash="rolling", max_frequency=None, candidates=None, archive=None, index_path=None,
+                 previous_scores=None):
+        if hash not in HASHES:
+            raise ValueError("unknown hash {}, expected one of {}".format(hash, list(HASHES)))
         self.k = k
         self.t = t
+        self.hash = hash
+        self.max_frequency = max_frequency
+        self.candidates = candidates
+        self.archive = archive
+        self.index_path = index_path
+        self.previous_scores = previous_scores
 
     def score(self, submissions, archive_submissions, ignored_files):
         """Number of matching k-grams."""
+        return self._score(submissions, archive_submissions, ignored_files)
+
+    def top_scores(self, submissions, archive_submissions, ignored_files, n):
+        """The ``n`` highest scores, without creating a Score for every submission pair."""
+        return self._score(submissions, archive_submissions, ignored_files, n=n)
+
+    def _score(self, submissions, archive_submissions, ignored_files, n=None):
         def files(subs):
             return [f for sub in subs for f in sub]
 
-        submission_index = ScoreIndex(self.k, self.t)
-        archive_index = ScoreIndex(self.k, self.t)
-        ignored_index = ScoreIndex(self.k, self.t)
+        submission_index = ScoreIndex(self.k, self.t, self.hash)
+        archive_index = ScoreIndex(self.k, self.t, self.hash)
+        ignored_index = ScoreIndex(self.k, self.t, self.hash)
 
         submission_files = files(submissions)
-        archive_files = files(archive_submissions)
+        archive_files = files(archive_submissions) if self.archive is None else []
+        n_archive_files = len(archive_files) if self.archive is None else self.archive.n_files
 
         bar = _api.get_progress_bar()
         bar.reset(total=math.ceil((len(submission_files) + len(archive_files) + len(ignored_files)) / 0.9))
-        frequency_map = collections.Counter()
+        cache = self._fingerprint_cache()
+        index_files = self._index_files(self._index_file(ScoreIndex, (self.k, self.t, self.hash), cache=cache))
+
         with _api.Executor() as executor:
-            
             # Subs and archive subs
-            for index, files in ((submission_index, submission_files), (archive_index, archive_files)):
-                for idx in executor.map(self._index_file(ScoreIndex, (self.k, self.t)), files):
-                    for hash_ in idx.keys():
-                        frequency_map[hash_] += 1
-                    index.include_all(idx)
-                    bar.update()
-            
+            partial_frequencies = self._index(submission_index, submission_files, index_files, executor)
+            if self.archive is None:
+                partial_frequencies += self._index(archive_index, archive_files, index_files, executor)
+            else:
+                archive_index = self.archive.index
+                partial_frequencies.append(self.archive.frequencies)
+
             # Ignored files
-            for idx in executor.map(self._index_file(ScoreIndex, (self.k, self.t)), ignored_files):
-                ignored_index.include_all(idx)
-                bar.update()
+            self._index(ignored_index, list(ignored_files), index_files, executor)
 
-        submission_index.ignore_all(ignored_index)
-        archive_index.ignore_all(ignored_index)
+        if cache is not None:
+            cache.prune()
+
+        if self.index_path is not None:
+            index = ScoreIndex(self.k, self.t, self.hash).include_all(submission_index)
+            index.include_all(archive_index if self.archive is None else self.archive.index)
+            self._write_index(self.index_path, list(submissions) + list(archive_submissions), index,
+                              partial_frequencies, len(submission_files) + n_archive_files)
 
-        # Add submissions to archive (the Index we're going to compare against)
-        archive_index.include_all(submission_index)
+        submission_index.ignore_all(ignored_index)
+        if self.archive is None:
+            archive_index.ignore_all(ignored_index)
+
+        frequency_hashes, frequencies = _merge_frequencies(partial_frequencies)
+
+        # Skip fingerprints shared by (too) many files, these carry little weight
+        # but produce a number of submission pairs quadratic in their frequency
+        common_hashes = np.zeros(0, dtype=np.int64)
+        if self.max_frequency is not None:
+            max_frequency = self.max_frequency
+            if isinstance(max_frequency, float):
+                max_frequency *= len(submission_files) + n_archive_files
+
+            common_hashes = frequency_hashes[frequencies > max_frequency]
+            submission_index.ignore_hashes(common_hashes)
+            if len(common_hashes):
+                bar.write("Skipped {} fingerprint{} that occur{} in more than {} files"
+                          .format(len(common_hashes), "s" if len(common_hashes) != 1 else "",
+                                  "s" if len(common_hashes) == 1 else "", math.floor(max_frequency)))
 
         N = len(submissions) + len(archive_submissions)
-        return submission_index.compare(archive_index, score=lambda h: 1 + math.log(N / (1 + frequency_map[h])))
 
-    def compare(self, scores, ignored_files):
+        def score(hashes):
+            frequency = frequencies[np.searchsorted(frequency_hashes, hashes)]
+            return 1 + np.log(N / (1 + frequency))
+
+        # Compare against a prebuilt archive in place, rather than copying it to add the submissions.
+        # Only pairs of which the first submission has the smaller id are scored,
+        # so this requires the archive submissions to have larger ids than the submissions
+        if (self.archive is not None and self.candidates is None
+                and min(sub.id for sub in archive_submissions) > submission_index._max_id):
+            scores = submission_index.compare(submission_index, score=score, n=n) \
+                   + submission_index.compare(archive_index, score=score, n=n)
+        else:
+            if self.archive is not None:
+                archive_index = ScoreIndex(self.k, self.t, self.hash).include_all(archive_index)
+                archive_index.ignore_all(ignored_index)
+
+            # Add submissions to archive (the Index we're going to compare against)
+            archive_index.include_all(submission_index)
+
+            # Only score the most promising pairs, if so desired
+            pairs = None
+            if self.candidates is not None:
+                pairs = archive_index.candidates([sub.id for sub in submissions], self.candidates)
+
+            scores = submission_index.compare(archive_index, score=score, n=n, pairs=pairs)
+
+        if self.previous_scores and self.archive is not None:
+            scores += self._rescore(score, np.concatenate([ignored_index.keys(), common_hashes]))
+        return scores if n is None else heapq.nlargest(n, scores)
+
+    def _rescore(self, score, skipped_hashes):
+        """
+        Score the :attr:`previous_scores` again with ``score``, as the frequencies of fingerprints
+        changed since they were scored. The ``skipped_hashes`` do not count towards their scores.
+        """
+        def previous_score(hashes):
+            return np.where(np.isin(hashes, skipped_hashes), 0, score(hashes))
+
+        pairs = (np.array([s.sub_a.id for s in self.previous_scores], dtype=np.int64),
+                 np.array([s.sub_b.id for s in self.previous_scores], dtype=np.int64))
+        return self.archive.index.compare(self.archive.index, score=previous_score, pairs=pairs)
+
+    def build_archive(self, archive_submissions, path):
+        """
+        Index ``archive_submissions`` ahead of time, and write the index to ``path``.
+        Later runs can :meth:`load_archive` this index rather than index the archive again.
+        """
+        if not archive_submissions:
+            raise _api.Error("At least one non-empty archive submission is required to build an archive index.")
+
+        settings = self._archive_settings(archive_submissions)
+        files = [f for sub in archive_submissions for f in sub]
 
         bar = _api.get_progress_bar()
-        bar.reset(total=len(scores) if scores else 1)
+        bar.reset(total=len(files))
+        cache = self._fingerprint_cache()
+        index_files = self._index_files(self._index_file(ScoreIndex, (self.k, self.t, self.hash), cache=cache))
+
+        index = ScoreIndex(self.k, self.t, self.hash)
+        with _api.Executor() as executor:
+            partial_frequencies = self._index(index, files, index_files, executor)
+
+        if cache is not None:
+            cache.prune()
+
+        self._write_index(path, archive_submissions, index, partial_frequencies, len(files), settings=settings)
+
+    def _write_index(self, path, submissions, index, partial_frequencies, n_files, settings=None):
+        """Write ``index`` of ``submissions`` to ``path`` as an archive index."""
+        if settings is None:
+            settings = self._archive_settings(submissions)
+
+        # Store positions in submissions rather than submission ids, which differ per run
+        positions = np.zeros(max(index._max_id, max(sub.id for sub in submissions)) + 1, dtype=np.int32)
+        positions[[sub.id for sub in submissions]] = np.arange(len(submissions))
+        hashes, ids = index._arrays()
+        frequency_hashes, frequencies = _merge_frequencies(partial_frequencies)
+
+        metadata = {
+            "settings": settings,
+            "n_files": n_files,
+            "submissions": [{"path": str(sub.path.resolve()),
+                             "files": [str(f.name) for f in sub.files],
+                             "large_files": [str(f) for f in sub.large_files],
+                             "undecodable_files": [str(f) for f in sub.undecodable_files],
+                             "is_archive": sub.is_archive}
+                            for sub in submissions]
+        }
+        _archive.write(path, metadata, {"hashes": hashes,
+                                        "ids": positions[ids],
+                                        "frequency_hashes": frequency_hashes,
+                                        "frequencies": frequencies})
+
+    def load_archive(self, path, preprocessor, lexers=None):
+        """
+        Load an archive index written by :meth:`build_archive`. Returns an :class:`Archive`
+        of which the index is memory-mapped. Set it as this comparator's ``archive`` and
+        pass its submissions as the archive submissions to use it while scoring. These are
+        created with ``preprocessor`` and ``lexers`` (see :class:`compare50.Submission`).
+        """
+        metadata, arrays = _archive.read(path)
+        submissions = [Submission(sub["path"], sub["files"],
+                                  large_files=sub["large_files"],
+                                  undecodable_files=sub["undecodable_files"],
+                                  preprocessor=preprocessor,
+                                  is_archive=sub.get("is_archive", True),
+                                  lexers=lexers or {})
+                       for sub in metadata["submissions"]]
+
+        if metadata["settings"] != self._archive_settings(submissions):
+            raise _api.Error("{} was built with different settings (pass, lexers, or hash seed) than those of this run"
+                             .format(path))
+        ids = np.array([sub.id for sub in submissions], dtype=np.int32)
+
+        index = ScoreIndex(self.k, self.t, self.hash)
+        index._hashes, index._ids = arrays["hashes"], ids[arrays["ids"]]
+        index._max_id = int(ids.max())
+        return Archive(submissions, index, (arrays["frequency_hashes"], arrays["frequencies"]), metadata["n_files"])
+
+    def _archive_settings(self, submissions):
+        """Everything that determines the fingerprints of ``submissions`` in an archive index."""
+        description = _cache.describe(submissions[0].preprocessor)
+        if description is None:
+            raise _api.Error("Cannot use an archive index with a preprocessor that cannot be identified.")
+
+        # Python's hash() differs between interpreters unless PYTHONHASHSEED is set
+        salt = None
+        if self.hash == "builtin":
+            if os.environ.get("PYTHONHASHSEED", "random") == "random":
+                raise _api.Error("Cannot use an archive index with Python's hash unless PYTHONHASHSEED is set.")
+            salt = [sys.hash_info.algorithm, os.environ["PYTHONHASHSEED"]]
+
+        # The lexer of every file extension (or name) in the archive, e.g. as chosen with --lexer
+        lexers = {}
+        for sub in submissions:
+            for file in sub:
+                key = file.name.suffix or file.name.name
+                if key not in lexers:
+                    lexers[key] = _cache.describe_lexer(file._lexer_for_name())
+
+        return {"index": ScoreIndex.__name__, "k": self.k, "t": self.t, "hash": self.hash,
+                "salt": salt, "preprocessor": description, "lexers": lexers}
+
+    def _fingerprint_cache(self):
+        # Fingerprints built from Python's hash() can only be reused across runs
+        # if hash randomization is disabled
+        if self.hash == "builtin" and os.environ.get("PYTHONHASHSEED", "random") == "random":
+            return None
+        return _cache.fingerprint_cache
+
+    @staticmethod
+    def _index(index, files, index_files, executor):
+        """
+        Index files in batches, such that every worker merges the indices of its files
+        and only sends back one index (and how many of its files each fingerprint occurs in).
+        Adds every batch to ``index``, returns the fingerprint frequencies of every batch.
+        """
+        n_batches = 4 * (os.cpu_count() or 1)
+        bar = _api.get_progress_bar()
+
+        partial_frequencies = []
+        batches = _split(files, n_batches)
+        for batch, (idx, frequencies) in zip(batches, executor.map(index_files, batches)):
+            partial_frequencies.append(frequencies)
+            index.include_all(idx)
+            bar.update(len(batch))
+        return partial_frequencies
+
+    def compare(self, scores, ignored_files):
+        bar = _api.get_progress_bar()
         if not scores:
+            bar.reset(total=1)
             return []
 
         # Create index of ignored_files
-        ignored_index = CompareIndex(self.k)
+        ignored_index = CompareIndex(self.k, self.hash)
         for ignored_file in ignored_files:
             ignored_index.include(ignored_file)
 
-        # Find all unique submissions
-        subs = set()
-        for s in scores:
-            subs.add(s.sub_a)
-            subs.add(s.sub_b)
+        # Find all unique files
+        files = list({file: None for score in scores for sub in (score.sub_a, score.sub_b) for file in sub})
+        bar.reset(total=len(files) + len(scores))
 
-        # TODO: Rename me
-        # Basically a named tuple of information we need to keep around for each file
-        @attr.s(slots=True)
-        class FileCache:
-            # List of tokens (and their corresponding indices) that can be matched.
-            # Name is slightly misleading since it is a list of (token, index) pairs
-            unignored_tokens = attr.ib(factory=list)
-            ignored_spans = attr.ib(factory=list)
+        n_batches = 4 * (os.cpu_count() or 1)
 
+        with _api.Executor() as executor:
+            # Tokenize and index every file once, in parallel. The indexed stretches of unignored
+            # tokens of every file come back pickled, so that they are only ever unpickled by the
+            # workers that compare the file
+            file_cache = {}
+            ignored_spans = {}
+            for file, (cache, spans) in zip(files, executor.map(self._cache_file(ignored_index), files,
+                                                                chunksize=max(1, len(files) // n_batches))):
+                file_cache[file.id] = cache
+                ignored_spans[file] = [Span(file, start, end) for start, end in spans]
+                bar.update()
 
-        file_cache = {}
-        for sub in subs:
-            for file in sub:
-                file_tokens = file.tokens()
-                cache = FileCache()
-
-                # Get list of unignored tokens
-                token_lists = ignored_index.unignored_tokens(file, tokens=file_tokens)
-                # Index each stretch of unignored tokens, index and add to the cache
-                for token_list in token_lists:
-                    index = CompareIndex(self.k)
-                    index.include(file, tokens=token_list)
-                    cache.unignored_tokens.append((token_list, index))
-
-                cache.ignored_spans = _api.missing_spans(file,
-                                                         original_tokens=file_tokens,
-                                                         processed_tokens=list(itertools.chain.from_iterable(token_lists)))
-                file_cache[file] = cache
-
+            # Compare the submission pairs in batches, every batch is sent along with
+            # the caches of just the files it needs, so workers share nothing
+            batches = _split(sorted(scores, key=lambda score: (score.sub_a.id, score.sub_b.id)), n_batches)
+            tasks = [([([f.id for f in score.sub_a], [f.id for f in score.sub_b]) for score in batch],
+                      {f.id: file_cache[f.id] for score in batch for sub in (score.sub_a, score.sub_b) for f in sub})
+                     for batch in batches]
 
+            sub_match_to_span_matches = {}
+            for batch, results in zip(batches, executor.map(_compare_files, tasks)):
+                for score, span_matches in zip(batch, results):
+                    sub_match_to_span_matches[(score.sub_a, score.sub_b)] = span_matches
+                bar.update(len(batch))
 
         comparisons = []
         for score in scores:
-            ignored_spans = set()
-            span_matches = []
+            # Spans are sent back as (file id, start, end), turn them back into Spans of our own Files
+            span_matches = [(Span(File.get(file_a), start_a, end_a), Span(File.get(file_b), start_b, end_b))
+                            for file_a, start_a, end_a, file_b, start_b, end_b
+                            in sub_match_to_span_matches[(score.sub_a, score.sub_b)]]
 
             # We already have the ignored spans for every file cached, so we just need to get the list
             # for each file in this submission pair.
+            sub_ignored_spans = set()
             for file in itertools.chain(score.sub_a.files, score.sub_b.files):
-                ignored_spans.update(file_cache[file].ignored_spans)
-
-            # Compare each pair of files in the submission pair
-            for file_a, file_b in itertools.product(score.sub_a.files, score.sub_b.files):
-                cache_a = file_cache[file_a]
-                cache_b = file_cache[file_b]
-                # For each pair of unignored regions in the file pair, find the matching spans
-                # (by comparing their indices) and expand them as much as possible
-                for (tokens_a, index_a), (tokens_b, index_b) in itertools.product(cache_a.unignored_tokens, cache_b.unignored_tokens):
-                    span_matches += _api.expand(index_a.compare(index_b), tokens_a, tokens_b)
+                sub_ignored_spans.update(ignored_spans[file])
 
-            comparisons.append(Comparison(score.sub_a, score.sub_b, span_matches, list(ignored_spans)))
-            bar.update()
+            comparisons.append(Comparison(score.sub_a, score.sub_b, span_matches, list(sub_ignored_spans)))
 
         return comparisons
 
+    @attr.s(slots=True)
+    class _cache_file:
+        """ "Function" that tokenizes a file, and indexes the stretches of its unignored tokens.
+        Returns the pickled stretches (as Tokens) and their index, and the
+        spans (start, end) of the file that are ignored.
+        In the form of a class so that pickle can serialize it. """
+        ignored_index = attr.ib()
+
+        def __call__(self, file):
+            file_tokens = file.tokens()
+
+            # Get list of unignored tokens
+            unignored_token_lists = self.ignored_index.unignored_tokens(file, tokens=file_tokens)
+            # Index all stretches of unignored tokens in one index, that keeps track of
+            # which stretch every fingerprint comes from
+            token_lists = [Tokens.from_tokens(token_list) for token_list in unignored_token_lists]
+            index = CompareIndex(self.ignored_index.k, self.ignored_index.hash)
+            for stretch, token_list in enumerate(token_lists):
+                index.include(file, tokens=token_list, stretch=stretch)
+
+            ignored_spans = _api.missing_spans(file,
+                                               original_tokens=file_tokens,
+                                               processed_tokens=list(itertools.chain.from_iterable(unignored_token_lists)))
+            return (pickle.dumps((token_lists, index)),
+                    [(span.start, span.end) for span in ignored_spans])
 
     @attr.s(slots=True)
     class _index_file:
@@ -145,12 +393,65 @@ class Winnowing(Comparator):
         In the form of a class so that pickle can serialize it. """
         index = attr.ib()
         args = attr.ib(default=())
+        cache = attr.ib(default=None)
 
         def __call__(self, file):
             index = self.index(*self.args)
-            index.include(file)
+
+            preprocessor = _cache.describe(file.submission.preprocessor)
+            if self.cache is None or preprocessor is None:
+                index.include(file)
+                return index
+
+            # Python's hash() differs between interpreters unless PYTHONHASHSEED is set
+            salt = None
+            if index.hash == "builtin":
+                salt = (sys.hash_info.algorithm, os.environ.get("PYTHONHASHSEED"))
+
+            lexer = _cache.describe_lexer(file.lexer())
+            key = self.cache.key(file, self.index.__name__, self.args, salt, preprocessor, lexer)
+            hashes = self.cache.get(key)
+            if hashes is None:
+                hashes = index.fingerprint_hashes(file)
+                self.cache.put(key, hashes)
+            index.include_hashes(file, hashes)
             return index
 
+    @attr.s(slots=True)
+    class _index_files:
+        """ "Function" that indexes a batch of files into a single index, and counts
+        the number of files in which each fingerprint occurs.
+        In the form of a class so that pickle can serialize it. """
+        index_file = attr.ib()
+
+        def __call__(self, files):
+            index = self.index_file.index(*self.index_file.args)
+            file_hashes = [np.zeros(0, dtype=np.int64)]
+            for file in files:
+                file_index = self.index_file(file)
+                file_hashes.append(file_index.keys())
+                index.include_all(file_index)
+
+            # Merge before sending the index back
+            index._arrays()
+            return index, np.unique(np.concatenate(file_hashes), return_counts=True)
+
+
+@attr.s(slots=True, frozen=True)
+class Archive:
+    """
+    Archive submissions indexed ahead of time, see :meth:`Winnowing.build_archive`.
+
+    :ivar submissions: the archive submissions
+    :ivar index: :class:`ScoreIndex` of the archive submissions
+    :ivar frequencies: the fingerprints in the archive, and the number of files each occurs in
+    :ivar n_files: the number of files in the archive
+    """
+    submissions = attr.ib()
+    index = attr.ib()
+    frequencies = attr.ib()
+    n_files = attr.ib()
+
 
 class Index(abc.ABC):
     """Abstract base class for a map between (hashed) fingerprints (k-grams) and the Spans
@@ -158,32 +459,40 @@ class Index(abc.ABC):
     :param k: the size of the fingerprints, or equivalently the "noise threshold", the \
               number of tokens that must be identical between two files for us to consider
               it a match.
+    :param hash: name of the function used to hash k-grams (see ``HASHES``)
     """
-    def __init__(self, k):
+    def __init__(self, k, hash="rolling"):
         self.k = k
-        self._index = collections.defaultdict(set)
+        self.hash = hash
 
+    @abc.abstractmethod
     def keys(self):
-        return self._index.keys()
+        """The distinct hashes in the index, in ascending order."""
+        pass
 
+    @abc.abstractmethod
     def values(self):
-        return self._index.values()
+        """What every distinct hash maps to, in the order of :meth:`keys`."""
+        pass
 
+    @abc.abstractmethod
     def include(self, file, tokens=None):
-        """Fingerprint a file and add it too the index."""
-        for hash, val in self.fingerprint(file, tokens):
-            self._index[hash].add(val)
+        """Fingerprint a file and add it to the index."""
+        pass
 
+    @abc.abstractmethod
     def include_all(self, other):
         """Add all fingerprints from another index into this one."""
-        for hash, vals in other._index.items():
-            self._index[hash] |= vals
-        return self
+        pass
 
     def ignore_all(self, other):
         """Remove all fingerprints in another index from this one."""
-        for hash in other._index:
-            self._index.pop(hash, None)
+        self.ignore_hashes(other.keys())
+
+    @abc.abstractmethod
+    def ignore_hashes(self, hashes):
+        """Remove all fingerprints with the given hashes from this index."""
+        pass
 
     def kgrams(self, iterable):
         """
@@ -196,8 +505,43 @@ class Index(abc.ABC):
         return zip(*iters)
 
     def hashes(self, tokens):
-        """Hash each contiguous sequence of k tokens in ``tokens``."""
-        return (hash("".join(kgram)) for kgram in self.kgrams(t.val for t in tokens))
+        """Hash each contiguous sequence of k tokens in ``tokens``, returns an array of hashes."""
+        return HASHES[self.hash](self, tokens)
+
+    def _builtin_hashes(self, tokens):
+        return np.fromiter((hash("".join(kgram)) for kgram in self.kgrams(t.val for t in tokens)),
+                           dtype=np.int64)
+
+    def _rolling_hashes(self, tokens):
+        # Polynomial (Rabin-Karp) hash over token ids, modulo 2^64:
+        #     h_i = id_i * B^(k-1) + id_(i+1) * B^(k-2) + ... + id_(i+k-1)
+        # Since B is odd, it has an inverse modulo 2^64. With the prefix sums
+        #     P_i = id_0 + id_1 * B^-1 + ... + id_(i-1) * B^-(i-1)
+        # every hash follows from h_i = (P_(i+k) - P_i) * B^(i+k-1), in O(n) total
+        n = len(tokens) - self.k + 1
+        if n <= 0:
+            return np.zeros(0, dtype=np.int64)
+
+        if isinstance(tokens, Tokens):
+            # Hash every distinct value only once
+            ids = np.fromiter((_token_id(val) for val in tokens.value_table), dtype=np.uint64,
+                              count=len(tokens.value_table))[tokens.values]
+        else:
+            ids = np.fromiter((_token_id(tok.val) for tok in tokens), dtype=np.uint64, count=len(tokens))
+
+        with np.errstate(over="ignore"):
+            prefix_sums = np.zeros(len(ids) + 1, dtype=np.uint64)
+            np.cumsum(ids * _powers(_ROLLING_BASE_INVERSE, len(ids)), out=prefix_sums[1:])
+            hashes = (prefix_sums[self.k:] - prefix_sums[:n]) * _powers(_ROLLING_BASE, len(ids))[self.k - 1:]
+
+            # Mix the bits (splitmix64 finalizer), winnowing relies on hashes being uniform
+            hashes ^= hashes >> np.uint64(30)
+            hashes *= np.uint64(0xbf58476d1ce4e5b9)
+            hashes ^= hashes >> np.uint64(27)
+            hashes *= np.uint64(0x94d049bb133111eb)
+            hashes ^= hashes >> np.uint64(31)
+
+        return hashes.view(np.int64)
 
     @abc.abstractmethod
     def compare(self, other):
@@ -207,103 +551,584 @@ class Index(abc.ABC):
     def fingerprint(self, file, tokens=None):
         pass
 
+    @abc.abstractmethod
     def __bool__(self):
-        return bool(self._index)
+        pass
+
+
+#: Functions by which an Index can hash k-grams
+HASHES = {
+    "rolling": Index._rolling_hashes,
+    "builtin": Index._builtin_hashes
+}
+
+
+_ROLLING_BASE = 0x100000001b3
+
+
+def _inverse(x, bits=64):
+    """Multiplicative inverse of odd x modulo 2^bits (by Newton's method)."""
+    inverse = x
+    for _ in range(6):
+        inverse = inverse * (2 - x * inverse) % 2 ** bits
+    return inverse
+
+
+_ROLLING_BASE_INVERSE = _inverse(_ROLLING_BASE)
+
+
+def _powers(base, n):
+    """Array containing base^0, base^1, ..., base^(n-1) modulo 2^64."""
+    powers = np.full(n, base, dtype=np.uint64)
+    powers[0] = 1
+    return np.cumprod(powers, out=powers)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _token_id(val):
+    """Map a token value to an integer that is identical across processes and runs."""
+    return int.from_bytes(hashlib.blake2b(val.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
 
 
 class ScoreIndex(Index):
-    def __init__(self, k, t):
-        super().__init__(k)
+    """
+    Index from (winnowed) fingerprints to the ids of the submissions they occur in.
+    Stored as two parallel arrays of hashes and submission ids, sorted by hash and id.
+    """
+    #: Largest number of submission pairs for which scores are accumulated in a dense matrix
+    MAX_DENSE_SIZE = 1 << 24
+
+    #: Number of submission pairs that compare expands at once
+    BATCH_SIZE = 1 << 22
+
+    #: MinHash signatures (see candidates) consist of this many bands of this many rows.
+    #: Single row bands find pairs that share only a small part of their code.
+    MINHASH_BANDS = 128
+    MINHASH_ROWS = 1
+
+    #: Buckets of more submissions than this are not used to propose candidates
+    MINHASH_MAX_BUCKET = 64
+
+    def __init__(self, k, t, hash="rolling"):
+        super().__init__(k, hash)
         self.w = t - k + 1
         self._max_id = 0
+        self._hashes = np.zeros(0, dtype=np.int64)
+        self._ids = np.zeros(0, dtype=np.int32)
+        # Arrays of hashes and ids that have yet to be merged into the arrays above
+        self._pending = []
+
+    def keys(self):
+        """The distinct hashes in the index, in ascending order."""
+        hashes, _, _ = self._groups()
+        return hashes
+
+    def values(self):
+        """The ids of the submissions of every distinct hash, as arrays in the order of :meth:`keys`."""
+        _, starts, _ = self._groups()
+        return np.split(self._arrays()[1], starts[1:]) if len(starts) else []
 
     def include(self, file, tokens=None):
-        super().include(file, tokens)
-        self._max_id = max(self._max_id, file.submission.id)
+        self.include_hashes(file, self.fingerprint_hashes(file, tokens))
 
     def include_all(self, other):
-        super().include_all(other)
+        self._pending.append(other._arrays())
         self._max_id = max(self._max_id, other._max_id)
+        return self
 
-    def compare(self, other, score=lambda _: 1):
-        # Keep a self.max_file_id by other.max_file_id matrix for counting score
-        scores = np.zeros((self._max_id + 1, other._max_id + 1), dtype=np.float64)
+    def include_hashes(self, file, hashes):
+        """Add precomputed (e.g. cached) fingerprint hashes of a file to the index."""
+        hashes = np.unique(np.asarray(hashes, dtype=np.int64))
+        self._pending.append((hashes, np.full(len(hashes), file.submission.id, dtype=np.int32)))
+        self._max_id = max(self._max_id, file.submission.id)
+
+    def ignore_hashes(self, hashes):
+        hashes_, ids = self._arrays()
+        keep = ~np.isin(hashes_, np.asarray(hashes, dtype=np.int64))
+        self._hashes, self._ids = hashes_[keep], ids[keep]
+
+    def compare(self, other, score=lambda hashes: 1, n=None, pairs=None):
+        """
+        Score every pair of submissions from self and other by summing the score of every
+        fingerprint they have in common. ``score`` maps an array of hashes to their scores.
+        Returns only the ``n`` highest scores (in descending order) if ``n`` is not ``None``.
+        If ``pairs`` (two arrays of submission ids) is given, only those pairs are scored.
+        """
+        if pairs is None:
+            ids_a, ids_b, values = self._score_all(other, score)
+        else:
+            ids_a, ids_b, values = self._score_pairs(other, score, *pairs)
+
+        if n is not None:
+            largest = _largest(values, n)
+            ids_a, ids_b, values = ids_a[largest], ids_b[largest], values[largest]
 
-        # Find common fingerprints (hashes)
-        common_hashes = set(self._index) & set(other._index)
+        return [Score(Submission.get(id1), Submission.get(id2), score)
+                for id1, id2, score in zip(ids_a, ids_b, values)]
+
+    def _score_all(self, other, score):
+        """
+        Score all pairs of submissions (id_a < id_b) from self and other. Returns arrays
+        of the ids and scores of all pairs with a score > 0.
+        """
+        # Accumulate scores in a self.max_file_id by other.max_file_id matrix, unless that
+        # matrix would be too large, then only keep track of the pairs that actually match
+        shape = (self._max_id + 1, other._max_id + 1)
+        if shape[0] * shape[1] <= self.MAX_DENSE_SIZE:
+            scores = _DenseScores(shape)
+        else:
+            scores = _SparseScores(shape)
+
+        # Find common fingerprints (hashes), and where their ids are in both indices
+        hashes_a, starts_a, counts_a = self._groups()
+        hashes_b, starts_b, counts_b = other._groups()
+        common_hashes, common_a, common_b = np.intersect1d(hashes_a, hashes_b, assume_unique=True,
+                                                           return_indices=True)
+        starts_a, counts_a = starts_a[common_a], counts_a[common_a]
+        starts_b, counts_b = starts_b[common_b], counts_b[common_b]
+        weights = np.broadcast_to(np.asarray(score(common_hashes), dtype=np.float64), common_hashes.shape)
+
+        # Each common fingerprint scores the product of the ids from self and other
+        sizes = counts_a.astype(np.int64) * counts_b
 
         bar = _api.get_progress_bar()
-        try:
-            update_amount = (bar.total - bar.n - 1) / len(common_hashes)
-        except ZeroDivisionError:
-            pass
+        update_amount = (bar.total - bar.n - 1) / max(sizes.sum(), 1)
 
-        for hash_ in common_hashes:
-            bar.update(update_amount)
+        for begin, end in _batches(sizes, self.BATCH_SIZE):
+            batch_sizes = sizes[begin:end]
+
+            # For every pair, the fingerprint it belongs to and its position in that product
+            fingerprints = np.repeat(np.arange(begin, end), batch_sizes)
+            positions = np.arange(batch_sizes.sum()) - np.repeat(np.cumsum(batch_sizes) - batch_sizes, batch_sizes)
 
-            # All file_ids associated with fingerprint in self
-            index1 = self._index[hash_]
-            # All file_ids associated with fingerprint in other
-            index2 = other._index[hash_]
-            if index1 and index2:
-                # Create the product of all file_ids from self and other
-                # https://stackoverflow.com/questions/28684492/numpy-equivalent-of-itertools-product
-                index = np.array(np.meshgrid([id for id in index1],
-                                             [id for id in index2])).T.reshape(-1, 2)
+            ids_a = self._ids[starts_a[fingerprints] + positions // counts_b[fingerprints]]
+            ids_b = other._ids[starts_b[fingerprints] + positions % counts_b[fingerprints]]
+            scores.add(ids_a, ids_b, weights[fingerprints])
 
-                # Add 1 to all combo's (the product) of file_ids from self and other
-                scores[index[:, 0], index[:, 1]] += score(hash_)
+            bar.update(update_amount * len(fingerprints))
 
         # Return only those Scores with a score > 0 from different submissions
-        return [Score(Submission.get(id1), Submission.get(id2), scores[id1][id2])
-                for id1, id2 in zip(*np.where(np.triu(scores, 1) > 0))]
+        return scores.nonzero()
+
+    def _score_pairs(self, other, score, ids_a, ids_b):
+        """
+        Score only the given pairs of submissions, by intersecting the fingerprints of
+        both submissions. Returns arrays of the ids and scores of the pairs with a score > 0.
+        """
+        hashes_a, bounds_a = self._by_id()
+        hashes_b, bounds_b = other._by_id()
+        weights_a = np.broadcast_to(np.asarray(score(hashes_a), dtype=np.float64), hashes_a.shape)
+
+        bar = _api.get_progress_bar()
+        update_amount = (bar.total - bar.n - 1) / max(len(ids_a), 1)
+
+        values = np.zeros(len(ids_a), dtype=np.float64)
+        for i, (id_a, id_b) in enumerate(zip(ids_a.tolist(), ids_b.tolist())):
+            begin_a, end_a = bounds_a[id_a], bounds_a[id_a + 1]
+            begin_b, end_b = bounds_b[id_b], bounds_b[id_b + 1]
+            _, common, _ = np.intersect1d(hashes_a[begin_a:end_a], hashes_b[begin_b:end_b],
+                                          assume_unique=True, return_indices=True)
+            values[i] = weights_a[begin_a + common].sum()
+            bar.update(update_amount)
+
+        mask = values > 0
+        return ids_a[mask], ids_b[mask], values[mask]
+
+    def _by_id(self):
+        """
+        The hashes in the index sorted by id (then hash), and for every id the position
+        of its first hash. The hashes of id ``i`` are ``hashes[bounds[i]:bounds[i + 1]]``.
+        """
+        hashes, ids = self._arrays()
+        order = np.lexsort((hashes, ids))
+        bounds = np.searchsorted(ids[order], np.arange(self._max_id + 2))
+        return hashes[order], bounds
+
+    def candidates(self, submission_ids, n):
+        """
+        Quickly propose the (roughly) ``n`` most similar pairs of submissions in the index,
+        wherein the first submission of every pair has one of ``submission_ids``.
+
+        The similarity of two submissions is estimated as the Jaccard similarity of their
+        fingerprints, by means of MinHash signatures. Only pairs with identical rows in
+        one of the bands of their signatures (locality sensitive hashing) are considered.
+        Returns two arrays of submission ids (id_a < id_b), sorted by id.
+        """
+        hashes, bounds = self._by_id()
+        ids = np.flatnonzero(np.diff(bounds) > 0)
+        empty = np.zeros(0, dtype=np.int64)
+        if len(ids) < 2 or n <= 0:
+            return empty, empty
+
+        # MinHash signature of every submission, the minimum of every permutation of its hashes
+        signatures = np.empty((len(ids), self.MINHASH_BANDS * self.MINHASH_ROWS), dtype=np.uint64)
+        random = np.random.RandomState(50)
+        with np.errstate(over="ignore"):
+            for i in range(signatures.shape[1]):
+                xor, multiplier = random.randint(0, 2 ** 63, size=2, dtype=np.uint64)
+                permuted = (hashes.view(np.uint64) ^ xor) * (multiplier | np.uint64(1))
+                signatures[:, i] = np.minimum.reduceat(permuted, bounds[ids])
+
+        # Submissions whose signatures agree on all rows of a band end up in the same bucket
+        pairs = []
+        for band in range(self.MINHASH_BANDS):
+            rows = signatures[:, band * self.MINHASH_ROWS:(band + 1) * self.MINHASH_ROWS]
+            with np.errstate(over="ignore"):
+                keys = rows[:, 0].copy()
+                for row in rows[:, 1:].T:
+                    keys = keys * np.uint64(0x100000001b3) ^ row
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+
+            # Pair each submission with the next few submissions in its bucket,
+            # but skip buckets that are too large to be telling
+            bucket_starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+            bucket_sizes = np.diff(np.append(bucket_starts, len(keys)))
+            small = np.repeat(bucket_sizes <= self.MINHASH_MAX_BUCKET, bucket_sizes)
+            for distance in range(1, min(bucket_sizes.max(), self.MINHASH_MAX_BUCKET)):
+                same = (keys[distance:] == keys[:-distance]) & small[distance:]
+                first, second = order[:-distance][same], order[distance:][same]
+                pairs.append(np.minimum(first, second) * len(ids) + np.maximum(first, second))
+
+        # Only pairs whose first submission is a submission (e.g. not an archive submission)
+        pairs = np.unique(np.concatenate([empty] + pairs))
+        first, second = np.divmod(pairs, len(ids))
+        mask = np.isin(ids[first], submission_ids)
+        first, second = first[mask], second[mask]
+
+        # Keep the n pairs with the highest estimated similarity
+        similarity = np.zeros(len(first), dtype=np.float64)
+        for begin in range(0, len(first), self.BATCH_SIZE // signatures.shape[1]):
+            end = begin + self.BATCH_SIZE // signatures.shape[1]
+            similarity[begin:end] = (signatures[first[begin:end]] == signatures[second[begin:end]]).mean(axis=1)
+        largest = np.sort(_largest(similarity, n))
+        return ids[first[largest]], ids[second[largest]]
+
+    def _arrays(self):
+        """Merge any pending fingerprints, then return the arrays of hashes and ids."""
+        if self._pending:
+            hashes = np.concatenate([self._hashes] + [hashes for hashes, _ in self._pending])
+            ids = np.concatenate([self._ids] + [ids for _, ids in self._pending])
+            self._pending = []
+
+            # Sort by hash, then id, and drop duplicates
+            order = np.lexsort((ids, hashes))
+            hashes, ids = hashes[order], ids[order]
+            unique = np.ones(len(hashes), dtype=bool)
+            unique[1:] = (hashes[1:] != hashes[:-1]) | (ids[1:] != ids[:-1])
+            self._hashes, self._ids = hashes[unique], ids[unique]
+
+        return self._hashes, self._ids
+
+    def _groups(self):
+        """The distinct hashes in the index, with the position and number of their ids."""
+        return _groups(self._arrays()[0])
+
+    def __bool__(self):
+        return bool(len(self._arrays()[0]))
 
     def fingerprint(self, file, tokens=None):
+        return [(hash_, file.submission.id) for hash_ in self.fingerprint_hashes(file, tokens).tolist()]
+
+    def fingerprint_hashes(self, file, tokens=None):
+        """The hashes of the fingerprints of a file, as an array."""
         if not tokens:
-            tokens = file.tokens()
+            tokens = file.tokens(columnar=True)
             if not tokens:
-                return []
+                return np.zeros(0, dtype=np.int64)
 
         hashes = self.hashes(tokens)
+        if not len(hashes):
+            return hashes
 
-        fingerprints = []
-
-        # circular buffer holding window
-        buf = [(math.inf, Span(None, 0, 0))] * self.w
-        # index of minimum hash in buffer
-        min_idx = 0
-        for hash_, idx in zip(hashes, itertools.cycle(range(self.w))):
-            buf[idx] = hash_, file.submission.id
-            if min_idx == idx:
-                # old min not in window, search left for new min
-                for j in range(1, self.w):
-                    search_idx = (idx - j) % self.w
-                    if buf[search_idx][0] < buf[min_idx][0]:
-                        min_idx = search_idx
-                fingerprints.append(buf[min_idx])
-            else:
-                # compare new hash to old min (robust winnowing)
-                if buf[idx][0] < buf[min_idx][0]:
-                    min_idx = idx
-                    fingerprints.append(buf[min_idx])
-        return fingerprints
+        return self._winnow(hashes)
+
+    def _winnow(self, hashes):
+        """
+        Robust winnowing over an array of hashes. Selects the minimum hash of the first
+        window, then only selects a new minimum once the selected hash leaves the window,
+        or a strictly smaller hash enters it. Among equal hashes, the rightmost is selected.
+        """
+        w = self.w
+
+        # Pad the start, so that the first w - 1 windows only cover the hashes seen so far
+        padded = np.concatenate((np.full(w - 1, np.iinfo(np.int64).max, dtype=np.int64), hashes))
+        # Every window as a read-only view, sliding_window_view requires numpy 1.20
+        windows = np.lib.stride_tricks.as_strided(padded, shape=(len(hashes), w),
+                                                  strides=(padded.strides[0], padded.strides[0]),
+                                                  writeable=False)
+
+        # Position of the (rightmost) minimum of the window ending at every position
+        minima = np.arange(len(hashes)) - np.argmin(windows[:, ::-1], axis=1)
+
+        # Positions of hashes that are strictly smaller than every hash in the window before it
+        smaller = (np.flatnonzero(hashes[1:] < hashes[minima[:-1]]) + 1).tolist()
+        smaller.append(len(hashes))
+        minima = minima.tolist()
+
+        # A new minimum is selected at the start, whenever a strictly smaller hash comes in,
+        # or whenever the selected minimum leaves the window. Only the latter depends on
+        # earlier selections, so walk from selection to selection.
+        selected = []
+        pos = 0
+        next_smaller = 0
+        while pos < len(hashes):
+            selected.append(minima[pos])
+            while smaller[next_smaller] <= pos:
+                next_smaller += 1
+            pos = min(minima[pos] + w, smaller[next_smaller])
+
+        return hashes[selected]
+
+
+def _groups(hashes):
+    """
+    The distinct hashes in a sorted array of hashes, with the position
+    of the first occurrence and the number of occurrences of each.
+    """
+    if not len(hashes):
+        empty = np.zeros(0, dtype=np.int64)
+        return hashes, empty, empty
+
+    starts = np.flatnonzero(np.concatenate(([True], hashes[1:] != hashes[:-1])))
+    counts = np.diff(np.append(starts, len(hashes)))
+    return hashes[starts], starts, counts
+
+
+def _largest(values, n):
+    """
+    Indices of the ``n`` largest values in descending order of value. Like ``heapq.nlargest``,
+    equal values are ordered by their index.
+    """
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if n < len(values):
+        # Everything larger than the n-th largest value, plus the first few equal to it
+        threshold = np.partition(values, len(values) - n)[len(values) - n]
+        larger = np.flatnonzero(values > threshold)
+        equal = np.flatnonzero(values == threshold)[:n - len(larger)]
+        indices = np.sort(np.concatenate((larger, equal)))
+    else:
+        indices = np.arange(len(values))
+
+    return indices[np.argsort(-values[indices], kind="stable")]
+
+
+def _compare_files(task):
+    """
+    Compare every file of the first submission with every file of the second submission,
+    for a batch of submission pairs (as lists of file ids) and a mapping from file ids to
+    their (pickled) stretches of unignored tokens and index, see Winnowing._cache_file.
+    Returns the matching spans of every pair, as tuples of
+    (file_a, start_a, end_a, file_b, start_b, end_b) wherein files are ids.
+    """
+    pairs, pickled_file_cache = task
+    file_cache = {}
+    results = []
+    for files_a, files_b in pairs:
+        for file in itertools.chain(files_a, files_b):
+            if file not in file_cache:
+                file_cache[file] = pickle.loads(pickled_file_cache[file])
+
+        span_matches = []
+        # Compare each pair of files in the submission pair
+        for file_a, file_b in itertools.product(files_a, files_b):
+            token_lists_a, index_a = file_cache[file_a]
+            token_lists_b, index_b = file_cache[file_b]
+
+            # Find the matching spans, and group them by the pair of unignored regions they are from
+            positions_a, positions_b = index_a.compare(index_b)
+            _, stretches_a, starts_a, ends_a = index_a.spans(positions_a)
+            _, stretches_b, starts_b, ends_b = index_b.spans(positions_b)
+            order = np.lexsort((stretches_b, stretches_a))
+            stretches_a, starts_a, ends_a = stretches_a[order], starts_a[order], ends_a[order]
+            stretches_b, starts_b, ends_b = stretches_b[order], starts_b[order], ends_b[order]
+            bounds = np.flatnonzero(np.diff(stretches_a) | np.diff(stretches_b)) + 1
+
+            # Expand the matching spans as much as possible, without leaving their regions
+            for begin, end in zip(np.append(0, bounds).tolist(), np.append(bounds, len(order)).tolist()):
+                if begin == end:
+                    continue
+                tokens_a = token_lists_a[stretches_a[begin]]
+                tokens_b = token_lists_b[stretches_b[begin]]
+                span_matches += [(file_a, start_a, end_a, file_b, start_b, end_b)
+                                 for start_a, end_a, start_b, end_b
+                                 in _api._expand(starts_a[begin:end], ends_a[begin:end],
+                                                 starts_b[begin:end], ends_b[begin:end], tokens_a, tokens_b)]
+
+        results.append(span_matches)
+    return results
+
+
+def _split(items, n):
+    """Split a list into (at most) ``n`` consecutive batches of (roughly) equal size."""
+    size = math.ceil(len(items) / n) if items else 1
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _merge_frequencies(frequencies):
+    """
+    Merge ``(hashes, counts)`` pairs, as returned by ``np.unique(..., return_counts=True)``,
+    into one pair of distinct hashes and their total counts.
+    """
+    hashes = np.concatenate([np.zeros(0, dtype=np.int64)] + [hashes for hashes, _ in frequencies])
+    counts = np.concatenate([np.zeros(0, dtype=np.int64)] + [counts for _, counts in frequencies])
+    distinct_hashes, inverse = np.unique(hashes, return_inverse=True)
+    return distinct_hashes, np.bincount(inverse.ravel(), weights=counts, minlength=len(distinct_hashes)).astype(np.int64)
+
+
+def _batches(sizes, batch_size):
+    """
+    Split ``range(len(sizes))`` into consecutive ranges whose ``sizes`` add up to at most
+    ``batch_size``, or to a single element if that alone exceeds ``batch_size``.
+    """
+    ends = np.cumsum(sizes)
+    begin = 0
+    while begin < len(sizes):
+        offset = ends[begin - 1] if begin else 0
+        end = max(int(np.searchsorted(ends, offset + batch_size, side="right")), begin + 1)
+        yield begin, end
+        begin = end
+
+
+class _DenseScores:
+    """Scores of submission pairs, accumulated in a dense matrix."""
+    def __init__(self, shape):
+        self._scores = np.zeros(shape, dtype=np.float64)
+
+    def add(self, ids_a, ids_b, score):
+        np.add.at(self._scores, (ids_a, ids_b), score)
+
+    def nonzero(self):
+        """Returns the ids and scores of all pairs (id_a < id_b) with a score > 0."""
+        ids_a, ids_b = np.where(np.triu(self._scores, 1) > 0)
+        return ids_a, ids_b, self._scores[ids_a, ids_b]
+
+
+class _SparseScores:
+    """
+    Scores of submission pairs, accumulated as arrays of (encoded) pairs and their scores.
+    Memory scales with the number of matching pairs rather than the number of submissions.
+    """
+    #: Number of pending additions at which they are reduced
+    BATCH_SIZE = 1 << 22
+
+    def __init__(self, shape):
+        self._n_cols = shape[1]
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._scores = np.zeros(0, dtype=np.float64)
+        self._pending = []
+        self._n_pending = 0
+
+    def add(self, ids_a, ids_b, score):
+        # Only pairs with id_a < id_b end up in the result
+        mask = ids_a < ids_b
+        keys = ids_a[mask].astype(np.int64) * self._n_cols + ids_b[mask]
+        scores = np.broadcast_to(np.asarray(score, dtype=np.float64), mask.shape)[mask]
+
+        self._pending.append((keys, scores))
+        self._n_pending += len(keys)
+        if self._n_pending >= self.BATCH_SIZE:
+            self._reduce()
+
+    def nonzero(self):
+        """Returns the ids and scores of all pairs (id_a < id_b) with a score > 0."""
+        self._reduce()
+        mask = self._scores > 0
+        ids_a, ids_b = np.divmod(self._keys[mask], self._n_cols)
+        return ids_a, ids_b, self._scores[mask]
+
+    def _reduce(self):
+        """Sum the scores of identical pairs, keeping them sorted by (id_a, id_b)."""
+        if not self._pending:
+            return
+
+        # Accumulated scores come first, such that scores are summed in the order they were added
+        keys = np.concatenate([self._keys] + [keys for keys, _ in self._pending])
+        scores = np.concatenate([self._scores] + [scores for _, scores in self._pending])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._scores = np.bincount(inverse.ravel(), weights=scores, minlength=len(self._keys))
+        self._pending = []
+        self._n_pending = 0
 
 
 class CompareIndex(Index):
-    def compare(self, other):
-        matches = []
+    """
+    Index from every fingerprint (k-gram) to the spans it comes from. Stored as parallel
+    arrays of hashes and the file id, stretch (see :meth:`include`), start and end of
+    every span, sorted by hash.
+    """
+    def __init__(self, k, hash="rolling"):
+        super().__init__(k, hash)
+        self._hashes = np.zeros(0, dtype=np.int64)
+        self._files = np.zeros(0, dtype=np.int32)
+        self._stretches = np.zeros(0, dtype=np.int32)
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._ends = np.zeros(0, dtype=np.int64)
+        # Arrays that have yet to be merged into the arrays above
+        self._pending = []
+
+    def keys(self):
+        """The distinct hashes in the index, in ascending order."""
+        return np.unique(self._arrays()[0])
+
+    def values(self):
+        """
+        The positions of the spans of every distinct hash (see :meth:`spans`),
+        as arrays in the order of :meth:`keys`.
+        """
+        _, starts, _ = _groups(self._arrays()[0])
+        return np.split(np.arange(len(self._arrays()[0])), starts[1:]) if len(starts) else []
 
-        # Find common fingerprints (hashes)
-        common_hashes = set(self._index) & set(other._index)
-        for hash_ in common_hashes:
-            # All spans associated with fingerprint in self
-            spans_a = self._index[hash_]
-            # All spans associated with fingerprint in other
-            spans_b = other._index[hash_]
-            matches.extend((span_a, span_b)
-                           for span_a, span_b in itertools.product(spans_a, spans_b))
+    def include(self, file, tokens=None, stretch=0):
+        """
+        Fingerprint a file, or a stretch of its tokens, and add it to the index.
+        Fingerprints (and so matches) never straddle stretches.
+        """
+        if tokens is None:
+            tokens = file.tokens(columnar=True)
+        hashes, starts, ends = self._fingerprint_arrays(tokens)
+        self._pending.append((hashes,
+                              np.full(len(hashes), file.id, dtype=np.int32),
+                              np.full(len(hashes), stretch, dtype=np.int32),
+                              starts,
+                              ends))
 
-        return matches
+    def include_all(self, other):
+        self._pending.append(other._arrays())
+        return self
+
+    def ignore_hashes(self, hashes):
+        arrays = self._arrays()
+        keep = ~np.isin(arrays[0], np.asarray(hashes, dtype=np.int64))
+        self._hashes, self._files, self._stretches, self._starts, self._ends = (array[keep] for array in arrays)
+
+    def compare(self, other):
+        """
+        Find all pairs of spans, one from self and one from other, with the same fingerprint.
+        Returns two arrays with the positions of these spans in self and in other,
+        see :meth:`spans`.
+        """
+        hashes_a, starts_a, counts_a = _groups(self._arrays()[0])
+        hashes_b, starts_b, counts_b = _groups(other._arrays()[0])
+
+        # Find common fingerprints (hashes), and where their spans are in both indices
+        _, common_a, common_b = np.intersect1d(hashes_a, hashes_b, assume_unique=True, return_indices=True)
+        starts_a, counts_a = starts_a[common_a], counts_a[common_a]
+        starts_b, counts_b = starts_b[common_b], counts_b[common_b]
+
+        # Every span from self matches every span from other with the same fingerprint
+        sizes = counts_a * counts_b
+        fingerprints = np.repeat(np.arange(len(sizes)), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return (starts_a[fingerprints] + offsets // counts_b[fingerprints],
+                starts_b[fingerprints] + offsets % counts_b[fingerprints])
+
+    def spans(self, positions):
+        """The spans at ``positions``, as arrays of their file ids, stretches, starts and ends."""
+        _, files, stretches, starts, ends = self._arrays()
+        return files[positions], stretches[positions], starts[positions], ends[positions]
 
     def unignored_tokens(self, file, tokens=None):
         if tokens is None:
@@ -313,37 +1138,31 @@ class CompareIndex(Index):
         if not self:
             return [tokens]
 
-        # Create an index of file with same settings as self
-        file_index = CompareIndex(k=self.k)
-        file_index.include(file, tokens=tokens)
-
         # Figure out spans (regions) of the file to ignore
         # Note: these can overlap!
-        ignored_spans = []
-        for hash, spans in file_index._index.items():
-            if hash in self._index:
-                ignored_spans.extend(spans)
+        hashes, starts, ends = self._fingerprint_arrays(tokens)
+        ignored = np.isin(hashes, self.keys())
 
         # Nothing to ignore
-        if not ignored_spans:
+        if not ignored.any():
             return [tokens]
 
         # Find relevant tokens (any token not completely in an ignored_span)
         relevant_token_lists = []
         relevant_tokens = []
-        span_iter = iter(sorted(ignored_spans, key=lambda span: span.start))
-        span = next(span_iter)
+        span_iter = zip(starts[ignored].tolist(), ends[ignored].tolist())
+        span_start, span_end = next(span_iter)
         for i, token in enumerate(tokens):
             # If token comes after span, move on to next span
-            while token.end > span.end:
+            while token.end > span_end:
                 try:
-                    span = next(span_iter)
+                    span_start, span_end = next(span_iter)
                 except StopIteration:
                     relevant_token_lists.append(relevant_tokens + tokens[i:])
                     return relevant_token_lists
 
             # If token starts before the span does, it's relevant
-            if token.start < span.start:
+            if token.start < span_start:
                 relevant_tokens.append(token)
             # If a token is ignored, yield any relevant_tokens so far
             elif relevant_tokens:
@@ -354,19 +1173,43 @@ class CompareIndex(Index):
 
     def fingerprint(self, file, tokens=None):
         if not tokens:
-            tokens = file.tokens()
-            if not tokens:
-                return []
-
-        hashes = self.hashes(tokens)
+            tokens = file.tokens(columnar=True)
 
-        starts = (tok.start for tok in tokens[:-self.k+1])
-        ends = itertools.chain((tok.start for tok in tokens[self.k:]), (tokens[-1].end,))
+        hashes, starts, ends = self._fingerprint_arrays(tokens)
+        return [(hash_, Span(file, start, end))
+                for hash_, start, end in zip(hashes.tolist(), starts.tolist(), ends.tolist())]
 
-        fingerprints = []
-
-        # use all fingerprints instead of sampling
-        for start, end, hash_ in zip(starts, ends, hashes):
-            fingerprints.append((hash_, Span(file, start, end)))
+    def _fingerprint_arrays(self, tokens):
+        """
+        Hash every k-gram of ``tokens`` (all of them, not just a sample), returns
+        arrays of the hashes and the start and end of the k-grams.
+        """
+        hashes = self.hashes(tokens)
+        if not len(hashes):
+            empty = np.zeros(0, dtype=np.int64)
+            return hashes, empty, empty
+
+        # A k-gram spans from its first token up to the token after it (or the end of the last token)
+        if isinstance(tokens, Tokens):
+            token_starts = tokens.starts
+        else:
+            token_starts = np.fromiter((tok.start for tok in tokens), dtype=np.int64, count=len(tokens))
+        starts = token_starts[:len(hashes)]
+        ends = np.append(token_starts[self.k:], tokens[-1].end)
+        return hashes, starts, ends
+
+    def _arrays(self):
+        """Merge any pending fingerprints, then return the arrays of hashes, files, stretches, starts and ends."""
+        if self._pending:
+            arrays = [np.concatenate([array] + [pending[i] for pending in self._pending])
+                      for i, array in enumerate((self._hashes, self._files, self._stretches, self._starts, self._ends))]
+            self._pending = []
+
+            # Sort by hash, keep spans of the same hash in order of insertion
+            order = np.argsort(arrays[0], kind="stable")
+            self._hashes, self._files, self._stretches, self._starts, self._ends = (array[order] for array in arrays)
+
+        return self._hashes, self._files, self._stretches, self._starts, self._ends
 
-        return fingerprints
+    def __bool__(self):
+        return bool(len(self._arrays()[0]))
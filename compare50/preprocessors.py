@@ -1,30 +1,98 @@
+import itertools
 import re
 
 import attr
-from pygments.token import Comment, Name, Number, String, Text, Keyword
-
-from ._data import Token
-
-
+import numpy as np
+from pygments.token import Comment, Text
+
+from ._data import Token, Tokens
+from ._token_types import categories, members, TEXT, NAME, KEYWORD_TYPE, STRING, NUMBER, INTEGER, FLOAT
+
+
+def _maps_tokens(map_token):
+    """
+    Declare that a preprocessor handles every token on its own, as ``map_token(type, val)``
+    does: it returns the new value of a token, or ``None`` to remove the token. A
+    :class:`compare50._data.Preprocessor` fuses runs of such preprocessors into a single
+    mapping over the distinct (type, value) pairs of :class:`compare50.Tokens`.
+    """
+    def decorator(preprocessor):
+        preprocessor.map_token = map_token
+        return preprocessor
+    return decorator
+
+
+def _columnar(columnar):
+    """
+    Declare that ``columnar`` does what a preprocessor does, on the arrays of
+    :class:`compare50.Tokens` rather than on a stream of :class:`compare50.Token`\ s.
+    """
+    def decorator(preprocessor):
+        preprocessor.columnar = columnar
+        return preprocessor
+    return decorator
+
+
+def _split_tokens(tokens, split, type=None):
+    """
+    Split every token of ``tokens`` into the pieces ``split(val)`` returns for its value,
+    as (start, end, val) tuples relative to the start of the token. Every distinct value
+    is split once. The pieces keep the type of their token, unless ``type`` is given.
+    """
+    pieces = [split(val) for val in tokens.value_table]
+    counts = np.fromiter(map(len, pieces), dtype=np.int64, count=len(pieces))
+    pieces = list(itertools.chain.from_iterable(pieces))
+    value_table = {}
+    piece_starts = np.fromiter((start for start, _, _ in pieces), dtype=np.int64, count=len(pieces))
+    piece_ends = np.fromiter((end for _, end, _ in pieces), dtype=np.int64, count=len(pieces))
+    piece_values = np.fromiter((value_table.setdefault(val, len(value_table)) for _, _, val in pieces),
+                               dtype=np.int32, count=len(pieces))
+
+    # Repeat every token once per piece of its value, then find the pieces
+    token_counts = counts[tokens.values]
+    token_index = np.repeat(np.arange(len(tokens)), token_counts)
+    piece_index = np.arange(len(token_index)) - np.repeat(np.cumsum(token_counts) - token_counts, token_counts)
+    pieces = (np.cumsum(counts) - counts)[tokens.values][token_index] + piece_index
+
+    starts = tokens.starts[token_index]
+    if type is None:
+        types, type_table = tokens.types[token_index], tokens.type_table
+    else:
+        types, type_table = np.zeros(len(token_index), dtype=np.int32), [type]
+    return Tokens(starts + piece_starts[pieces], starts + piece_ends[pieces], types, type_table,
+                  piece_values[pieces], list(value_table))
+
+_WORD = re.compile(r'\S+')
+
+
+def _split_on_words(val):
+    if _WORD.fullmatch(val):
+        return [(0, len(val), val)]
+    return [(m.start(), m.end(), m.group(0)) for m in _WORD.finditer(val)]
+
+
+@_maps_tokens(lambda type, val: ("".join(val.split()) if categories[type] & TEXT else val) or None)
 def strip_whitespace(tokens):
     """Remove all whitespace from tokens."""
     for tok in tokens:
         val = tok.val
-        if tok.type in Text:
+        if categories[tok.type] & TEXT:
             val = "".join(tok.val.split())
         if val:
             tok.val = val
             yield tok
 
 
+@_maps_tokens(lambda type, val: "t" if categories[type] & KEYWORD_TYPE else val)
 def normalize_builtin_types(tokens):
     """Normalize builtin type names"""
     for tok in tokens:
-        if tok.type in Keyword.Type:
+        if categories[tok.type] & KEYWORD_TYPE:
             tok.val = "t"
         yield tok
 
 
+@_maps_tokens(lambda type, val: None if type in (Comment.Multiline, Comment.Single, Comment.Hashbang) else val)
 def strip_comments(tokens):
     """Remove all comments from tokens."""
     for tok in tokens:
@@ -32,6 +100,7 @@ def strip_comments(tokens):
             yield tok
 
 
+@_maps_tokens(lambda type, val: val.lower())
 def normalize_case(tokens):
     """Make all tokens lower case."""
     for tok in tokens:
@@ -39,19 +108,44 @@ def normalize_case(tokens):
         yield tok
 
 
+@_maps_tokens(lambda type, val: "v" if categories[type] & NAME else val)
 def normalize_identifiers(tokens):
     """Replace all identifiers with ``v``"""
     for tok in tokens:
-        if tok.type in Name:
+        if categories[tok.type] & NAME:
             tok.val = "v"
         yield tok
 
 
+def _normalize_string_literals(tokens):
+    if len(tokens) == 0:
+        return tokens
+
+    strings = members(tokens.type_table, STRING)[tokens.types]
+    types = tokens.types
+
+    # A string continues the literal before it if it directly follows a string of the same type
+    continues = np.zeros(len(tokens), dtype=bool)
+    continues[1:] = strings[1:] & strings[:-1] & (types[1:] == types[:-1])
+    kept = np.flatnonzero(~continues)
+
+    # Every literal ends where the last string that continues it ends
+    last = np.append(kept[1:], len(tokens)) - 1
+
+    # Like the generator, drop a literal that the stream ends with
+    if len(tokens) and strings[-1]:
+        kept, last = kept[:-1], last[:-1]
+    tokens = Tokens(tokens.starts[kept], tokens.ends[last], types[kept], tokens.type_table,
+                    tokens.values[kept], tokens.value_table)
+    return tokens.replace_values(strings[kept], '""')
+
+
+@_columnar(_normalize_string_literals)
 def normalize_string_literals(tokens):
     """Replace string literals with empty strings."""
     string_token = None
     for tok in tokens:
-        if tok.type in String:
+        if categories[tok.type] & STRING:
             if string_token is None:
                 string_token = attr.evolve(tok, val='""')
             elif tok.type == string_token.type:
@@ -66,29 +160,34 @@ def normalize_string_literals(tokens):
             yield tok
 
 
+@_maps_tokens(lambda type, val: "INT" if categories[type] & INTEGER else
+              "FLOAT" if categories[type] & FLOAT else
+              "NUM" if categories[type] & NUMBER else val)
 def normalize_numeric_literals(tokens):
     """Replace numeric literals with their types."""
     for tok in tokens:
-        if tok.type in Number.Integer:
+        if categories[tok.type] & INTEGER:
             tok.val = "INT"
             yield tok
-        elif tok.type in Number.Float:
+        elif categories[tok.type] & FLOAT:
             tok.val = "FLOAT"
             yield tok
-        elif tok.type in Number:
+        elif categories[tok.type] & NUMBER:
             tok.val = "NUM"
             yield tok
         else:
             yield tok
 
 
+@_maps_tokens(lambda type, val: val if categories[type] & NAME else None)
 def extract_identifiers(tokens):
     """Remove all tokens that don't represent identifiers."""
     for tok in tokens:
-        if tok.type in Name:
+        if categories[tok.type] & NAME:
             yield tok
 
 
+@_columnar(lambda tokens: _split_tokens(tokens, lambda val: [(i, i + 1, c) for i, c in enumerate(val)], type=Text))
 def by_character(tokens):
     """Make a token for each character."""
     for tok in tokens:
@@ -113,6 +212,7 @@ def text_printer(tokens):
         yield tok
 
 
+@_maps_tokens(lambda type, val: val if type == Comment.Single or type == Comment.Multiline else None)
 def comments(tokens):
     """Remove all tokens that aren't comments."""
     for t in tokens:
@@ -120,6 +220,7 @@ def comments(tokens):
             yield t
 
 
+@_columnar(lambda tokens: _split_tokens(tokens, lambda val: _split_on_words(re.sub("[^a-zA-Z'_-]", " ", val))))
 def words(tokens):
     """Split tokens into tokens containing just one word."""
     for t in tokens:
@@ -129,6 +230,7 @@ def words(tokens):
             yield Token(t.start + start, t.start + end, t.type, val)
 
 
+@_columnar(lambda tokens: _split_tokens(tokens, _split_on_words))
 def split_on_whitespace(tokens):
     """Split values of tokens on whitespace into new tokens"""
     for t in tokens:
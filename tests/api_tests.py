@@ -1,9 +1,26 @@
 import unittest
+import bisect
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
 import tempfile
 import os
+import pickle
+import random
+
+import numpy as np
+import pygments.lexers
+import pygments.token
 
 import compare50._data as data
 import compare50._api as api
+import compare50._cache as cache
+import compare50._checkpoint as checkpoint
+import compare50._incremental as incremental
+import compare50._token_types as token_types
+import compare50.preprocessors as preprocessors
+import compare50.passes as passes
 
 class TestCreateSpans(unittest.TestCase):
     pass
@@ -59,6 +76,149 @@ class TestGroupSpans(unittest.TestCase):
         groups = api._group_span_matches(span_matches)
         self.assertEqual(set(groups), {data.Group(spans_1), data.Group(spans_2)})
 
+    def test_long_chain(self):
+        spans = [self.span(i) for i in range(10000)]
+        groups = api._group_span_matches(list(zip(spans, spans[1:])))
+        self.assertEqual(groups, [data.Group(spans)])
+
+
+class TestGroupSpansEquivalence(unittest.TestCase):
+    """The grouping of span matches, against its original (recursive and quadratic) implementation."""
+
+    @staticmethod
+    def transitive_closure(connections):
+        connections_ = collections.defaultdict(set)
+        for a, b in connections:
+            connections_[a].add(b)
+            connections_[b].add(a)
+
+        def traverse(node, visited):
+            visited.add(node)
+            for other_node in connections_[node]:
+                if other_node not in visited:
+                    traverse(other_node, visited)
+            return visited
+
+        trans_closure = []
+        nodes = set(connections_)
+        while nodes:
+            reachable_nodes = traverse(next(iter(nodes)), set())
+            nodes -= reachable_nodes
+            trans_closure.append(reachable_nodes)
+        return trans_closure
+
+    @staticmethod
+    def filter_subsumed_groups(groups):
+        def is_span_subsumed(span, other_spans):
+            return any(span.start >= other.start and span.end <= other.end for other in other_spans)
+
+        def is_group_subsumed(group):
+            for other_group in groups:
+                if other_group == group or len(other_group.spans) < len(group.spans):
+                    continue
+                if all(is_span_subsumed(span, [other for other in other_group.spans if other.file == span.file])
+                       for span in group.spans):
+                    return True
+            return False
+
+        return [group for group in groups if not is_group_subsumed(group)]
+
+    def setUp(self):
+        self.files = data.Submission(".", ["foo", "bar", "baz"]).files
+
+    def random_span_matches(self, rand):
+        spans = []
+        for _ in range(rand.randint(1, 60)):
+            start = rand.randint(0, 50)
+            spans.append(data.Span(rand.choice(self.files), start, start + rand.randint(0, 20)))
+        return [(rand.choice(spans), rand.choice(spans)) for _ in range(rand.randint(1, 40))]
+
+    def test_transitive_closure(self):
+        rand = random.Random(0)
+        for _ in range(300):
+            span_matches = self.random_span_matches(rand)
+            self.assertEqual({frozenset(component) for component in api._transitive_closure(span_matches)},
+                             {frozenset(component) for component in self.transitive_closure(span_matches)})
+
+    def test_filter_subsumed_groups(self):
+        rand = random.Random(0)
+        for _ in range(300):
+            groups = [data.Group(spans) for spans in api._transitive_closure(self.random_span_matches(rand))]
+            self.assertEqual(api._filter_subsumed_groups(groups), self.filter_subsumed_groups(groups))
+
+    def test_identical_and_empty_groups(self):
+        foo, bar = self.files[:2]
+        groups = [data.Group([data.Span(foo, 0, 10)]),
+                  data.Group([data.Span(foo, 0, 10), data.Span(bar, 5, 6)]),
+                  data.Group([data.Span(foo, 0, 10), data.Span(bar, 5, 6)]),
+                  data.Group([data.Span(bar, 0, 10), data.Span(bar, 2, 3)]),
+                  data.Group([])]
+        self.assertEqual(api._filter_subsumed_groups(groups), self.filter_subsumed_groups(groups))
+
+
+class TestCompareIgnoredSpans(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+        api.progress_bar("foo", disable=True)
+
+        self.subs = []
+        for name in ("a", "b", "c"):
+            os.mkdir(name)
+            for file_name in ("foo.py", "bar.py"):
+                with open(os.path.join(name, file_name), "w") as f:
+                    f.write("def foo():\n    # bar\n    return 42\n")
+            self.subs.append(data.Submission(os.path.abspath(name), ["bar.py", "foo.py"],
+                                             preprocessor=data.Preprocessor([preprocessors.strip_comments])))
+
+        files = [file for sub in self.subs for file in sub.files]
+        # Overlapping ignored spans of every file
+        self.ignored_spans = {file: [data.Span(file, 0, 4), data.Span(file, 2, 8), data.Span(file, 30, 32)]
+                              for file in files}
+
+        test = self
+        class Comparator:
+            def compare(self, scores, ignored_files):
+                return [data.Comparison(score.sub_a, score.sub_b, [],
+                                        [span for sub in (score.sub_a, score.sub_b) for file in sub.files
+                                              for span in test.ignored_spans[file]])
+                        for score in scores]
+
+        class Pass:
+            comparator = Comparator()
+
+        self.pass_ = Pass
+        self.scores = [data.Score(sub_a, sub_b, 1) for sub_a, sub_b in itertools.combinations(self.subs, 2)]
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+    def test_ignored_spans(self):
+        results = api.compare(self.scores, set(), self.pass_)
+        for result in results:
+            expected = []
+            for sub in (result.score.sub_a, result.score.sub_b):
+                for file in sub.files:
+                    expected += api._flatten_spans(self.ignored_spans[file] + api.missing_spans(file))
+            self.assertEqual(result.ignored_spans, expected)
+
+    def test_missing_spans_once_per_file(self):
+        missing_spans = api.missing_spans
+        files = []
+        def count(file, *args, **kwargs):
+            files.append(file)
+            return missing_spans(file, *args, **kwargs)
+
+        api.missing_spans = count
+        try:
+            api.compare(self.scores, set(), self.pass_)
+        finally:
+            api.missing_spans = missing_spans
+        self.assertEqual(sorted(files, key=lambda file: file.id),
+                         sorted((file for sub in self.subs for file in sub.files), key=lambda file: file.id))
+
 
 class TestFlatten(unittest.TestCase):
     def span(self, start, end):
@@ -100,6 +260,90 @@ class TestFlatten(unittest.TestCase):
         self.assertEqual(api._flatten_spans([span_1, span_2]), [resulting_span])
 
 
+class TestExpand(unittest.TestCase):
+    def tokens(self, rand, n, alphabet):
+        # Tokens with gaps in between them, as if whitespace were stripped
+        tokens = []
+        start = 0
+        for _ in range(n):
+            val = rand.choice(alphabet)
+            tokens.append(data.Token(start, start + len(val), "Token.Name", val))
+            start += len(val) + rand.randint(0, 2)
+        return tokens
+
+    def kgram_matches(self, tokens_a, tokens_b, k):
+        def spans(tokens):
+            return {i: (tokens[i].start, tokens[i + k].start if i + k < len(tokens) else tokens[-1].end)
+                    for i in range(len(tokens) - k + 1)}
+
+        spans_a, spans_b = spans(tokens_a), spans(tokens_b)
+        return [(spans_a[i], spans_b[j]) for i in spans_a for j in spans_b
+                if tokens_a[i:i + k] == tokens_b[j:j + k]]
+
+    def reference_expand(self, matches, tokens_a, tokens_b):
+        """The original expand, with linear scans instead of interval trees"""
+        starts_a = [tok.start for tok in tokens_a]
+        starts_b = [tok.start for tok in tokens_b]
+        expanded_a, expanded_b, expanded = [], [], set()
+
+        def is_subsumed(start, end, intervals):
+            return any(begin <= start and stop >= end for begin, stop in intervals)
+
+        def expand_side(idx_a, idx_b, step):
+            try:
+                while min(idx_a, idx_b) >= 0 and tokens_a[idx_a] == tokens_b[idx_b]:
+                    idx_a += step
+                    idx_b += step
+            except IndexError:
+                pass
+            return idx_a - step, idx_b - step
+
+        for (start_a, end_a), (start_b, end_b) in sorted(matches):
+            if is_subsumed(start_a, end_a, expanded_a) and is_subsumed(start_b, end_b, expanded_b):
+                continue
+            left_a, left_b = expand_side(bisect.bisect_right(starts_a, start_a) - 2,
+                                         bisect.bisect_right(starts_b, start_b) - 2, -1)
+            right_a, right_b = expand_side(bisect.bisect_right(starts_a, end_a) - 2,
+                                           bisect.bisect_right(starts_b, end_b) - 2, 1)
+            match = (tokens_a[left_a].start, tokens_a[right_a].end, tokens_b[left_b].start, tokens_b[right_b].end)
+            expanded_a.append(match[:2])
+            expanded_b.append(match[2:])
+            expanded.add(match)
+        return expanded
+
+    def test_identical_to_reference(self):
+        rand = random.Random(0)
+        for i in range(200):
+            k = rand.randint(2, 4)
+            alphabet = ["a", "bb", "ccc", "d"][:rand.randint(1, 4)]
+            tokens_a = self.tokens(rand, rand.randint(1, 60), alphabet)
+            tokens_b = self.tokens(rand, rand.randint(1, 60), alphabet)
+            matches = self.kgram_matches(tokens_a, tokens_b, k)
+            if not matches:
+                continue
+
+            with self.subTest(i=i):
+                starts_a, ends_a, starts_b, ends_b = (np.array(offsets, dtype=np.int64) for offsets in
+                                                      zip(*((a[0], a[1], b[0], b[1]) for a, b in matches)))
+                expanded = api._expand(starts_a, ends_a, starts_b, ends_b, tokens_a, tokens_b)
+                self.assertEqual(len(expanded), len(set(expanded)))
+                self.assertEqual(set(expanded), self.reference_expand(matches, tokens_a, tokens_b))
+
+    def test_long_runs(self):
+        tokens = self.tokens(random.Random(0), 5000, ["a", "bb", "ccc", "d", "e", "f"])
+        expanded = api._expand(np.array([tokens[2500].start]), np.array([tokens[2503].start]),
+                               np.array([tokens[2500].start]), np.array([tokens[2503].start]), tokens, tokens)
+        self.assertEqual(expanded, [(0, tokens[-1].end, 0, tokens[-1].end)])
+
+    def test_expand_spans(self):
+        file = data.Submission(".", ["bar/foo"]).files[0]
+        tokens = self.tokens(random.Random(0), 10, ["a", "b"])
+        span_matches = [(data.Span(file, tokens[3].start, tokens[5].start), data.Span(file, tokens[3].start, tokens[5].start))]
+        self.assertEqual(api.expand(span_matches, tokens, tokens),
+                         [(data.Span(file, 0, tokens[-1].end), data.Span(file, 0, tokens[-1].end))])
+        self.assertEqual(api.expand([], tokens, tokens), [])
+
+
 class TestMissingSpans(unittest.TestCase):
     def setUp(self):
         self.working_directory = tempfile.TemporaryDirectory()
@@ -162,5 +406,455 @@ class TestMissingSpans(unittest.TestCase):
         self.assertEqual(spans, [resulting_span])
 
 
+class TestTokens(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n"
+                    "    print('qux', 42)  # baz\n")
+
+        preprocessor = data.Preprocessor([preprocessors.strip_whitespace, preprocessors.normalize_identifiers])
+        self.file = data.Submission(os.path.abspath("."), ["foo.py"], preprocessor=preprocessor).files[0]
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+    @staticmethod
+    def fields(tokens):
+        return [(tok.start, tok.end, tok.type, tok.val) for tok in tokens]
+
+    def test_columnar_identical_to_tokens(self):
+        tokens = self.file.unprocessed_tokens(columnar=True)
+        self.assertIsInstance(tokens, data.Tokens)
+        self.assertEqual(self.fields(tokens), self.fields(self.file.unprocessed_tokens()))
+        self.assertEqual(self.fields(tokens[2:5]), self.fields(list(tokens)[2:5]))
+        self.assertEqual(self.fields([tokens[-1]]), self.fields(list(tokens)[-1:]))
+        self.assertEqual(self.fields(data.Tokens.from_tokens(list(tokens))), self.fields(tokens))
+
+        # The preprocessor runs fused on Tokens
+        preprocessed = self.file.tokens(columnar=True)
+        self.assertIsInstance(preprocessed, data.Tokens)
+        self.assertEqual(self.fields(preprocessed), self.fields(self.file.tokens()))
+
+    def test_empty_file(self):
+        with open("empty.py", "w"):
+            pass
+        tokens = data.Submission(".", ["empty.py"]).files[0].unprocessed_tokens(columnar=True)
+        self.assertEqual(len(tokens), 0)
+        self.assertEqual({len(column) for column in (tokens.starts, tokens.ends, tokens.types, tokens.values)}, {0})
+
+    def test_tokens_are_new(self):
+        tokens = self.file.unprocessed_tokens(columnar=True)
+        expected = self.fields(tokens)
+        for tok in tokens:
+            tok.val = "foo"
+        self.assertEqual(self.fields(tokens), expected)
+
+    def test_pickle(self):
+        tokens = self.file.unprocessed_tokens(columnar=True)
+        unpickled = pickle.loads(pickle.dumps(tokens))
+        self.assertEqual(self.fields(unpickled), self.fields(tokens))
+        # Pygments token types are singletons
+        self.assertTrue(all(a.type is b.type for a, b in zip(unpickled, tokens)))
+
+    def test_bulk_operations(self):
+        from pygments.token import Name
+        tokens = self.file.unprocessed_tokens(columnar=True)
+        names = tokens.mask(Name)
+        self.assertEqual(names.tolist(), [tok.type in Name for tok in tokens])
+        self.assertEqual(self.fields(tokens.select(names)), [f for f in self.fields(tokens) if f[2] in Name])
+        self.assertEqual(tokens.replace_values(names, "v").vals(),
+                         ["v" if tok.type in Name else tok.val for tok in tokens])
+        self.assertEqual(tokens.vals(), [tok.val for tok in tokens])
+
+    def test_expand_tokens(self):
+        tokens = self.file.unprocessed_tokens()
+        span_matches = [(data.Span(self.file, tokens[i].start, tokens[i + 2].start),
+                         data.Span(self.file, tokens[i].start, tokens[i + 2].start)) for i in (0, 3)]
+        self.assertEqual(sorted(api.expand(span_matches, tokens, tokens), key=repr),
+                         sorted(api.expand(span_matches, data.Tokens.from_tokens(tokens), tokens), key=repr))
+
+
+class TestLexers(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+        self._lexer_cache = data.File._lexer_cache
+        self._guessed_lexers = data.File._guessed_lexers
+        data.File._lexer_cache = {}
+        data.File._guessed_lexers = {}
+        api.progress_bar("foo", disable=True)
+
+        contents = {"Makefile": "all:\n\tcc -o foo foo.c\n",
+                    "README": "",
+                    "foo": "#!/usr/bin/env python3\nprint('bar')\n",
+                    "bar": "#!/usr/bin/env python3\nprint('bar')\n",
+                    "foo.c": "int main(void) {}\n"}
+        for name, content in contents.items():
+            with open(name, "w") as f:
+                f.write(content)
+        self.files = {file.name.name: file for file in data.Submission(os.path.abspath("."), sorted(contents)).files}
+
+    def tearDown(self):
+        data.File._lexer_cache = self._lexer_cache
+        data.File._guessed_lexers = self._guessed_lexers
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+    def test_files_without_extension(self):
+        self.assertEqual(self.files["Makefile"].lexer().name, "Makefile")
+        self.assertEqual(self.files["README"].lexer().name, "Text only")
+
+    def test_guesses_are_cached(self):
+        self.assertEqual(self.files["foo"].lexer().name, "Python")
+
+        guess_lexer = pygments.lexers.guess_lexer
+        def guess(*args, **kwargs):
+            raise AssertionError("guessed the same contents twice")
+        pygments.lexers.guess_lexer = guess
+        try:
+            self.assertEqual(self.files["bar"].lexer().name, "Python")
+        finally:
+            pygments.lexers.guess_lexer = guess_lexer
+
+    def test_guess_lexers(self):
+        n_guessed, seconds = api.guess_lexers(list(self.files.values()))
+        self.assertEqual(n_guessed, 3)
+        self.assertGreaterEqual(seconds, 0)
+        self.assertEqual(len(data.File._guessed_lexers), 2)
+        self.assertEqual(self.files["foo"].lexer().name, "Python")
+
+    def test_lexer_map(self):
+        lexers = {".c": "cpp", "foo": "ruby"}
+        files = {file.name.name: file for file in data.Submission(os.path.abspath("."), sorted(self.files),
+                                                                  lexers=lexers).files}
+        self.assertEqual(files["foo.c"].lexer().name, "C++")
+        self.assertEqual(files["foo"].lexer().name, "Ruby")
+        self.assertEqual(self.files["foo.c"].lexer().name, "C")
+
+    def test_lexer_map_in_spawned_workers(self):
+        # Workers that are not forked do not share our state, so the lexers go along with the submission
+        file = data.Submission(os.path.abspath("."), ["foo.c"], preprocessor=data.Preprocessor([]),
+                               lexers={".c": "cpp"}).files[0]
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            tokens, = executor.map(data.File.unprocessed_tokens, [file])
+        self.assertEqual(list(tokens), file.unprocessed_tokens())
+
+
+class TestTokenTypes(unittest.TestCase):
+    def test_categories_identical_to_hierarchy(self):
+        for type in pygments.token.STANDARD_TYPES:
+            for bit, category in token_types.CATEGORIES.items():
+                self.assertEqual(bool(token_types.categories[type] & bit), type in category)
+
+    def test_members(self):
+        type_table = list(pygments.token.STANDARD_TYPES)
+        self.assertEqual(token_types.members(type_table, token_types.STRING).tolist(),
+                         [type in pygments.token.String for type in type_table])
+        self.assertEqual(token_types.members([], token_types.STRING).tolist(), [])
+
+
+class TestFusedPreprocessor(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+        with open("foo.c", "w") as f:
+            f.write("#include <stdio.h>\n"
+                    "/* Prints a grteeting */\n"
+                    "int main(void)\n"
+                    "{\n"
+                    "    unsigned long n = 0x2a + 4.2e1; // Don't panic\n"
+                    "    char c = 'c';\n"
+                    "    printf(\"hello, %s\\n\", \"world\" \"!\");\n"
+                    "}\n")
+        with open("foo.py", "w") as f:
+            f.write("#!/usr/bin/env python3\n"
+                    "def bar(baz):  # qux\n"
+                    "    return f'{baz}' + \"\"\"quux\"\"\" + 1j\n"
+                    "\n"
+                    "print(bar('corge'))\n"
+                    "s = 'grault'")
+
+        self.files = data.Submission(os.path.abspath("."), ["foo.c", "foo.py"]).files
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+    @staticmethod
+    def fields(tokens):
+        return [(tok.start, tok.end, tok.type, tok.val) for tok in tokens]
+
+    def assertFusedIdentical(self, preprocessor):
+        for file in self.files:
+            tokens = file.unprocessed_tokens(columnar=True)
+            fused = preprocessor(tokens)
+            self.assertIsInstance(fused, data.Tokens)
+            self.assertEqual(self.fields(fused), self.fields(preprocessor(list(tokens))))
+
+    def test_passes(self):
+        for pass_ in (passes.structure, passes.text, passes.exact, passes.nocomments, passes.misspellings):
+            self.assertFusedIdentical(data.Preprocessor(pass_.preprocessors))
+
+    def test_preprocessors(self):
+        for name in ("strip_whitespace", "normalize_builtin_types", "strip_comments", "normalize_case",
+                     "normalize_identifiers", "normalize_string_literals", "normalize_numeric_literals",
+                     "extract_identifiers", "by_character", "comments", "words", "split_on_whitespace"):
+            self.assertFusedIdentical(data.Preprocessor([getattr(preprocessors, name)]))
+
+        self.assertFusedIdentical(data.Preprocessor([preprocessors.by_character, preprocessors.strip_whitespace,
+                                                     preprocessors.normalize_case]))
+
+    def test_empty_files(self):
+        with open("empty.py", "w"):
+            pass
+        with open("comment.py", "w") as f:
+            f.write("# just a comment")
+
+        self.files = data.Submission(os.path.abspath("."), ["empty.py", "comment.py"]).files
+        self.assertFusedIdentical(data.Preprocessor(passes.structure.preprocessors))
+
+    def test_falls_back_to_token_streams(self):
+        def strip_odd(tokens):
+            return (tok for i, tok in enumerate(tokens) if i % 2 == 0)
+
+        preprocessor = data.Preprocessor([preprocessors.strip_whitespace, strip_odd, preprocessors.normalize_identifiers])
+        for file in self.files:
+            tokens = file.unprocessed_tokens(columnar=True)
+            self.assertEqual(self.fields(preprocessor(tokens)), self.fields(preprocessor(list(tokens))))
+
+    def test_missing_spans(self):
+        preprocessor = data.Preprocessor(passes.structure.preprocessors)
+        for file in data.Submission(os.path.abspath("."), ["foo.c", "foo.py"], preprocessor=preprocessor).files:
+            original_tokens = file.unprocessed_tokens()
+            processed_tokens = file.submission.preprocessor(list(original_tokens))
+            self.assertEqual(api.missing_spans(file),
+                             api.missing_spans(file, original_tokens=original_tokens, processed_tokens=processed_tokens))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n"
+                    "    print('qux')  # baz\n")
+
+        self.file = data.Submission(os.path.abspath("."), ["foo.py"],
+                                    preprocessor=data.Preprocessor([preprocessors.normalize_identifiers])).files[0]
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+    def lex(self, *args):
+        raise AssertionError("file should not be lexed again")
+
+    def test_tokens_are_identical(self):
+        expected = self.file.unprocessed_tokens()
+        with cache.cache_tokens():
+            for _ in range(2):
+                tokens = self.file.unprocessed_tokens()
+                self.assertEqual([(t.start, t.end, t.type, t.val) for t in tokens],
+                                 [(t.start, t.end, t.type, t.val) for t in expected])
+                # Pygments token types are singletons
+                self.assertTrue(all(a.type is b.type for a, b in zip(tokens, expected)))
+        self.assertIsNone(data.File._token_cache)
+
+    def test_cache_hit_skips_lexing(self):
+        with cache.cache_tokens():
+            expected = self.file.tokens()
+            original, data.File._lex = data.File._lex, self.lex
+            try:
+                self.assertEqual(self.file.tokens(), expected)
+                self.assertEqual(api.missing_spans(self.file), api.missing_spans(self.file))
+            finally:
+                data.File._lex = original
+
+    def test_preprocessors_do_not_alter_cached_tokens(self):
+        with cache.cache_tokens():
+            expected = self.file.unprocessed_tokens()
+            self.file.tokens()
+            self.assertEqual(self.file.unprocessed_tokens(), expected)
+
+    def test_evicted_tokens_are_read_from_disk(self):
+        with cache.cache_tokens(max_memory=0) as token_cache:
+            expected = self.file.unprocessed_tokens()
+            self.assertEqual(len(token_cache._memory), 0)
+            original, data.File._lex = data.File._lex, self.lex
+            try:
+                self.assertEqual(self.file.unprocessed_tokens(), expected)
+            finally:
+                data.File._lex = original
+
+    def test_memory_is_split_between_processes(self):
+        with cache.cache_tokens(max_memory=1000, processes=4) as token_cache:
+            self.assertEqual(token_cache.max_memory, 250)
+
+    def test_shared_with_workers(self):
+        with cache.cache_tokens():
+            with api.Executor() as executor:
+                expected, = executor.map(data.File.unprocessed_tokens, [self.file])
+            original, data.File._lex = data.File._lex, self.lex
+            try:
+                self.assertEqual(self.file.unprocessed_tokens(), expected)
+            finally:
+                data.File._lex = original
+
+
+class TestIncrementalState(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.working_directory.name, "results")
+        self.subs = [data.Submission(os.path.join(self.working_directory.name, name), [])
+                     for name in ("a", "b", "c")]
+        a, b, c = self.subs
+        self.scores = [data.Score(a, b, 3.0), data.Score(a, c, 2.0)]
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+
+    def save(self, scores):
+        state = incremental.State(self.dest, ["winnowing"], ["distro.c"], scores=scores)
+        for id, score in enumerate(scores, 1):
+            state.pages[(score.sub_a, score.sub_b)] = (id, len(scores))
+            state.contents[(score.sub_a, score.sub_b)] = (["winnowing"], [f"match {id}"], [])
+        incremental.save(state)
+
+    def test_round_trip(self):
+        self.assertFalse(incremental.exists(self.dest))
+        self.save(self.scores)
+        self.assertTrue(incremental.exists(self.dest))
+
+        state = incremental.load(self.dest, self.subs)
+        self.assertEqual((state.passes, state.distro), (["winnowing"], ["distro.c"]))
+        self.assertEqual([(s.sub_a, s.sub_b, s.score) for s in state.scores],
+                         [(s.sub_a, s.sub_b, s.score) for s in self.scores])
+        a, b, c = self.subs
+        self.assertEqual(state.pages, {(a, b): (1, 2), (a, c): (2, 2)})
+        self.assertEqual(state.contents[(a, c)], (["winnowing"], ["match 2"], []))
+        self.assertEqual(state.contents.changed, set())
+
+    def test_pages_of_dropped_pairs_are_removed(self):
+        self.save(self.scores)
+        self.save(self.scores[:1])
+        self.assertEqual(len(os.listdir(os.path.join(self.dest, incremental.STATE_DIR, "pages"))), 1)
+        state = incremental.load(self.dest, self.subs)
+        with self.assertRaises(FileNotFoundError):
+            state.contents[(self.scores[1].sub_a, self.scores[1].sub_b)]
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+        api.progress_bar("foo", disable=True)
+
+        for name in ("a", "b", "c"):
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                for i in range(10):
+                    f.write(f"def foo{i}(bar):\n    return [bar, bar + {i}, bar * 2]\n")
+        self.preprocessor = data.Preprocessor(passes.structure.preprocessors)
+        self.subs = [data.Submission(os.path.abspath(name), ["foo.py"], preprocessor=self.preprocessor)
+                     for name in ("a", "b", "c")]
+
+    def tearDown(self):
+        os.chdir(self._wd)
+        self.working_directory.cleanup()
+
+    def checkpoint(self, settings={"n": 2}):
+        point = checkpoint.Checkpoint("results", settings)
+        point.submissions = self.subs
+        return point
+
+    def test_inventory(self):
+        point = self.checkpoint()
+        point.start()
+        self.assertEqual(point.inventory(lambda: (self.subs, [], []), self.preprocessor), (self.subs, [], []))
+
+        # Recreated submissions refer to the same files
+        subs, archive_subs, ignored_subs = point.inventory(lambda: self.fail("not resumed"), self.preprocessor)
+        self.assertEqual(([sub.path for sub in subs], archive_subs, ignored_subs),
+                         ([sub.path for sub in self.subs], [], []))
+        self.assertEqual([sub.files for sub in subs], [sub.files for sub in self.subs])
+
+    def test_compare_is_resumed(self):
+        point = self.checkpoint()
+        point.start()
+        scores = point.scores(lambda: api.rank(self.subs, [], set(), passes.structure, n=2))
+        self.assertEqual(point.scores(lambda: self.fail("not resumed")), scores)
+
+        original = checkpoint.Checkpoint.BATCH_SIZE
+        checkpoint.Checkpoint.BATCH_SIZE = 1
+        try:
+            expected = point.compare(scores, set(), passes.structure)
+            os.remove(os.path.join(point.path, f"{passes.structure.__name__}_1.pickle"))
+
+            # Only the second batch is compared again
+            compared = []
+            def compare(scores, *args):
+                compared.append(scores)
+                return original_compare(scores, *args)
+            original_compare, api.compare = api.compare, compare
+            try:
+                results = point.compare(scores, set(), passes.structure)
+            finally:
+                api.compare = original_compare
+            self.assertEqual(compared, [scores[1:]])
+        finally:
+            checkpoint.Checkpoint.BATCH_SIZE = original
+
+        self.assertEqual([(r.sub_a, r.sub_b, r.score, r.groups, r.ignored_spans) for r in results],
+                         [(r.sub_a, r.sub_b, r.score, r.groups, r.ignored_spans) for r in expected])
+        self.assertTrue(all(r.sub_a in self.subs and r.sub_b in self.subs for r in results))
+
+    def test_pages(self):
+        point = self.checkpoint()
+        point.start()
+        pages = point.pages()
+        a, b, c = self.subs
+        pages[(a, b)] = (1, 2)
+        pages[(a, c)] = (2, 2)
+        with open(os.path.join(point.path, "pages"), "a") as f:
+            f.write("[0, ")
+        self.assertEqual(point.pages(), {(a, b): (1, 2), (a, c): (2, 2)})
+
+    def test_settings_must_match(self):
+        self.assertFalse(self.checkpoint().exists())
+        self.checkpoint().start()
+        self.assertTrue(self.checkpoint().exists())
+        self.checkpoint().resume()
+        with self.assertRaises(api.Error):
+            self.checkpoint({"n": 3}).resume()
+
+    def test_remove(self):
+        point = self.checkpoint()
+        point.start()
+        point.remove()
+        self.assertFalse(point.exists())
+        self.assertFalse(os.path.exists(os.path.join("results", incremental.STATE_DIR)))
+
+    def test_disabled(self):
+        point = checkpoint.Checkpoint(None, {})
+        point.start()
+        self.assertFalse(point.exists())
+        self.assertEqual(point.scores(lambda: [1]), [1])
+        self.assertIsNone(point.pages())
+        self.assertFalse(os.path.exists("results"))
+
+
 if __name__ == '__main__':
     unittest.main()
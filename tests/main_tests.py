@@ -1,9 +1,14 @@
 import unittest
 import tempfile
 import zipfile
+import argparse
 import os
+
+import lib50
+
 import compare50.__main__ as main
 import compare50._api as api
+import compare50._cache as cache
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -110,6 +115,83 @@ class TestSubmissionFactory(TestCase):
         subs = {sub for sub in subs if sub.files}
         self.assertEqual(subs, set())
 
+    def test_text_is_read_once(self):
+        preprocessor = lambda tokens : tokens
+        os.mkdir("foo")
+        with open("foo/bar.py", "wb") as f:
+            f.write(b"foo\r\nbar\rbaz\n")
+        with open("foo/bar.py") as f:
+            expected = f.read()
+
+        with cache.cache_texts():
+            sub, = self.factory.get_all(["foo"], preprocessor)
+            os.remove("foo/bar.py")
+            self.assertEqual(sub.files[0].read(), expected)
+            self.assertEqual(sub.files[0].read(3), expected[:3])
+
+    def test_large_files(self):
+        preprocessor = lambda tokens : tokens
+        os.mkdir("foo")
+        with open("foo/small.py", "w") as f:
+            f.write("foo")
+        with open("foo/large.py", "w") as f:
+            f.write("foo" * 10)
+        with open("foo/large.bin", "wb") as f:
+            f.write(b"\x80" * 10)
+
+        self.factory.max_file_size = 10
+        sub, = self.factory.get_all(["foo"], preprocessor)
+        self.assertEqual([str(f.name) for f in sub.files], ["small.py"])
+        self.assertEqual([str(f) for f in sub.large_files], ["large.py"])
+        self.assertEqual([str(f) for f in sub.undecodable_files], ["large.bin"])
+
+    def test_single_file_identical_to_lib50(self):
+        preprocessor = lambda tokens : tokens
+        names = ["foo.py", "foo.c", ".foo.py", "foo"]
+        patterns = [[], [("exclude", "*")], [("exclude", "*"), ("include", "*.py")],
+                    [("exclude", "**/*.py")], [("exclude", "*"), ("include", "./foo.py")],
+                    [("include", ".*")], [("exclude", "foo.py/")], [("exclude", "[f]oo*")]]
+        for i, name in enumerate(names):
+            os.mkdir(str(i))
+            with open(os.path.join(str(i), name), "w") as f:
+                f.write("foo")
+        for tagged in patterns:
+            with self.subTest(patterns=tagged):
+                factory = main.SubmissionFactory()
+                for tag, pattern in tagged:
+                    getattr(factory, tag)(pattern)
+                subs = factory.get_all([os.path.join(str(i), name) for i, name in enumerate(names)], preprocessor)
+                for sub in subs:
+                    included, _ = lib50.files(factory.patterns, root=sub.path)
+                    self.assertEqual([str(f.name) for f in sub.files], sorted(included))
+
+    def test_outside_current_directory(self):
+        preprocessor = lambda tokens : tokens
+        os.mkdir("foo")
+        with open("foo/bar.py", "w") as f:
+            f.write("foo")
+        self.factory.exclude("../bar.py")
+        for path in ("foo", "foo/bar.py"):
+            with self.subTest(path=path), self.assertRaises(lib50.Error):
+                self.factory.get_all([path], preprocessor)
+
+
+class TestLexerMapping(unittest.TestCase):
+    def test_extension(self):
+        ext, lexer = main.lexer_mapping(".h=c")
+        self.assertEqual(ext, ".h")
+        self.assertEqual(lexer.name, "C")
+
+    def test_file_name(self):
+        name, lexer = main.lexer_mapping("Makefile=make")
+        self.assertEqual(name, "Makefile")
+        self.assertEqual(lexer.name, "Makefile")
+
+    def test_invalid(self):
+        for value in ("c", ".h", "=c", ".h=foo"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                main.lexer_mapping(value)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+import tempfile
+import itertools
+import os
+import random
+import sys
+
+import numpy as np
+
+import compare50.comparators._suffix_array as suffix_array
+import compare50.comparators._winnowing as winnowing
+import compare50._api as api
+import compare50._data as data
+import compare50.preprocessors as preprocessors
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+class TestMaximalMatches(unittest.TestCase):
+    @staticmethod
+    def maximal_matches(stretches_a, stretches_b, min_length):
+        """Every maximal run, by trying every pair of positions."""
+        matches = set()
+        for (file_a, codes_a, starts_a, ends_a), (file_b, codes_b, starts_b, ends_b) \
+                in itertools.product(stretches_a, stretches_b):
+            for i, j in itertools.product(range(len(codes_a)), range(len(codes_b))):
+                if i > 0 and j > 0 and codes_a[i - 1] == codes_b[j - 1]:
+                    continue
+                length = 0
+                while i + length < len(codes_a) and j + length < len(codes_b) \
+                        and codes_a[i + length] == codes_b[j + length]:
+                    length += 1
+                if length >= min_length:
+                    matches.add((file_a, int(starts_a[i]), int(ends_a[i + length - 1]),
+                                 file_b, int(starts_b[j]), int(ends_b[j + length - 1])))
+        return matches
+
+    def test_identical_to_brute_force(self):
+        rand = random.Random(0)
+
+        def stretches(file):
+            result = []
+            offset = 0
+            for _ in range(rand.randint(0, 3)):
+                n = rand.randint(0, 30)
+                starts = offset + np.arange(n, dtype=np.int64) * 2
+                offset += 2 * n + 1
+                result.append((file, np.array([rand.choice([-1, 7]) for _ in range(n)], dtype=np.int64),
+                               starts, starts + 1))
+            return result
+
+        for _ in range(200):
+            stretches_a, stretches_b = stretches(1), stretches(2)
+            min_length = rand.randint(1, 4)
+            matches = suffix_array._maximal_matches(stretches_a, stretches_b, min_length)
+            self.assertEqual(len(matches), len(set(matches)))
+            self.assertEqual(set(matches), self.maximal_matches(stretches_a, stretches_b, min_length))
+
+    def test_no_tokens(self):
+        empty = np.zeros(0, dtype=np.int64)
+        self.assertEqual(suffix_array._maximal_matches([], [], 1), [])
+        self.assertEqual(suffix_array._maximal_matches([(1, empty, empty, empty)], [], 1), [])
+
+class TestCompare(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True)
+        preprocessor = data.Preprocessor([preprocessors.strip_whitespace])
+
+        distro = "def main():\n    print('hello, world')\n"
+        shared = "def foo(bar):\n    return [bar, bar + 1, bar * 2]\n"
+        contents = {"a": {"foo.py": distro + shared, "bar.py": shared + "x = 1\n"},
+                    "b": {"foo.py": shared + distro + "y = 2\n"},
+                    "c": {"foo.py": distro + "while True:\n    pass\n" + shared},
+                    "d": {"foo.py": shared + distro + shared}}
+
+        os.mkdir("distro")
+        with open(os.path.join("distro", "foo.py"), "w") as f:
+            f.write(distro)
+        self.ignored_files = set(data.Submission(os.path.abspath("distro"), ["foo.py"], preprocessor=preprocessor).files)
+
+        self.subs = []
+        for name, files in contents.items():
+            os.mkdir(name)
+            for file_name, content in files.items():
+                with open(os.path.join(name, file_name), "w") as f:
+                    f.write(content)
+            self.subs.append(data.Submission(os.path.abspath(name), sorted(files), preprocessor=preprocessor))
+
+        self.scores = [data.Score(sub_a, sub_b, 1) for sub_a, sub_b in itertools.combinations(self.subs, 2)]
+        self.comparator = suffix_array.SuffixArray(2, scorer=winnowing.Winnowing(k=2, t=3))
+
+    def compare(self, comparator):
+        comparisons = comparator.compare(self.scores, self.ignored_files)
+        return [(c.sub_a, c.sub_b,
+                 sorted((a.file.id, a.start, a.end, b.file.id, b.start, b.end) for a, b in c.span_matches),
+                 sorted((span.file.id, span.start, span.end) for span in c.ignored_spans))
+                for c in comparisons]
+
+    def test_parallel_identical_to_serial(self):
+        comparisons = self.compare(self.comparator)
+        self.assertTrue(all(span_matches and ignored_spans for _, _, span_matches, ignored_spans in comparisons))
+
+        executor = api.Executor
+        api.Executor = api.FauxExecutor
+        try:
+            self.assertEqual(self.compare(self.comparator), comparisons)
+        finally:
+            api.Executor = executor
+
+    def test_winnowing_matches_are_found(self):
+        comparisons = self.compare(self.comparator)
+        for (_, _, matches, ignored_spans), (_, _, winnowing_matches, winnowing_ignored_spans) \
+                in zip(comparisons, self.compare(winnowing.Winnowing(k=2, t=3))):
+            self.assertEqual(ignored_spans, winnowing_ignored_spans)
+            # Every expanded match is part of a maximal match
+            for file_a, start_a, end_a, file_b, start_b, end_b in winnowing_matches:
+                self.assertTrue(any(file_a == f_a and file_b == f_b and s_a <= start_a and end_a <= e_a
+                                    and s_b <= start_b and end_b <= e_b
+                                    for f_a, s_a, e_a, f_b, s_b, e_b in matches))
+
+    def test_matches_do_not_straddle_ignored_spans(self):
+        for comparison in self.comparator.compare(self.scores, self.ignored_files):
+            for span_a, span_b in comparison.span_matches:
+                self.assertNotIn("hello, world", span_a._raw_contents())
+                self.assertNotIn("hello, world", span_b._raw_contents())
+
+    def test_scores_of_scorer(self):
+        scores = self.comparator.score(self.subs, [], self.ignored_files)
+        self.assertEqual(sorted(scores), sorted(self.comparator.scorer.score(self.subs, [], self.ignored_files)))
+        self.assertEqual(self.comparator.top_scores(self.subs, [], self.ignored_files, 2),
+                         self.comparator.scorer.top_scores(self.subs, [], self.ignored_files, 2))
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    unittest.TextTestRunner(verbosity=2).run(suite)
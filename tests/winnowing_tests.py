@@ -1,10 +1,23 @@
 import unittest
+import unittest.mock
 import tempfile
+import collections
+import heapq
+import itertools
+import math
 import os
+import pathlib
+import random
+import subprocess
 import sys
 
+import numpy as np
+
 import compare50.comparators._winnowing as winnowing
+import compare50._api as api
+import compare50._cache as cache
 import compare50._data as data
+import compare50.preprocessors as preprocessors
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -58,6 +71,551 @@ class TestCompareIndexIgnoreTokens(TestCase):
         self.assertEqual(relevant_token_lists[0], expected_tokens)
 
 
+class TestScoreIndexFingerprint(unittest.TestCase):
+    FILES = pathlib.Path(__file__).parent / "files"
+
+    @staticmethod
+    def loop_fingerprint(index, file):
+        """The original (circular buffer) implementation of robust winnowing."""
+        fingerprints = []
+        buf = [(math.inf, None)] * index.w
+        min_idx = 0
+        for hash_, idx in zip(index.hashes(file.tokens()), itertools.cycle(range(index.w))):
+            buf[idx] = hash_, file.submission.id
+            if min_idx == idx:
+                for j in range(1, index.w):
+                    search_idx = (idx - j) % index.w
+                    if buf[search_idx][0] < buf[min_idx][0]:
+                        min_idx = search_idx
+                fingerprints.append(buf[min_idx])
+            else:
+                if buf[idx][0] < buf[min_idx][0]:
+                    min_idx = idx
+                    fingerprints.append(buf[min_idx])
+        return fingerprints
+
+    def test_identical_to_loop(self):
+        for path in sorted(self.FILES.glob("*/*.py")):
+            file = data.Submission(path.parent, [path.name]).files[0]
+            for k, t in ((1, 1), (2, 3), (3, 8), (5, 20), (25, 35)):
+                with self.subTest(file=path.name, k=k, t=t):
+                    index = winnowing.ScoreIndex(k, t)
+                    self.assertEqual(index.fingerprint(file), self.loop_fingerprint(index, file))
+
+
+class TestScoreIndexCompare(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True)
+        files = [data.Submission(str(i), ["foo"]).files[0] for i in range(20)]
+
+        rand = random.Random(0)
+        self.index_a = winnowing.ScoreIndex(2, 3)
+        self.index_b = winnowing.ScoreIndex(2, 3)
+        for index in (self.index_a, self.index_b):
+            for file in files:
+                index.include_hashes(file, [hash_ for hash_ in range(100) if rand.random() < 0.15])
+
+    def compare(self, max_dense_size, batch_size=winnowing._SparseScores.BATCH_SIZE):
+        original = winnowing.ScoreIndex.MAX_DENSE_SIZE, winnowing._SparseScores.BATCH_SIZE
+        winnowing.ScoreIndex.MAX_DENSE_SIZE, winnowing._SparseScores.BATCH_SIZE = max_dense_size, batch_size
+        try:
+            scores = self.index_a.compare(self.index_b, score=lambda h: 1 + h % 3)
+        finally:
+            winnowing.ScoreIndex.MAX_DENSE_SIZE, winnowing._SparseScores.BATCH_SIZE = original
+        return [(s.sub_a.id, s.sub_b.id, s.score) for s in scores]
+
+    def test_sparse_identical_to_dense(self):
+        dense = self.compare(max_dense_size=1 << 24)
+        self.assertTrue(dense)
+        self.assertTrue(all(id_a < id_b and score > 0 for id_a, id_b, score in dense))
+        self.assertEqual(self.compare(max_dense_size=0), dense)
+        self.assertEqual(self.compare(max_dense_size=0, batch_size=7), dense)
+
+    def test_batches_identical(self):
+        expected = self.compare(max_dense_size=1 << 24)
+        original = winnowing.ScoreIndex.BATCH_SIZE
+        try:
+            for batch_size in (1, 5, 100):
+                winnowing.ScoreIndex.BATCH_SIZE = batch_size
+                self.assertEqual(self.compare(max_dense_size=1 << 24), expected)
+        finally:
+            winnowing.ScoreIndex.BATCH_SIZE = original
+
+    def test_values(self):
+        hashes, ids = self.index_a._arrays()
+        expected = collections.defaultdict(set)
+        for hash_, id in zip(hashes.tolist(), ids.tolist()):
+            expected[hash_].add(id)
+        self.assertTrue(expected)
+        self.assertEqual({hash_: set(ids.tolist()) for hash_, ids in zip(self.index_a.keys().tolist(), self.index_a.values())},
+                         expected)
+        self.assertEqual(winnowing.ScoreIndex(2, 3).values(), [])
+
+    def test_top_n_identical_to_nlargest(self):
+        scores = self.index_a.compare(self.index_b, score=lambda h: 1 + h % 3)
+        for n in (0, 1, 5, 17, len(scores), len(scores) + 10):
+            with self.subTest(n=n):
+                expected = [(s.sub_a.id, s.sub_b.id, s.score) for s in heapq.nlargest(n, scores)]
+                top = self.index_a.compare(self.index_b, score=lambda h: 1 + h % 3, n=n)
+                self.assertEqual([(s.sub_a.id, s.sub_b.id, s.score) for s in top], expected)
+
+
+class TestMaxFrequency(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True)
+
+        common = "for i in range(10):\n    print(i)\n"
+        shared = "def foo(bar):\n    return [bar, bar + 1, bar * 2]\n"
+        contents = {"a": common + shared,
+                    "b": common + shared,
+                    "c": common + "while True:\n    pass\n"}
+
+        self.subs = []
+        for name, content in contents.items():
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(content)
+            self.subs.append(data.Submission(name, ["foo.py"], preprocessor=data.Preprocessor([])))
+
+    def pairs(self, max_frequency):
+        winnowing_ = winnowing.Winnowing(k=2, t=3, max_frequency=max_frequency)
+        scores = winnowing_.score(self.subs, [], set())
+        return {(score.sub_a.path.name, score.sub_b.path.name) for score in scores}
+
+    def test_no_max_frequency(self):
+        self.assertEqual(self.pairs(None), {("a", "b"), ("a", "c"), ("b", "c")})
+
+    def test_max_frequency(self):
+        self.assertEqual(self.pairs(2), {("a", "b")})
+        self.assertEqual(self.pairs(0.7), {("a", "b")})
+        self.assertEqual(self.pairs(3), self.pairs(None))
+
+
+class TestCandidates(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True)
+        self.files = [data.Submission(str(i), ["foo"]).files[0] for i in range(40)]
+
+        # Random submissions, of which some are planted near copies of another
+        rand = random.Random(0)
+        self.index = winnowing.ScoreIndex(2, 3)
+        self.planted = set()
+        fingerprints = {}
+        for i, file in enumerate(self.files):
+            if i % 8 == 7:
+                original = self.files[i - 7]
+                hashes = [hash_ for hash_ in fingerprints[original] if rand.random() < 0.95]
+                self.planted.add((original.submission.id, file.submission.id))
+            else:
+                hashes = rand.sample(range(10000), 200)
+            fingerprints[file] = hashes
+            self.index.include_hashes(file, hashes)
+
+    def test_pairs_identical_to_all(self):
+        scores = self.index.compare(self.index, score=lambda h: 1 + h % 3)
+        ids_a = np.array([s.sub_a.id for s in scores])
+        ids_b = np.array([s.sub_b.id for s in scores])
+        pairs = self.index.compare(self.index, score=lambda h: 1 + h % 3, pairs=(ids_a, ids_b))
+        self.assertEqual([(s.sub_a.id, s.sub_b.id) for s in pairs], [(s.sub_a.id, s.sub_b.id) for s in scores])
+        for expected, actual in zip(scores, pairs):
+            self.assertAlmostEqual(expected.score, actual.score)
+
+    def test_candidates_find_planted(self):
+        ids = [file.submission.id for file in self.files]
+        ids_a, ids_b = self.index.candidates(ids, len(self.planted))
+        self.assertEqual(set(zip(ids_a.tolist(), ids_b.tolist())), self.planted)
+        self.assertEqual(len(self.index.candidates(ids, 1)[0]), 1)
+
+    def test_candidates_only_from_submissions(self):
+        ids = [file.submission.id for file in self.files[8:]]
+        ids_a, _ = self.index.candidates(ids, 100)
+        self.assertTrue(set(ids_a.tolist()) <= set(ids))
+        self.assertNotIn(min(self.planted), set(zip(*self.index.candidates(ids, 100))))
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True)
+        self.preprocessor = data.Preprocessor([preprocessors.strip_whitespace])
+
+        rand = random.Random(0)
+        words = ["foo", "bar", "baz", "qux", "quux"]
+        for name in ["a", "b", "c", "x", "y", "z"]:
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                for i in range(20):
+                    f.write("{} = {}({})\n".format(rand.choice(words), rand.choice(words), rand.randint(0, 3)))
+
+    def subs(self, names, is_archive=False):
+        return [data.Submission(os.path.abspath(name), ["foo.py"], preprocessor=self.preprocessor,
+                                is_archive=is_archive) for name in names]
+
+    def score(self, comparator, subs, archive_subs, n=None):
+        scores = comparator._score(subs, archive_subs, set(), n=n)
+        return sorted((s.sub_a.path.name, s.sub_b.path.name, round(s.score, 6)) for s in scores)
+
+    def test_identical_to_archive_submissions(self):
+        subs = self.subs(["a", "b", "c"])
+        winnowing.Winnowing(k=2, t=3).build_archive(self.subs(["x", "y", "z"], is_archive=True), "archive")
+        self.assertTrue(max(sub.id for sub in subs) < min(sub.id for sub in self.subs(["x", "y", "z"])))
+        expected = self.score(winnowing.Winnowing(k=2, t=3), subs, self.subs(["x", "y", "z"], is_archive=True))
+        self.assertTrue(expected)
+
+        for candidates in (None, 100):
+            comparator = winnowing.Winnowing(k=2, t=3, candidates=candidates)
+            comparator.archive = comparator.load_archive("archive", self.preprocessor)
+            self.assertIsInstance(comparator.archive.index._hashes, np.memmap)
+            self.assertEqual(self.score(comparator, subs, comparator.archive.submissions), expected)
+            top = self.score(comparator, subs, comparator.archive.submissions, n=3)
+            self.assertEqual(sorted(score for _, _, score in top),
+                             sorted(score for _, _, score in expected)[-3:])
+
+    def test_archive_with_smaller_ids(self):
+        comparator = winnowing.Winnowing(k=2, t=3)
+        comparator.build_archive(self.subs(["x", "y", "z"], is_archive=True), "archive")
+        comparator.archive = comparator.load_archive("archive", self.preprocessor)
+
+        # Submissions created after the archive have larger ids
+        subs = self.subs(["a", "b", "c"])
+        self.assertTrue(max(sub.id for sub in subs) > min(sub.id for sub in comparator.archive.submissions))
+        expected = self.score(winnowing.Winnowing(k=2, t=3), subs, self.subs(["x", "y", "z"], is_archive=True))
+        self.assertEqual(self.score(comparator, subs, comparator.archive.submissions), expected)
+
+    def test_index_path(self):
+        # Submissions compared before have larger ids, as they are loaded after the new submissions
+        new_subs = self.subs(["x", "y", "z"])
+        subs = self.subs(["a", "b", "c"])
+        def pairs(scores):
+            return sorted((*sorted(names), score) for *names, score in scores)
+
+        expected = pairs(self.score(winnowing.Winnowing(k=2, t=3), new_subs + subs, []))
+        expected = [score for score in expected if {score[0], score[1]} & {"x", "y", "z"}]
+
+        self.score(winnowing.Winnowing(k=2, t=3, index_path="index"), subs, [])
+        comparator = winnowing.Winnowing(k=2, t=3, index_path="index")
+        comparator.archive = comparator.load_archive("index", self.preprocessor)
+        self.assertEqual([sub.path.name for sub in comparator.archive.submissions], ["a", "b", "c"])
+        self.assertFalse(any(sub.is_archive for sub in comparator.archive.submissions))
+        self.assertEqual(pairs(self.score(comparator, new_subs, comparator.archive.submissions)), expected)
+
+        # The index now holds the new submissions too
+        archive = comparator.load_archive("index", self.preprocessor)
+        self.assertEqual(sorted(sub.path.name for sub in archive.submissions), ["a", "b", "c", "x", "y", "z"])
+        self.assertEqual(archive.n_files, 6)
+
+    def test_previous_scores_are_rescored(self):
+        def chunk(name, n):
+            return "".join("{0}_{1} = {0}_{1}_f({1})\n".format(name, i) for i in range(n))
+
+        # a and b share more code than a and c, but d and e share the code of a and b too
+        contents = {"a": chunk("shared_b", 12) + chunk("shared_c", 10), "b": chunk("shared_b", 12) + chunk("b", 5),
+                    "c": chunk("shared_c", 10) + chunk("c", 5), "d": chunk("shared_b", 12) + chunk("d", 5),
+                    "e": chunk("shared_b", 12) + chunk("e", 5)}
+        for name, content in contents.items():
+            os.mkdir("previous_" + name)
+            with open(os.path.join("previous_" + name, "foo.py"), "w") as f:
+                f.write(content)
+        names = ["previous_" + name for name in "abcde"]
+
+        def ranking(scores):
+            return [(score[0][-1], score[1][-1]) for score in sorted(scores, key=lambda score: -score[2])]
+
+        new_subs = self.subs(names[3:])
+        subs = self.subs(names[:3])
+        previous_scores = winnowing.Winnowing(k=2, t=3, index_path="index")._score(subs, [], set())
+        previous = self.score(winnowing.Winnowing(k=2, t=3), subs, [])
+        self.assertEqual(ranking(previous)[:2], [("a", "b"), ("a", "c")])
+
+        comparator = winnowing.Winnowing(k=2, t=3)
+        comparator.archive = comparator.load_archive("index", self.preprocessor)
+        comparator.previous_scores = previous_scores
+        scores = self.score(comparator, new_subs, comparator.archive.submissions)
+
+        expected = self.score(winnowing.Winnowing(k=2, t=3), new_subs + subs, [])
+        self.assertEqual(scores, expected)
+        old_pairs = [pair for pair in ranking(scores) if set(pair) <= set("abc")]
+        self.assertEqual(old_pairs[:2], [("a", "c"), ("a", "b")])
+
+    def test_settings_must_match(self):
+        winnowing.Winnowing(k=2, t=3).build_archive(self.subs(["x", "y"], is_archive=True), "archive")
+        with self.assertRaises(api.Error):
+            winnowing.Winnowing(k=3, t=4).load_archive("archive", self.preprocessor)
+        with self.assertRaises(api.Error):
+            winnowing.Winnowing(k=2, t=3).load_archive("archive", data.Preprocessor([]))
+        with open("foo", "w") as f:
+            f.write("foo")
+        with self.assertRaises(api.Error):
+            winnowing.Winnowing(k=2, t=3).load_archive("foo", self.preprocessor)
+
+    def test_lexers_must_match(self):
+        winnowing.Winnowing(k=2, t=3).build_archive(self.subs(["x", "y"], is_archive=True), "archive")
+        winnowing.Winnowing(k=2, t=3).load_archive("archive", self.preprocessor)
+        with self.assertRaises(api.Error):
+            winnowing.Winnowing(k=2, t=3).load_archive("archive", self.preprocessor,
+                                                       {".py": "ruby"})
+
+
+class TestCompareIndex(unittest.TestCase):
+    FILES = pathlib.Path(__file__).parent / "files"
+
+    def test_compare_identical_to_sets(self):
+        files = [data.Submission(path.parent, [path.name]).files[0] for path in sorted(self.FILES.glob("*/*.py"))]
+        for file_a, file_b in itertools.combinations(files, 2):
+            with self.subTest(file_a=file_a.name, file_b=file_b.name):
+                index_a, index_b = winnowing.CompareIndex(3), winnowing.CompareIndex(3)
+                index_a.include(file_a)
+                index_b.include(file_b)
+
+                spans_a, spans_b = collections.defaultdict(set), collections.defaultdict(set)
+                for hash_, span in index_a.fingerprint(file_a):
+                    spans_a[hash_].add((span.start, span.end))
+                for hash_, span in index_b.fingerprint(file_b):
+                    spans_b[hash_].add((span.start, span.end))
+                expected = {(span_a, span_b) for hash_ in spans_a.keys() & spans_b.keys()
+                            for span_a, span_b in itertools.product(spans_a[hash_], spans_b[hash_])}
+
+                positions_a, positions_b = index_a.compare(index_b)
+                _, _, starts_a, ends_a = index_a.spans(positions_a)
+                _, _, starts_b, ends_b = index_b.spans(positions_b)
+                actual = list(zip(zip(starts_a.tolist(), ends_a.tolist()), zip(starts_b.tolist(), ends_b.tolist())))
+                self.assertEqual(len(actual), len(expected))
+                self.assertEqual(set(actual), expected)
+
+    def test_values(self):
+        file = data.Submission(self.FILES / "sub_a", ["foo.py"]).files[0]
+        index = winnowing.CompareIndex(3)
+        self.assertEqual(index.values(), [])
+        index.include(file)
+
+        expected = collections.defaultdict(set)
+        for hash_, span in index.fingerprint(file):
+            expected[hash_].add((span.start, span.end))
+        actual = {}
+        for hash_, positions in zip(index.keys().tolist(), index.values()):
+            _, _, starts, ends = index.spans(positions)
+            actual[hash_] = set(zip(starts.tolist(), ends.tolist()))
+        self.assertEqual(actual, expected)
+
+
+class TestCompare(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True)
+        preprocessor = data.Preprocessor([preprocessors.strip_whitespace])
+
+        distro = "def main():\n    print('hello, world')\n"
+        shared = "def foo(bar):\n    return [bar, bar + 1, bar * 2]\n"
+        contents = {"a": {"foo.py": distro + shared, "bar.py": shared + "x = 1\n"},
+                    "b": {"foo.py": shared + distro + "y = 2\n"},
+                    "c": {"foo.py": distro + "while True:\n    pass\n" + shared},
+                    "d": {"foo.py": shared + distro + shared}}
+
+        os.mkdir("distro")
+        with open(os.path.join("distro", "foo.py"), "w") as f:
+            f.write(distro)
+        self.ignored_files = set(data.Submission(os.path.abspath("distro"), ["foo.py"], preprocessor=preprocessor).files)
+
+        self.subs = []
+        for name, files in contents.items():
+            os.mkdir(name)
+            for file_name, content in files.items():
+                with open(os.path.join(name, file_name), "w") as f:
+                    f.write(content)
+            self.subs.append(data.Submission(os.path.abspath(name), sorted(files), preprocessor=preprocessor))
+
+        self.scores = [data.Score(sub_a, sub_b, 1) for sub_a, sub_b in itertools.combinations(self.subs, 2)]
+
+    def compare(self):
+        comparisons = winnowing.Winnowing(k=2, t=3).compare(self.scores, self.ignored_files)
+        return [(c.sub_a, c.sub_b,
+                 sorted((a.file.id, a.start, a.end, b.file.id, b.start, b.end) for a, b in c.span_matches),
+                 sorted((span.file.id, span.start, span.end) for span in c.ignored_spans))
+                for c in comparisons]
+
+    def test_parallel_identical_to_serial(self):
+        comparisons = self.compare()
+        self.assertTrue(all(span_matches and ignored_spans for _, _, span_matches, ignored_spans in comparisons))
+
+        executor = api.Executor
+        api.Executor = api.FauxExecutor
+        try:
+            self.assertEqual(self.compare(), comparisons)
+        finally:
+            api.Executor = executor
+
+    def test_matches_do_not_straddle_ignored_spans(self):
+        comparisons = winnowing.Winnowing(k=2, t=3).compare(self.scores, self.ignored_files)
+        for comparison in comparisons:
+            for span_a, span_b in comparison.span_matches:
+                self.assertNotIn("hello, world", span_a._raw_contents())
+                self.assertNotIn("hello, world", span_b._raw_contents())
+
+    def test_spans_of_own_files(self):
+        files = {file.id: file for sub in self.subs for file in sub}
+        for comparison in winnowing.Winnowing(k=2, t=3).compare(self.scores, self.ignored_files):
+            for span_a, span_b in comparison.span_matches:
+                self.assertIs(span_a.file, files[span_a.file.id])
+                self.assertIs(span_b.file, files[span_b.file.id])
+
+
+class TestIndexFiles(unittest.TestCase):
+    FILES = pathlib.Path(__file__).parent / "files"
+
+    def setUp(self):
+        self.files = [data.Submission(path.parent, [path.name]).files[0]
+                      for path in sorted(self.FILES.glob("*/*.py"))]
+        self.index_file = winnowing.Winnowing._index_file(winnowing.ScoreIndex, (2, 3))
+
+    def test_batch_identical_to_files(self):
+        expected = winnowing.ScoreIndex(2, 3)
+        expected_frequencies = collections.Counter()
+        for file in self.files:
+            index = self.index_file(file)
+            expected.include_all(index)
+            expected_frequencies.update(index.keys().tolist())
+
+        # Index the files in every possible number of batches, then merge the batches
+        for n in range(1, len(self.files) + 1):
+            with self.subTest(n=n):
+                batches = winnowing._split(self.files, n)
+                self.assertEqual(sum(batches, []), self.files)
+
+                index = winnowing.ScoreIndex(2, 3)
+                frequencies = []
+                for batch_index, batch_frequencies in map(winnowing.Winnowing._index_files(self.index_file), batches):
+                    index.include_all(batch_index)
+                    frequencies.append(batch_frequencies)
+
+                for actual, expected_array in zip(index._arrays(), expected._arrays()):
+                    self.assertEqual(actual.tolist(), expected_array.tolist())
+
+                hashes, counts = winnowing._merge_frequencies(frequencies)
+                self.assertEqual(dict(zip(hashes.tolist(), counts.tolist())), expected_frequencies)
+
+
+class TestHashes(unittest.TestCase):
+    FILE = pathlib.Path(__file__).parent / "files" / "sub_a" / "foo.py"
+
+    def hashes(self, hash, seed):
+        code = "import compare50; from compare50.comparators import _winnowing as w;" \
+               "f = compare50.Submission({!r}, [{!r}]).files[0];" \
+               "print(w.CompareIndex(3, hash={!r}).hashes(f.tokens()).tolist())" \
+               .format(str(self.FILE.parent), self.FILE.name, hash)
+        env = dict(os.environ, PYTHONHASHSEED=str(seed))
+        return subprocess.check_output([sys.executable, "-c", code], env=env,
+                                       cwd=str(pathlib.Path(__file__).parents[1]))
+
+    def test_rolling_hashes_are_stable_across_processes(self):
+        self.assertEqual(self.hashes("rolling", 1), self.hashes("rolling", 2))
+
+    def test_rolling_hashes_kgrams(self):
+        file = data.Submission(self.FILE.parent, [self.FILE.name]).files[0]
+        tokens = file.tokens()
+        hashes = winnowing.CompareIndex(3).hashes(tokens)
+
+        self.assertEqual(len(hashes), len(tokens) - 2)
+        self.assertEqual(list(winnowing.CompareIndex(3).hashes(tokens[:2])), [])
+
+        # Identical k-grams hash identically, irrespective of their position
+        for i, j in itertools.combinations(range(len(hashes)), 2):
+            kgram_i = [t.val for t in tokens[i:i + 3]]
+            kgram_j = [t.val for t in tokens[j:j + 3]]
+            self.assertEqual(kgram_i == kgram_j, hashes[i] == hashes[j])
+
+    def test_columnar_tokens_hash_identically(self):
+        file = data.Submission(self.FILE.parent, [self.FILE.name]).files[0]
+        for hash in winnowing.HASHES:
+            index = winnowing.CompareIndex(3, hash=hash)
+            self.assertEqual(list(index.hashes(file.tokens(columnar=True))), list(index.hashes(file.tokens())))
+            self.assertEqual([(h, s.start, s.end) for h, s in index.fingerprint(file, file.tokens(columnar=True))],
+                             [(h, s.start, s.end) for h, s in index.fingerprint(file, file.tokens())])
+
+    def test_hash_is_selectable(self):
+        file = data.Submission(self.FILE.parent, [self.FILE.name]).files[0]
+        builtin = winnowing.CompareIndex(3, hash="builtin").hashes(file.tokens())
+        expected = [hash("".join(t.val for t in file.tokens()[i:i + 3])) for i in range(len(builtin))]
+        self.assertEqual(list(builtin), expected)
+
+        with self.assertRaises(ValueError):
+            winnowing.Winnowing(k=3, t=5, hash="foo")
+
+
+class TestFingerprintCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n"
+                    "    print('qux')\n"
+                    "    return 42\n")
+
+        preprocessor = data.Preprocessor([preprocessors.strip_whitespace, preprocessors.normalize_identifiers])
+        self.file = data.Submission(".", ["foo.py"], preprocessor=preprocessor).files[0]
+        self.cache = cache.FingerprintCache("cache")
+        self.index_file = winnowing.Winnowing._index_file(winnowing.ScoreIndex, (2, 3), cache=self.cache)
+
+    def test_cached_index_is_identical(self):
+        expected = winnowing.ScoreIndex(2, 3)
+        expected.include(self.file)
+
+        for _ in range(2):
+            index = self.index_file(self.file)
+            self.assertEqual(list(index.keys()), list(expected.keys()))
+            self.assertEqual(index._max_id, expected._max_id)
+            self.assertEqual(len(list(self.cache.path.glob("*/*.npy"))), 1)
+
+    def test_cache_hit_skips_fingerprinting(self):
+        self.index_file(self.file)
+
+        with unittest.mock.patch.object(winnowing.ScoreIndex, "fingerprint_hashes") as fingerprint_hashes:
+            self.index_file(self.file)
+        fingerprint_hashes.assert_not_called()
+
+    def test_key_depends_on_contents_and_settings(self):
+        key = self.cache.key(self.file, "foo")
+        self.assertEqual(key, self.cache.key(self.file, "foo"))
+        self.assertNotEqual(key, self.cache.key(self.file, "bar"))
+
+        with open("foo.py", "a") as f:
+            f.write("print('baz')\n")
+        self.assertNotEqual(key, self.cache.key(self.file, "foo"))
+
+    def test_lexer_change_misses_cache(self):
+        self.index_file(self.file)
+        file = data.Submission(".", ["foo.py"], preprocessor=self.file.submission.preprocessor,
+                               lexers={".py": "ruby"}).files[0]
+        self.index_file(file)
+        self.assertEqual(len(list(self.cache.path.glob("*/*.npy"))), 2)
+
+    def test_key_of_cached_text_skips_reading(self):
+        key = self.cache.key(self.file, "foo")
+        with cache.cache_texts():
+            data.File._text_cache.put(self.file.path, self.file.read())
+            os.remove("foo.py")
+            self.assertEqual(self.cache.key(self.file, "foo"), key)
+
+    def test_uncacheable_preprocessor(self):
+        file = data.Submission(".", ["foo.py"], preprocessor=lambda tokens: tokens).files[0]
+        self.index_file(file)
+        self.assertFalse(self.cache.path.exists())
+
+    def test_prune(self):
+        for i in range(10):
+            self.cache.put(str(i) * 64, range(100))
+        entry_size = next(self.cache.path.glob("*/*.npy")).stat().st_size
+
+        self.cache.max_size = entry_size * 5
+        self.cache.prune()
+        self.assertEqual(len(list(self.cache.path.glob("*/*.npy"))), 5)
+
+        self.cache.max_age = -1
+        self.cache.prune()
+        self.assertEqual(list(self.cache.path.glob("*/*.npy")), [])
+
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     unittest.TextTestRunner(verbosity=2).run(suite)